@@ -7,16 +7,56 @@ clusters are assigned to the group 'good'. This means that reverting the
 assignment requires two 'undo' steps in action history.
 
 Removing the assignment both removes the quality label and the group
-assignment (two actions).
+assignment (two actions). Clusters that already have the quality or
+group are left out, such that no empty actions are added to the
+history.
+
+'Suggest quality' scores all unsorted clusters by their refractory
+violations, amplitude cutoff and signal-to-noise ratio (see
+`QualityMetrics`) in a background thread and fills the column
+'quality_suggested'. The thresholds of each level are checked in order
+and the first level whose thresholds are all met is suggested. Clusters
+meeting none are left without suggestion. 'Accept suggested quality'
+assigns the suggested levels to the selected clusters, with one label
+action per level and one group assignment, leaving out clusters that
+already have the suggested quality or group.
+
+Configuration:
+
+On first use, a JSON file will be created in the Phy configuration
+directory, usually {HOME}/.phy/plugin_assignquality.json, with the
+thresholds of the suggested levels.
 """
 
+import sys
+from collections import defaultdict
+from pathlib import Path
 from phy import IPlugin, connect
+from phy.gui.qt import Worker, thread_pool
+import numpy as np
 import logging
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import load_config, timed  # noqa: E402
+from plugin_annotations import annotations  # noqa: E402
+from plugin_metrics import metrics_table  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
 class AssignQuality(IPlugin):
+    def __init__(self):
+        # Default config
+        dflts = dict()
+        dflts['suggest'] = [  # Thresholds of the suggested levels 1 to 3
+            dict(max_isi_viol=.002, max_amp_cutoff=.05, min_snr=8.),
+            dict(max_isi_viol=.005, max_amp_cutoff=.1, min_snr=5.),
+            dict(max_isi_viol=.01, max_amp_cutoff=.2, min_snr=3.),
+        ]
+
+        self.config = load_config('plugin_assignquality.json', dflts)
+
+    @timed('Assign quality')
     def assignQuality(self, controller, quality=None):
         """Assign the label to all selected clusters"""
         selection = controller.supervisor.selected
@@ -25,28 +65,108 @@ class AssignQuality(IPlugin):
         if not selection:
             return
 
-        # Assign quality
-        controller.supervisor.label('quality',
-                                    str(quality) if quality else None)
-
-        # Obtain sub selection of good clusters
         if not isinstance(selection, list):
             selection = list(selection)
-        sel_good = [ci for ci, ll
-                    in controller.supervisor.get_labels('group').items()
-                    if ci in selection and ll == 'good']
+        sup = controller.supervisor
+
+        # Assign quality to the clusters that do not have it yet
+        store = annotations(controller)
+        changed = np.asarray(selection)[
+            store.get_quality(selection) != (quality or 0)].tolist()
+        if changed:
+            sup.label('quality', str(quality) if quality else None,
+                      cluster_ids=changed)
+
+        # Obtain sub selection of good clusters
+        sel_good = [c for c in selection
+                    if sup.cluster_meta.get('group', c) == 'good']
 
         # (Un-)assign group membership
         if quality:
-            if len(sel_good) != len(selection):
-                controller.supervisor.label('group', 'good')
+            not_good = [c for c in selection if c not in sel_good]
+            if not_good:
+                sup.label('group', 'good', cluster_ids=not_good)
             logger.info('Assign quality of %i to clusters %s.', quality,
                         ', '.join(map(str, selection)))
         else:
-            controller.supervisor.label('group', None, sel_good)
+            if sel_good:
+                sup.label('group', None, sel_good)
             logger.info('Remove quality assignment from clusters %s.',
                         ', '.join(map(str, selection)))
 
+    def suggest(self, controller, cluster_ids, pending):
+        """
+        Return the suggested quality of clusters, None if they meet no
+        level, from the spikes not in the metrics table yet at the time
+        of `MetricsTable.pending`
+        """
+        table = metrics_table(controller)
+        table.update(pending)
+        isi = table.lookup('isi_viol', cluster_ids)
+        cutoff = table.lookup('amp_cutoff', cluster_ids)
+        snr = table.lookup('snr', cluster_ids)  # NaN without templates
+
+        # Lower levels take precedence
+        levels = self.config['suggest']
+        quality = np.zeros(len(cluster_ids), dtype=np.int64)
+        for level, thr in reversed(list(enumerate(levels, 1))):
+            ok = isi <= thr.get('max_isi_viol', np.inf)
+            ok &= cutoff <= thr.get('max_amp_cutoff', np.inf)
+            ok &= ~(snr < thr.get('min_snr', -np.inf))
+            quality[ok] = level
+        return {c: q or None for c, q in zip(cluster_ids, quality.tolist())}
+
+    def show_suggestions(self, controller, suggested):
+        """Fill the column of suggested quality, one action per level"""
+        sup = controller.supervisor
+        existing = set(sup.clustering.cluster_ids)
+        current = (sup.get_labels('quality_suggested')
+                   if 'quality_suggested' in sup.fields else dict())
+        by_level = defaultdict(list)
+        for cluster_id, quality in suggested.items():
+            quality = str(quality) if quality else None
+            if (cluster_id in existing and
+                    current.get(cluster_id) != quality):
+                by_level[quality].append(cluster_id)
+        for quality, cluster_ids in by_level.items():
+            sup.label('quality_suggested', quality, cluster_ids=cluster_ids)
+        levels = defaultdict(int)
+        for quality in suggested.values():
+            levels[quality or 'none'] += 1
+        logger.info('Suggested quality for %i clusters: %s.',
+                    len(suggested), ', '.join(
+                        '%i x %s' % (n, q) for q, n in sorted(
+                            levels.items(), key=lambda item: str(item[0]))))
+
+    @timed('Accept suggested quality')
+    def acceptSuggestions(self, controller):
+        """Assign the suggested quality to all selected clusters"""
+        selection = controller.supervisor.selected
+        if 'quality_suggested' not in controller.supervisor.fields:
+            logger.warn('Run suggest quality first.')
+            return
+        sup = controller.supervisor
+        suggested = sup.get_labels('quality_suggested')
+        accepted = [c for c in selection if suggested.get(c)]
+        if not accepted:
+            return
+
+        # Batched label updates instead of one per cluster, only for the
+        # clusters that do not have the suggested quality or group yet
+        by_level = defaultdict(list)
+        for cluster_id in accepted:
+            quality = str(suggested[cluster_id])
+            if sup.cluster_meta.get('quality', cluster_id) != quality:
+                by_level[quality].append(cluster_id)
+        for quality, cluster_ids in sorted(by_level.items()):
+            sup.label('quality', quality, cluster_ids=cluster_ids)
+        not_good = [c for c in accepted
+                    if sup.cluster_meta.get('group', c) != 'good']
+        if not_good:
+            sup.label('group', 'good', cluster_ids=not_good)
+        logger.info('Accept suggested quality for clusters %s.',
+                    ', '.join(map(str, accepted)))
+
     def attach_to_controller(self, controller):
         @connect
         def on_gui_ready(sender, gui):
@@ -74,3 +194,29 @@ class AssignQuality(IPlugin):
                                                submenu='Assign quality')
             def Remove_quality_assigment():
                 self.assignQuality(controller, 0)
+
+            @controller.supervisor.actions.add(submenu='Assign quality')
+            @timed('Suggest quality')
+            def Suggest_quality():
+                """Suggest the quality of all unsorted clusters"""
+                logger.info('Scoring unsorted clusters.')
+
+                # The worker only gets a snapshot of the clustering
+                groups = controller.supervisor.get_labels('group')
+                cluster_ids = [c for c, g in groups.items()
+                               if g in (None, 'unsorted')]
+                pending = metrics_table(controller).pending()
+                worker = Worker(self.suggest, controller, cluster_ids,
+                                pending)
+
+                # The labels are set in the GUI thread
+                @worker.signals.result.connect
+                def on_result(suggested):
+                    self.show_suggestions(controller, suggested)
+
+                thread_pool().start(worker)
+
+            @controller.supervisor.actions.add(shortcut='alt+6',
+                                               submenu='Assign quality')
+            def Accept_suggested_quality():
+                self.acceptSuggestions(controller)
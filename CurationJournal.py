@@ -0,0 +1,156 @@
+"""
+Journal curation changes to recover them after a crash
+
+All changes of the clustering (merges and splits, also those of other
+plugins) and of the cluster labels (group, quality, comments, ...) are
+appended to `plugin_journal.bin` in the data directory by a background
+thread. Saving starts a new journal.
+
+If phy was closed without saving, the journal applies to the
+clustering loaded on the next start and it is replayed in bulk: all
+merges and splits with a single split, and the labels with one action
+per value. The labels of the loaded clusters are set before the split
+and those of the final clusters of the journal after it. Labels passed
+on to new clusters by merges and splits are journaled with them. The
+recovery can be undone like other actions.
+
+See `plugin_journal` for the file format.
+"""
+
+import sys
+from collections import defaultdict
+from pathlib import Path
+from phy import IPlugin, connect
+import numpy as np
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import timed  # noqa: E402
+from plugin_journal import (JournalWriter, checksum, collapse,  # noqa: E402
+                            encode_assign, encode_label, read_journal)
+
+logger = logging.getLogger('phy')
+
+
+class CurationJournal(IPlugin):
+    filename = 'plugin_journal.bin'
+
+    def load(self, filepath, n_spikes, check):
+        """Return the records of the journal if it applies to the data"""
+        if not filepath.exists():
+            return []
+        try:
+            n, journal_check, records = read_journal(filepath)
+        except (OSError, ValueError) as e:
+            logger.warning("Cannot read the journal %s: %s", filepath, e)
+            return []
+        if n != n_spikes or journal_check != check:
+            logger.debug("Journal does not apply to this clustering.")
+            return []
+        return records
+
+    def _label(self, supervisor, labels, mapping):
+        """
+        Set the journaled labels of the clusters in `mapping` to the
+        clusters they map to, return the number of labels set
+        """
+        n_labels = 0
+        for field, values in labels.items():
+            by_value = defaultdict(list)
+            for cluster_id, value in values.items():
+                if cluster_id in mapping:
+                    by_value[value].append(mapping[cluster_id])
+            for value, clusters in by_value.items():
+                supervisor.label(field, value, cluster_ids=clusters)
+                n_labels += len(clusters)
+        return n_labels
+
+    @timed('Replay journal')
+    def replay(self, controller, records):
+        """Apply the final state of the journal records"""
+        sup = controller.supervisor
+        clustering = sup.clustering
+        spike_ids, cluster_ids, labels = collapse(records)
+
+        # Labels of the loaded clusters go first, such that the split
+        # passes them on to the clusters replacing them
+        original = set(clustering.cluster_ids)
+        n_labels = self._label(sup, labels, {c: c for c in original})
+
+        # Journaled cluster ids are replaced by new ones
+        mapping = dict()
+        changed = clustering.spike_clusters[spike_ids] != cluster_ids
+        spike_ids, cluster_ids = spike_ids[changed], cluster_ids[changed]
+        if spike_ids.size:
+            sup.actions.split(spike_ids, cluster_ids)
+            old, index = np.unique(cluster_ids, return_index=True)
+            new = clustering.spike_clusters[spike_ids[index]]
+            mapping = dict(zip(old.tolist(), new.tolist()))
+
+        # Labels of intermediate clusters of the journal are dropped
+        n_labels += self._label(sup, labels, mapping)
+
+        logger.info("Recovered %i reassigned spikes and %i labels from the "
+                    "journal.", spike_ids.size, n_labels)
+
+    def attach_to_controller(self, controller):
+        filepath = Path(controller.dir_path) / self.filename
+
+        @connect
+        def on_gui_ready(sender, gui):
+            sup = controller.supervisor
+            clustering = sup.clustering
+            n_spikes = len(clustering.spike_clusters)
+            check = checksum(clustering.spike_clusters)
+            records = self.load(filepath, n_spikes, check)
+            if records:
+                # Keep the journal until the replay is written again
+                filepath.replace(filepath.with_suffix('.bak'))
+
+            writer = JournalWriter(filepath)
+            writer.reset(n_spikes, check)
+
+            def on_clustering(sender, up):
+                if len(up.spike_ids):
+                    spike_ids = np.asarray(up.spike_ids)
+                    writer.append(encode_assign(
+                        spike_ids, clustering.spike_clusters[spike_ids],
+                        n_spikes))
+                # The supervisor has already passed on the labels to the
+                # new clusters, without a label event. Missing labels are
+                # journaled as well, as a replayed split of several
+                # clusters passes on the labels of all of them.
+                for field in ('group',) + tuple(sup.fields):
+                    by_value = defaultdict(list)
+                    for cluster_id in up.added:
+                        by_value[sup.cluster_meta.get(
+                            field, cluster_id)].append(cluster_id)
+                    for value, clusters in by_value.items():
+                        writer.append(encode_label(field, value, clusters))
+
+            def on_cluster_meta(sender, up):
+                field = up.description[len('metadata_'):]
+                if not up.description.startswith('metadata_') or not field:
+                    return
+                # Current values, which differ per cluster after an undo
+                by_value = defaultdict(list)
+                for cluster_id in up.metadata_changed:
+                    by_value[sup.cluster_meta.get(field, cluster_id)].append(
+                        cluster_id)
+                for value, clusters in by_value.items():
+                    writer.append(encode_label(field, value, clusters))
+
+            connect(on_clustering, event='cluster', sender=clustering)
+            connect(on_cluster_meta, event='cluster', sender=sup.cluster_meta)
+
+            # Replayed changes are written to the new journal
+            if records:
+                self.replay(controller, records)
+
+            @connect(sender=sup)
+            def on_save_clustering(sender, spike_clusters, *args):
+                writer.reset(n_spikes, checksum(spike_clusters))
+
+            @connect(sender=gui)
+            def on_close(sender):
+                writer.close()
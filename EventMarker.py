@@ -8,10 +8,22 @@ provided as integers (no decimal point), they are treated as samples.
 Optionally, corresponding names can be supplied in
 `eventmarkernames.txt`.
 
+The events may be grouped into trials by a second column with the
+(non-negative integer) trial number of each event. The events of a
+trial are then numbered as stimuli 1, 2, ... in temporal order and
+labeled `trial.stim`, e.g. 37.3 for the third event of trial 37. 'Go to
+event' accepts these addresses as well as `37 3`, which also works for
+stimuli 10 and above. A trial starts with its first event and ends with
+the start of the next trial.
+
+'Count spikes per trial' writes the number of spikes of each selected
+cluster per trial to `trial_spike_counts.tsv` in the data directory.
+
 The event markers may be toggled on/off from the amplitude view menu or
 by keyboard shortcut.
 """
 
+import csv
 from phy import IPlugin, connect
 from phy.cluster.views import AmplitudeView, TraceView
 from phy.plot.visuals import LineVisual, TextVisual
@@ -22,6 +34,49 @@ import numpy as np
 logger = logging.getLogger('phy')
 
 
+class TrialIndex(object):
+    """Events grouped by trial as offsets into the events sorted by trial"""
+
+    def __init__(self, events, trials, duration):
+        # Events sorted by trial, in temporal order within trials
+        self.order = np.lexsort((events, trials))
+        self.trial_ids, counts = np.unique(trials, return_counts=True)
+        self.offsets = np.r_[0, np.cumsum(counts)]
+
+        # Position of each trial number, -1 for none
+        self.lookup = np.full(self.trial_ids[-1] + 1, -1, dtype=np.int64)
+        self.lookup[self.trial_ids] = np.arange(self.trial_ids.size)
+
+        # Trials end with the start of the next trial in time
+        self.starts = events[self.order[self.offsets[:-1]]]
+        later = np.r_[np.sort(self.starts), duration]
+        self.ends = later[np.searchsorted(later[:-1], self.starts, 'right')]
+
+    def event(self, trial, stim):
+        """Index of the stim-th event of a trial, -1 if it does not exist"""
+        if not 0 <= trial < self.lookup.size or self.lookup[trial] < 0:
+            return -1
+        i = self.lookup[trial]
+        if not 1 <= stim <= self.offsets[i + 1] - self.offsets[i]:
+            return -1
+        return self.order[self.offsets[i] + stim - 1]
+
+    def labels(self):
+        """Address `trial.stim` of each event"""
+        n_events = self.order.size
+        out = np.empty(n_events, dtype=object)
+        stims = np.arange(n_events) - np.repeat(self.offsets[:-1],
+                                                np.diff(self.offsets)) + 1
+        trials = np.repeat(self.trial_ids, np.diff(self.offsets))
+        out[self.order] = ['%i.%i' % ts for ts in zip(trials, stims)]
+        return list(out)
+
+    def spike_counts(self, spike_times):
+        """Number of sorted spike times per trial"""
+        return (np.searchsorted(spike_times, self.ends) -
+                np.searchsorted(spike_times, self.starts))
+
+
 class EventMarker(IPlugin):
     # Line color of the event markers
     line_color = (1, 1, 1, 0.75)
@@ -62,13 +117,53 @@ class EventMarker(IPlugin):
 
                 @view.actions.add(shortcut='shift+alt+e', prompt=True,
                                   name='Go to event', alias='ge')
-                def Go_to_event(event_num):
+                def Go_to_event(event_num, stim=None):
+                    """
+                    Go to an event by number, or by trial and stimulus as
+                    `trial.stim` or `trial stim`
+                    """
                     trace_view = gui.get_view(TraceView)
+                    if stim is None and isinstance(event_num, float):
+                        event_num, stim = map(int, str(event_num).split('.'))
+                    if stim is not None:
+                        if index is None:
+                            logger.warn('No trials in the event marker file.')
+                            return
+                        event_num = index.event(event_num, stim) + 1
                     if 0 < event_num <= events.size:
                         trace_view.go_to(events[event_num - 1])
 
+                @view.actions.add(name='Count spikes per trial',
+                                  alias='trialcounts')
+                def Count_spikes_per_trial():
+                    """
+                    Write the spike counts of the selected clusters per
+                    trial to trial_spike_counts.tsv
+                    """
+                    cluster_ids = controller.supervisor.selected
+                    if index is None or not cluster_ids:
+                        logger.warn('Select clusters and add trials to the '
+                                    'event marker file.')
+                        return
+                    counts = [index.spike_counts(np.sort(
+                        controller.get_spike_times(c))) for c in cluster_ids]
+                    filepath = controller.dir_path / 'trial_spike_counts.tsv'
+                    with open(filepath, 'w', newline='') as f:
+                        writer = csv.writer(f, delimiter='\t')
+                        writer.writerow(['trial', 'start', 'duration'] +
+                                        list(map(str, cluster_ids)))
+                        for row in zip(index.trial_ids, index.starts,
+                                       index.ends - index.starts, *counts):
+                            writer.writerow(['%i' % row[0], '%.6f' % row[1],
+                                             '%.6f' % row[2]] +
+                                            ['%i' % n for n in row[3:]])
+                    logger.info('Wrote the spike counts of %i trials to %s.',
+                                index.trial_ids.size, filepath)
+
                 # Disable the menu until events are successfully added
+                index = None
                 view.actions.disable('Go to event')
+                view.actions.disable('Count spikes per trial')
                 view.actions.disable('Toggle event markers')
                 if not hasattr(view, 'show_events'):
                     view.show_events = True
@@ -84,8 +179,35 @@ class EventMarker(IPlugin):
                     view.show_events = False
                     return
 
+                events = np.atleast_1d(events)
+
+                # Obtain seconds from samples
+                if events.dtype == int:
+                    logger.debug('Converting input from samples to seconds.')
+                    events = events / controller.model.sample_rate
+
+                # Read trials from the second column (if present)
+                try:
+                    trials = np.atleast_1d(np.genfromtxt(
+                        controller.dir_path / 'eventmarkers.txt', usecols=1,
+                        dtype=int))
+                except ValueError:
+                    trials = None
+                if trials is not None and (trials.size != events.size or
+                                           trials.min() < 0):
+                    logger.warn('Ignore invalid trial numbers in the event '
+                                'marker file.')
+                    trials = None
+                if trials is not None:
+                    index = TrialIndex(events, trials, view.duration)
+                    logger.debug('Index %i events in %i trials.', events.size,
+                                 index.trial_ids.size)
+
                 # Create list of event names
-                labels = list(map(str, range(1, events.size + 1)))
+                if index is not None:
+                    labels = index.labels()
+                else:
+                    labels = list(map(str, range(1, events.size + 1)))
 
                 # Read event names from file (if present)
                 filename = controller.dir_path / 'eventmarkernames.txt'
@@ -97,11 +219,6 @@ class EventMarker(IPlugin):
                     logger.info('Event marker names file not found (optional):'
                                 ' `%s`. Fall back to numbering.', filename)
 
-                # Obtain seconds from samples
-                if events.dtype == int:
-                    logger.debug('Converting input from samples to seconds.')
-                    events = events / controller.model.sample_rate
-
                 logger.debug('Add event markers to amplitude view.')
 
                 # Obtain horizontal positions
@@ -124,6 +241,8 @@ class EventMarker(IPlugin):
                 logger.debug('Enable menu items.')
                 view.actions.enable('Go to event')
                 view.actions.enable('Toggle event markers')
+                if index is not None:
+                    view.actions.enable('Count spikes per trial')
                 if view.show_events:
                     view.actions.get('Toggle event markers').toggle()
                 else:
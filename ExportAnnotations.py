@@ -0,0 +1,130 @@
+"""
+Export the cluster annotations for analysis outside of phy
+
+'Export annotations' writes one row per cluster with the columns
+
+- cluster_id, ch (peak channel), n_spikes,
+- group, quality (0 for none, see `AssignQuality`) and comment (see
+  `WriteComments`),
+- fr, isi_viol, amp_cutoff, presence and snr (NaN without templates),
+  see `QualityMetrics`,
+
+and the spike times of the clusters of the exported groups ('good' by
+default) as a ragged array: spike_times holds the sorted spike times (in
+s) of all these clusters one after the other, and those of the i-th
+cluster in spike_times_clusters are
+spike_times[spike_times_offsets[i]:spike_times_offsets[i + 1]].
+
+The columns are written as arrays to `cluster_annotations.npz` in the
+data directory, or, with the format 'npy', as one .npy file per column
+in the directory `cluster_annotations`, like the files of the template
+GUI. The .npy files can be memory-mapped with
+`np.load(path, mmap_mode='r')`. Strings are stored as unicode arrays,
+i.e. no pickle is needed to read them.
+
+Configuration:
+
+On first use, a JSON file will be created in the Phy configuration
+directory, usually {HOME}/.phy/plugin_exportannotations.json, with the
+format and the groups whose spike times are exported.
+"""
+
+import os
+import sys
+from pathlib import Path
+from phy import IPlugin, connect
+import numpy as np
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import count, load_config, timed  # noqa: E402
+from plugin_annotations import annotations  # noqa: E402
+from plugin_metrics import group_by_cluster, metrics_table  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class ExportAnnotations(IPlugin):
+    # Quality metrics exported as columns
+    metrics = ['fr', 'isi_viol', 'amp_cutoff', 'presence', 'snr']
+
+    def __init__(self):
+        # Default config
+        dflts = dict()
+        dflts['format'] = 'npz'  # Or 'npy' for one file per column
+        dflts['spike_times_groups'] = ['good']  # Export their spike times
+
+        self.config = load_config('plugin_exportannotations.json', dflts)
+
+    def columns(self, controller):
+        """Return the exported arrays by name"""
+        sup = controller.supervisor
+        model = controller.model
+        spike_clusters = sup.clustering.spike_clusters
+        cluster_ids = np.asarray(sup.clustering.cluster_ids, dtype=np.int64)
+
+        def strings(field):
+            labels = sup.get_labels(field)
+            return np.array([str(labels.get(c) or '') for c in cluster_ids],
+                            dtype=str)
+
+        out = dict(cluster_id=cluster_ids)
+        out['ch'] = np.array([controller.get_best_channel(c)
+                              for c in cluster_ids], dtype=np.int64)
+        out['n_spikes'] = np.bincount(
+            spike_clusters, minlength=cluster_ids.max(initial=-1) + 1)[
+                cluster_ids].astype(np.int64)
+        out['group'] = strings('group')
+        out['quality'] = annotations(controller).get_quality(cluster_ids)
+        out['comment'] = strings('comment')
+        table = metrics_table(controller)
+        for name in self.metrics:
+            out[name] = table.values(name, cluster_ids)
+
+        # Spike times of the exported groups as offsets and values
+        groups = set(self.config['spike_times_groups'])
+        exported = cluster_ids[np.isin(out['group'], list(groups))]
+        spike_ids = np.flatnonzero(np.isin(spike_clusters, exported))
+        order, clusters, _, counts = group_by_cluster(
+            spike_clusters[spike_ids])
+        out['spike_times'] = np.asarray(
+            model.spike_times[spike_ids[order]], dtype=np.float64)
+        out['spike_times_clusters'] = clusters.astype(np.int64)
+        out['spike_times_offsets'] = np.r_[0, np.cumsum(counts)].astype(
+            np.int64)
+        count(spikes=len(spike_clusters),
+              nbytes=spike_clusters.nbytes + out['spike_times'].nbytes)
+        return out
+
+    def save(self, path, columns):
+        """Write the arrays, replace existing files only when complete"""
+        if self.config['format'] == 'npy':
+            path.mkdir(exist_ok=True)
+            for name, values in columns.items():
+                tmp = path / (name + '.npy.tmp')
+                with open(tmp, 'wb') as f:
+                    np.save(f, values)
+                os.replace(tmp, path / (name + '.npy'))
+        else:
+            tmp = path.with_suffix('.npz.tmp')
+            with open(tmp, 'wb') as f:
+                np.savez(f, **columns)
+            os.replace(tmp, path.with_suffix('.npz'))
+
+    def attach_to_controller(self, controller):
+        @connect
+        def on_gui_ready(sender, gui):
+            @controller.supervisor.actions.add(name='Export annotations',
+                                               alias='export')
+            @timed('Export annotations')
+            def Export_annotations():
+                """
+                Write the annotations, metrics and spike times of all
+                clusters to cluster_annotations in the data directory
+                """
+                columns = self.columns(controller)
+                path = Path(controller.dir_path) / 'cluster_annotations'
+                self.save(path, columns)
+                logger.info('Exported %i clusters and the spike times of %i '
+                            'of them to %s.', len(columns['cluster_id']),
+                            len(columns['spike_times_clusters']), path)
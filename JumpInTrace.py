@@ -1,16 +1,76 @@
 """
 Additional jump options in trace view.
+
+Jump to the next or previous spike of any of the selected clusters, or
+to the next or previous burst or gap in their firing. Bursts and gaps
+are periods in which the spike density of the selected clusters is well
+above or below its mean over the session.
+
+The spike density is shown as a strip at the bottom of the amplitude
+view. Clicking the strip moves the trace view to that time.
+
+The spike times and density are computed once per selection and reused
+for all jumps until the selection changes.
 """
 
 import logging
+import sys
 import numpy as np
-from phy import IPlugin, connect
+from pathlib import Path
+from phy import IPlugin, connect, emit, unconnect
+from phy.cluster.views import AmplitudeView
 from phy.cluster.views.trace import TraceView as TraceView
+from phy.plot.transform import NDC, Range
+from phy.plot.visuals import HistogramVisual
+from phylib.utils import Bunch
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import count, timed  # noqa: E402
 
 logger = logging.getLogger('phy')
 
 
+def _run_starts(mask):
+    """Indices where runs of True values start"""
+    return np.flatnonzero(mask & ~np.r_[False, mask[:-1]])
+
+
 class JumpInTrace(IPlugin):
+    # Bin size of the spike density in s
+    bin_size = 1.
+    # Bursts and gaps are bins above and below these multiples of the mean
+    burst_factor = 3.
+    gap_factor = .1
+    # Height of the density strip in the amplitude view and its color
+    strip_height = .1
+    strip_color = (1, 1, 1, 0.5)
+
+    def __init__(self):
+        self._density = None  # Of the last selection
+
+    def density(self, controller, cluster_ids):
+        """Sorted spike times and binned density of clusters"""
+        # Cluster ids are never reused for different spikes, so the
+        # selection identifies its spikes
+        key = tuple(cluster_ids)
+        if self._density is not None and self._density.key == key:
+            return self._density
+
+        spike_times = np.sort(np.concatenate(
+            [controller.get_spike_times(c) for c in cluster_ids] or
+            [np.zeros(0)]))
+        count(spikes=len(spike_times), nbytes=spike_times.nbytes)
+        duration = controller.model.duration
+        n_bins = max(1, int(np.ceil(duration / self.bin_size)))
+        hist, edges = np.histogram(spike_times, bins=n_bins,
+                                   range=(0, duration))
+        mean = hist.mean()
+
+        self._density = Bunch(
+            key=key, spike_times=spike_times, hist=hist,
+            bursts=edges[_run_starts(hist > self.burst_factor * mean)],
+            gaps=edges[_run_starts(hist < self.gap_factor * mean)])
+        return self._density
 
     def attach_to_controller(self, controller):
 
@@ -18,6 +78,7 @@ class JumpInTrace(IPlugin):
         def on_view_attached(view, gui):
             if isinstance(view, TraceView):
 
+                @timed('Jump to spike')
                 def _jump_to_spike(delta=+1):
                     """
                     Move within the spikes of any of the selected clusters.
@@ -25,13 +86,12 @@ class JumpInTrace(IPlugin):
                     time = view.time  # Current position
 
                     selected = controller.supervisor.selected
-                    spt = np.array([])
-                    for sel in selected:
-                        spt = np.hstack((spt,
-                                         (controller.get_spike_times(sel))))
-                    spike_times = np.sort(spt)
-                    ind = np.searchsorted(spike_times, time)
+                    spike_times = self.density(controller,
+                                               selected).spike_times
                     n = len(spike_times)
+                    if not n:
+                        return
+                    ind = np.searchsorted(spike_times, time)
                     target = spike_times[(ind + delta) % n]
                     logger.debug('Jump with %+d to one of the spikes from '
                                  'clusters %s. Jumped from %.5f to %.5f.',
@@ -39,6 +99,29 @@ class JumpInTrace(IPlugin):
                                  target)
                     view.go_to(target)
 
+                @timed('Jump to burst or gap')
+                def _jump_to_period(kind, delta=+1):
+                    """
+                    Move to the start of the next or previous burst or gap
+                    """
+                    time = view.time  # Current position
+
+                    selected = controller.supervisor.selected
+                    starts = self.density(controller, selected)[kind]
+                    # Skip the period the view is already at
+                    if delta > 0:
+                        ind = np.searchsorted(starts, time + self.bin_size / 2)
+                    else:
+                        ind = np.searchsorted(starts,
+                                              time - self.bin_size / 2) - 1
+                    if not 0 <= ind < len(starts):
+                        logger.info('No %s %s in clusters %s.',
+                                    'next' if delta > 0 else 'previous',
+                                    kind[:-1], ', '.join(map(str, selected)))
+                        return
+                    logger.debug('Jump to %s at %.3f.', kind[:-1], starts[ind])
+                    view.go_to(starts[ind])
+
                 @view.actions.add(shortcut='shift+alt+pgdown',
                                   name='Jump to next spike')
                 def jump_to_next_spike():
@@ -54,3 +137,64 @@ class JumpInTrace(IPlugin):
                     Go to previous spike from any selected cluster.
                     """
                     _jump_to_spike(-1)
+
+                @view.actions.add(name='Jump to next burst')
+                def jump_to_next_burst():
+                    """
+                    Go to next period of high spike density.
+                    """
+                    _jump_to_period('bursts', +1)
+
+                @view.actions.add(name='Jump to previous burst')
+                def jump_to_prev_burst():
+                    """
+                    Go to previous period of high spike density.
+                    """
+                    _jump_to_period('bursts', -1)
+
+                @view.actions.add(name='Jump to next gap')
+                def jump_to_next_gap():
+                    """
+                    Go to next period of low spike density.
+                    """
+                    _jump_to_period('gaps', +1)
+
+                @view.actions.add(name='Jump to previous gap')
+                def jump_to_prev_gap():
+                    """
+                    Go to previous period of low spike density.
+                    """
+                    _jump_to_period('gaps', -1)
+
+            elif isinstance(view, AmplitudeView):
+                # Density strip along the bottom of the view
+                visual = HistogramVisual()
+                visual.transforms.add(
+                    Range(NDC, (-1, -1, 1, -1 + 2 * self.strip_height)))
+                view.canvas.add_visual(visual)
+
+                def on_mouse_click(e):
+                    """Go to the clicked time in the trace view"""
+                    if e.modifiers:
+                        return
+                    x, y = view.canvas.panzoom.window_to_ndc(e.pos)
+                    if y > -1 + 2 * self.strip_height:
+                        return
+                    emit('select_time', view, (x + 1) / 2 * view.duration)
+
+                view.canvas.attach_events(Bunch(on_mouse_click=on_mouse_click))
+
+                @connect(sender=controller.supervisor)
+                def on_select(sender, cluster_ids, **kwargs):
+                    if not cluster_ids:
+                        return
+                    hist = self.density(controller, cluster_ids).hist
+                    visual.reset_batch()
+                    visual.add_batch_data(hist=hist, ylim=max(hist.max(), 1),
+                                          color=self.strip_color)
+                    view.canvas.update_visual(visual)
+                    view.canvas.update()
+
+                @connect(sender=view)
+                def on_close_view(view_, gui):
+                    unconnect(on_select)
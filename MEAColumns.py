@@ -1,17 +1,22 @@
 """Remove unneccessary columns for curating MEA data"""
 
-from phy import IPlugin, connect
+import sys
+from pathlib import Path
+from phy import IPlugin
 import logging
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import column_layout  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
 class MEAColumns(IPlugin):
+    # Columns not applicable to MEA data
+    columns_to_remove = ['sh', 'depth', 'Amplitude']
+
     def attach_to_controller(self, controller):
-        @connect
-        def on_controller_ready(sender):
-            columns_to_remove = ['sh', 'depth', 'Amplitude']
-            for col in columns_to_remove:
-                if col in controller.supervisor.columns:
-                    logger.debug('Remove column `%s`.', col)
-                    controller.supervisor.columns.remove(col)
+        # The columns are removed once the controller is ready, together
+        # with the reordering of other plugins, see `plugin_utils`
+        logger.debug('Remove columns %s.', ', '.join(self.columns_to_remove))
+        column_layout(controller).remove_columns(self.columns_to_remove)
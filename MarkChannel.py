@@ -2,12 +2,17 @@
 Highlight all clusters in the same channel
 """
 
+import sys
 import numpy as np
+from pathlib import Path
 from phy import IPlugin, connect
 from phy.cluster.supervisor import ClusterView
 from phy.utils.color import selected_cluster_color
 import logging
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import table_bridge, timed  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
@@ -16,6 +21,7 @@ class MarkChannel(IPlugin):
         @connect
         def on_gui_ready(sender, gui):
             @connect(sender=controller.supervisor)
+            @timed('Mark channel')
             def on_select(sender, cluster_ids=None, **kwargs):
                 view = gui.get_view(ClusterView)
 
@@ -36,39 +42,12 @@ class MarkChannel(IPlugin):
                 for c in sender.clustering.cluster_ids:
                     ch = sender.get_cluster_info(c)['ch']
                     if ch in channels:
-                        clust[str(c)] = colors[channels.index(ch)]
-
-                js = """
-                    var ll = """ + str(clust) + """;
-                    var itms = document.getElementsByTagName("tr");
-                    var chng = []
-                    for (var i = 0; i < itms.length; i++) {
-                        var c_id = itms[i].getAttribute('data-_id');
-
-                        // New clusters do not have this attribute
-                        if (!c_id) {
-                            c_id = itms[i].getElementsByClassName('id')
-                            if (c_id.length) {
-                                c_id = c_id[0].innerHTML;
-                            } else {
-                                continue;
-                            }
-                        };
-
-                        if (Object.keys(ll).indexOf(c_id) >= 0) {
-                            itms[i].style.background = ll[c_id];
-                            chng.push(c_id);
-                        } else {
-                            itms[i].style.background = '';
-                        }
-                    }
-
-                    // Report highlighted clusters to callback function
-                    chng
-                """
+                        clust[c] = colors[channels.index(ch)]
 
+                # Report highlighted clusters to callback function
                 def report(obj):
                     logger.debug('Highlighted clusters %s.',
-                                 ', '.join(obj) if len(obj) > 0 else 'none')
+                                 ', '.join(obj or ()) or 'none')
 
-                view.eval_js(js, callback=report)
+                table_bridge(view).rows('markchannel', 'background', clust,
+                                        callback=report)
@@ -0,0 +1,133 @@
+"""
+Find and remove duplicate spikes when merging clusters
+
+When two templates detect the same spike, merging their clusters counts
+the spike twice, which shows up as refractory period violations.
+
+'Find duplicate spikes' reports, for the selected clusters, the number
+of spikes within a short window of a spike of another selected cluster
+and the fraction of refractory period violations of the merged cluster
+with and without them.
+
+'Merge without duplicates' merges the selected clusters and moves the
+duplicates into a separate cluster labeled as noise. Of each pair of
+coincident spikes, the one with the lower amplitude is the duplicate.
+The merge is done as a single split of all spikes of the selected
+clusters, followed by the noise label, i.e. it is undone in two steps.
+
+The spike ids of the selected clusters are in temporal order, so the
+spikes are compared in a single pass without sorting.
+
+Configuration:
+
+On first use, a JSON file will be created in the Phy configuration
+directory, usually {HOME}/.phy/plugin_mergeduplicates.json, with the
+window in seconds.
+"""
+
+import sys
+from pathlib import Path
+from phy import IPlugin, connect
+import numpy as np
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import count, load_config, timed  # noqa: E402
+from plugin_metrics import duplicate_spikes  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class MergeDuplicates(IPlugin):
+    def __init__(self):
+        # Default config
+        dflts = dict()
+        dflts['window'] = .0005  # Duplicates within this time in s
+        dflts['refractory'] = .0015  # Refractory period in s
+
+        self.config = load_config('plugin_mergeduplicates.json', dflts)
+
+    def find(self, controller, cluster_ids):
+        """
+        Return the spike ids of the clusters in temporal order and the
+        mask of their duplicates
+        """
+        sup = controller.supervisor
+        model = controller.model
+        spike_ids = sup.clustering.spikes_in_clusters(cluster_ids)
+        spike_times = model.spike_times[spike_ids]
+        amplitudes = model.amplitudes[spike_ids]
+        count(spikes=len(spike_ids),
+              nbytes=spike_times.nbytes + amplitudes.nbytes)
+        duplicates = duplicate_spikes(
+            spike_times, sup.clustering.spike_clusters[spike_ids],
+            amplitudes, self.config['window'])
+        return spike_ids, spike_times, duplicates
+
+    def _violations(self, spike_times):
+        """Fraction of refractory violations of sorted spike times"""
+        if len(spike_times) < 2:
+            return 0.
+        short = np.diff(spike_times) < self.config['refractory']
+        return short.sum() / len(spike_times)
+
+    def attach_to_controller(self, controller):
+        @connect
+        def on_gui_ready(sender, gui):
+            @controller.supervisor.actions.add(name='Find duplicate spikes',
+                                               alias='dup',
+                                               submenu='Duplicates')
+            @timed('Find duplicate spikes')
+            def Find_duplicate_spikes():
+                """
+                Report spikes of the selected clusters detected twice
+                """
+                cluster_ids = controller.supervisor.selected
+                if len(cluster_ids) < 2:
+                    logger.warn('Select at least two clusters.')
+                    return
+                spike_ids, spike_times, duplicates = self.find(
+                    controller, cluster_ids)
+                clustering = controller.supervisor.clustering
+                spike_clusters = clustering.spike_clusters[
+                    spike_ids[duplicates]]
+                per_cluster = ', '.join(
+                    '%i in %i' % (n, c) for c, n in zip(
+                        *np.unique(spike_clusters, return_counts=True)))
+                logger.info('%i duplicate spikes (%s), refractory '
+                            'violations of the merge %.2f%% with and %.2f%% '
+                            'without them.', duplicates.sum(),
+                            per_cluster or 'none',
+                            100 * self._violations(spike_times),
+                            100 * self._violations(spike_times[~duplicates]))
+
+            @controller.supervisor.actions.add(name='Merge without '
+                                                    'duplicates',
+                                               alias='mergedup',
+                                               submenu='Duplicates')
+            @timed('Merge without duplicates')
+            def Merge_without_duplicates():
+                """
+                Merge the selected clusters and move the duplicate spikes
+                into a noise cluster
+                """
+                sup = controller.supervisor
+                cluster_ids = sup.selected
+                if len(cluster_ids) < 2:
+                    logger.warn('Select at least two clusters.')
+                    return
+                spike_ids, _, duplicates = self.find(controller, cluster_ids)
+                if not duplicates.any():
+                    logger.info('No duplicate spikes, merge clusters %s.',
+                                ', '.join(map(str, cluster_ids)))
+                    sup.actions.merge()
+                    return
+
+                # Merged spikes and duplicates in a single split
+                sup.actions.split(spike_ids, duplicates.astype(np.int64))
+                noise = int(sup.clustering.spike_clusters[
+                    spike_ids[duplicates][0]])
+                sup.label('group', 'noise', cluster_ids=[noise])
+                logger.info('Merged clusters %s without %i duplicate spikes '
+                            '(cluster %i).', ', '.join(map(str, cluster_ids)),
+                            duplicates.sum(), noise)
@@ -0,0 +1,51 @@
+"""
+Show the timings of plugin actions
+
+The actions of the plugins in this repository record their wall time
+together with the number of spikes and bytes they loaded. The most
+recent calls are kept per action.
+
+'Plugin timings' in the help menu logs the median (p50) and 95th
+percentile (p95) of the wall time of each action. 'Save plugin timings'
+writes all recorded calls to `plugin_timings.csv` in the data
+directory.
+"""
+
+import sys
+from pathlib import Path
+from phy import IPlugin, connect
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import timings  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class PluginTimings(IPlugin):
+    def attach_to_controller(self, controller):
+        @connect
+        def on_gui_ready(sender, gui):
+            @gui.help_actions.add(name='Plugin timings')
+            def Plugin_timings():
+                """Log the timings of the plugin actions"""
+                stats = timings().stats()
+                if not stats:
+                    logger.info('No plugin actions recorded yet.')
+                    return
+
+                lines = ['%-32s %6s %9s %9s %10s %9s' % (
+                    'action', 'calls', 'p50 (ms)', 'p95 (ms)', 'spikes',
+                    'MB')]
+                for st in stats:
+                    lines.append('%-32s %6i %9.1f %9.1f %10i %9.2f' % (
+                        st['name'], st['calls'], st['p50'] * 1e3,
+                        st['p95'] * 1e3, st['spikes'], st['nbytes'] / 1e6))
+                logger.info('Plugin timings:\n%s', '\n'.join(lines))
+
+            @gui.help_actions.add(name='Save plugin timings')
+            def Save_plugin_timings():
+                """Write all recorded plugin action calls to a CSV file"""
+                filepath = controller.dir_path / 'plugin_timings.csv'
+                timings().save(filepath)
+                logger.info('Saved plugin timings to %s.', filepath)
@@ -0,0 +1,205 @@
+"""
+Propose splits and labels for all clusters at once
+
+'Batch pre-curation' computes for all non-noise clusters
+
+- the fraction of refractory period violations (as in 'Visualize short
+  ISI'),
+- the fraction of outliers by Mahalanobis distance of the PC features
+  (as in 'Split by Mahalanobis distance') and
+- the bimodality of the template amplitudes (as in 'Split by
+  amplitude').
+
+Clusters with many violations are proposed to be labeled as MUA,
+otherwise clusters with some outliers are proposed to be split into the
+outliers and the rest, otherwise clusters with bimodal amplitudes are
+proposed to be split at the amplitude valley.
+
+The proposals are written to `precuration.tsv` in the data directory.
+Delete the lines of the proposals to reject (or empty their proposal)
+and run 'Apply pre-curation' to apply the remaining ones. All splits are
+done in a single split and all labels in a single label action, i.e.
+the whole batch is undone in at most two steps. Proposals of clusters
+that have changed since are skipped. The file has no `cluster_id`
+column on purpose, such that phy does not load it as cluster metadata.
+
+Configuration:
+
+On first use, a JSON file will be created in the Phy configuration
+directory, usually {HOME}/.phy/plugin_precuration.json, with the
+thresholds of the proposals.
+"""
+
+import csv
+import sys
+from pathlib import Path
+from phy import IPlugin, connect
+import numpy as np
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import count, load_config, timed  # noqa: E402
+from plugin_clustering import combine_splits, split_by_valleys  # noqa: E402
+from plugin_features import feature_cache  # noqa: E402
+from plugin_metrics import (bimodality, outliers_per_cluster,  # noqa: E402
+                            refractory_violations)
+
+logger = logging.getLogger('phy')
+
+
+class PreCuration(IPlugin):
+    # Columns of the proposals file
+    columns = ['id', 'n_spikes', 'isi_violations', 'outliers',
+               'bimodality', 'proposal']
+
+    def __init__(self):
+        # Default config
+        dflts = dict()
+        dflts['min_spikes'] = 100  # Ignore smaller clusters
+        dflts['refractory'] = .0015  # Refractory period in s
+        dflts['max_isi_violations'] = .01  # Label as MUA above
+        dflts['outlier_threshold'] = 14  # Mahalanobis distance in STDs
+        dflts['min_outliers'] = .001  # Split outliers within this range
+        dflts['max_outliers'] = .2
+        dflts['min_bimodality'] = .555  # Split amplitudes above
+
+        self.config = load_config('plugin_precuration.json', dflts)
+        self.proposals = dict()  # Cluster id: (proposal, labels)
+
+    def propose(self, controller):
+        """Compute the metrics of all clusters and propose curation steps"""
+        cfg = self.config
+        sup = controller.supervisor
+        model = controller.model
+        spike_clusters = sup.clustering.spike_clusters
+        count(spikes=len(spike_clusters),
+              nbytes=model.spike_times.nbytes + model.amplitudes.nbytes)
+
+        # Metrics of all clusters in one pass
+        cluster_ids, isi = refractory_violations(
+            model.spike_times, spike_clusters, cfg['refractory'])
+        _, bimod = bimodality(model.amplitudes, spike_clusters)
+        n_spikes = np.bincount(spike_clusters)[cluster_ids]
+
+        groups = sup.get_labels('group')
+        keep = np.array([groups.get(c) != 'noise' for c in cluster_ids],
+                        dtype=bool)
+        keep &= n_spikes >= cfg['min_spikes']
+        rows = [dict(id=int(c), n_spikes=int(n), isi_violations=float(i),
+                     bimodality=float(b))
+                for c, n, i, b in zip(cluster_ids[keep], n_spikes[keep],
+                                      isi[keep], bimod[keep])]
+        logger.info("Pre-curation of %i clusters.", len(rows))
+
+        # Feature outliers of the clusters not labeled as MUA
+        spike_ids = {r['id']: sup.clustering.spikes_per_cluster[r['id']]
+                     for r in rows
+                     if r['isi_violations'] <= cfg['max_isi_violations']}
+        features = feature_cache(controller).features
+        outliers = outliers_per_cluster(features, spike_ids,
+                                        cfg['outlier_threshold'])
+
+        self.proposals = dict()
+        for row in rows:
+            cluster_id = row['id']
+            out = outliers.get(cluster_id)
+            row['outliers'] = (len(out) / row['n_spikes'] if out is not None
+                               else np.nan)
+            row['proposal'] = ''
+            labels = None
+
+            if row['isi_violations'] > cfg['max_isi_violations']:
+                if groups.get(cluster_id) != 'mua':
+                    row['proposal'] = 'mua'
+            elif cfg['min_outliers'] <= row['outliers'] <= cfg[
+                    'max_outliers']:
+                labels = np.zeros(row['n_spikes'], dtype=np.int64)
+                labels[out] = 1
+                row['proposal'] = 'split_outliers'
+            elif row['bimodality'] > cfg['min_bimodality']:
+                amplitudes = model.amplitudes[spike_ids[cluster_id]]
+                labels, n_found = split_by_valleys(amplitudes, 2)
+                if n_found > 1:
+                    row['proposal'] = 'split_amplitude'
+
+            if row['proposal']:
+                self.proposals[cluster_id] = (row['proposal'], labels)
+        return rows
+
+    def save(self, filepath, rows):
+        """Write the proposals to a TSV file"""
+        with open(filepath, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns,
+                                    delimiter='\t')
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({k: ('%.4f' % v if isinstance(v, float)
+                                     else v) for k, v in row.items()})
+
+    def load(self, filepath):
+        """Read the accepted proposals from a TSV file"""
+        with open(filepath, newline='') as f:
+            rows = list(csv.DictReader(f, delimiter='\t'))
+        return {int(r['id']): r['proposal'].strip() for r in rows
+                if r.get('id') and (r.get('proposal') or '').strip()}
+
+    def attach_to_controller(self, controller):
+        def filepath():
+            return Path(controller.dir_path) / 'precuration.tsv'
+
+        @connect
+        def on_gui_ready(sender, gui):
+            @controller.supervisor.actions.add(name='Batch pre-curation',
+                                               alias='precur',
+                                               submenu='Pre-curation')
+            @timed('Batch pre-curation')
+            def Batch_precuration():
+                """
+                Propose labels and splits for all non-noise clusters and
+                write them to precuration.tsv in the data directory
+                """
+                rows = self.propose(controller)
+                self.save(filepath(), rows)
+                logger.info("Wrote %i proposals to %s, review them and "
+                            "apply pre-curation.", len(self.proposals),
+                            filepath())
+
+            @controller.supervisor.actions.add(name='Apply pre-curation',
+                                               submenu='Pre-curation')
+            @timed('Apply pre-curation')
+            def Apply_precuration():
+                """Apply the proposals remaining in precuration.tsv"""
+                if not filepath().exists():
+                    logger.warn("Run batch pre-curation first.")
+                    return
+                accepted = self.load(filepath())
+                clustering = controller.supervisor.clustering
+                existing = set(clustering.cluster_ids)
+
+                mua, split, spike_ids, labels = [], [], [], []
+                for cluster_id, proposal in accepted.items():
+                    if (cluster_id not in existing or
+                            self.proposals.get(cluster_id, (None,))[0] !=
+                            proposal):
+                        logger.debug("Skip proposal of cluster %i.",
+                                     cluster_id)
+                        continue
+                    if proposal == 'mua':
+                        mua.append(cluster_id)
+                        continue
+                    split.append(cluster_id)
+                    spike_ids.append(
+                        clustering.spikes_per_cluster[cluster_id])
+                    labels.append(self.proposals[cluster_id][1])
+
+                # All splits at once
+                spike_ids, labels = combine_splits(spike_ids, labels)
+                if spike_ids.size:
+                    count(spikes=len(spike_ids), nbytes=labels.nbytes)
+                    controller.supervisor.actions.split(spike_ids, labels)
+                if mua:
+                    controller.supervisor.label('group', 'mua',
+                                                cluster_ids=mua)
+                logger.info("Applied pre-curation: %i clusters split, %i "
+                            "labeled as MUA.", len(split), len(mua))
+                self.proposals = dict()
@@ -0,0 +1,43 @@
+"""
+Show quality metrics of all clusters in the cluster view
+
+Three columns are added:
+
+- isi_viol: fraction of spikes within 1.5 ms of the previous spike
+- amp_cutoff: estimated fraction of spikes missing below the detection
+  threshold, from the template amplitudes
+- presence: fraction of the recording (in 100 bins) with spikes
+
+The firing rate (fr) and peak channel (ch) are already provided by phy.
+
+The metrics of all clusters are computed in one pass when the cluster
+view is built. After merges and splits, only the new clusters are
+computed.
+"""
+
+import sys
+from pathlib import Path
+from phy import IPlugin
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_metrics import metrics_table  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class QualityMetrics(IPlugin):
+    # Metrics shown as columns
+    columns = ['isi_viol', 'amp_cutoff', 'presence']
+
+    def attach_to_controller(self, controller):
+        table = metrics_table(controller)
+
+        def metric(name):
+            def get(cluster_id):
+                value = table.get(name, cluster_id)
+                return round(value, 3) if value is not None else None
+            return get
+
+        for name in self.columns:
+            controller.cluster_metrics[name] = metric(name)
@@ -1,15 +1,76 @@
 """
 Copied and modified from https://github.com/petersenpeter/phy2-plugins/
+
+The K-means clustering is seeded by the selected cluster ids, such that
+splitting the same cluster twice gives the same result.
+
+The split by amplitude cuts the template amplitudes at the valleys of
+their distribution instead of iterating. Optionally, the cuts are
+placed separately within time windows to follow amplitude drift.
+
+Similarly, the K-means split by amplitude can cluster time chunks
+separately in parallel processes and link the clusters across chunks.
+
+The features of the selected spikes are kept in memory, such that
+trying different splits of the same clusters reads them only once.
+
+The actions ending with 'per cluster' split each selected cluster
+independently, in parallel processes, and apply all splits at once.
+Each cluster is split as if it was selected alone.
 """
 import logging
+import sys
 import numpy as np
+from pathlib import Path
 from phy import IPlugin, connect
-from scipy.cluster.vq import kmeans2, whiten
+from scipy.cluster.vq import whiten
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import count, timed  # noqa: E402
+from plugin_features import feature_cache  # noqa: E402
+from plugin_clustering import (combine_splits, kmeans,  # noqa: E402
+                               kmeans_chunked, split_by_valleys,
+                               split_clusters)
 
 logger = logging.getLogger('phy')
 
 
 class Recluster(IPlugin):
+    # Number of K-means restarts (run in parallel)
+    n_init = 4
+
+    def split_each(self, controller, method, n_clusters, window=0,
+                   features=False):
+        """
+        Split each selected cluster independently with a method of
+        `split_cluster`, based on the features or template amplitudes
+        """
+        sup = controller.supervisor
+        cluster_ids = sup.selected
+        if features:
+            spike_ids = [sup.clustering.spikes_per_cluster[c]
+                         for c in cluster_ids]
+            data = feature_cache(controller).get(np.concatenate(spike_ids))
+        else:
+            bunchs = controller._amplitude_getter(cluster_ids,
+                                                  name='template',
+                                                  load_all=True)
+            spike_ids = [b.spike_ids for b in bunchs]
+            data = np.concatenate([b.amplitudes for b in bunchs])
+        offsets = np.r_[0, np.cumsum(list(map(len, spike_ids)))]
+        times = controller.model.spike_times[np.concatenate(spike_ids)]
+        count(spikes=len(data), nbytes=data.nbytes + times.nbytes)
+
+        labels = split_clusters(data, offsets, method, n_clusters,
+                                seeds=list(map(int, cluster_ids)),
+                                times=times, window=window,
+                                n_init=self.n_init)
+        spike_ids, labels = combine_splits(spike_ids, labels)
+        if not spike_ids.size:
+            logger.warn("None of the clusters could be split.")
+            return
+        sup.actions.split(spike_ids, labels)
+
     def attach_to_controller(self, controller):
         @connect
         def on_gui_ready(sender, gui):
@@ -17,6 +78,7 @@ class Recluster(IPlugin):
             @controller.supervisor.actions.add(shortcut='alt+q', prompt=True,
                                                prompt_default=lambda: 2,
                                                submenu='Clustering')
+            @timed('K-means clustering')
             def K_means_clustering(kmeanclusters):
                 """Select number of clusters"""
                 logger.info("Running K-means clustering")
@@ -26,12 +88,14 @@ class Recluster(IPlugin):
                 spike_ids = controller.selector.select_spikes(cluster_ids)
                 s = controller.supervisor.clustering.spikes_in_clusters(
                     cluster_ids)
-                data = controller.model._load_features()
-                data3 = data.data[spike_ids]
+                data3 = feature_cache(controller).get(spike_ids)
+                count(spikes=len(spike_ids), nbytes=data3.nbytes)
                 data2 = np.reshape(data3, (data3.shape[0],
                                            data3.shape[1]*data3.shape[2]))
                 whitened = whiten(data2)
-                clusters_out, label = kmeans2(whitened, kmeanclusters)
+                clusters_out, label = kmeans(whitened, kmeanclusters,
+                                             seed=list(map(int, cluster_ids)),
+                                             n_init=self.n_init)
                 assert s.shape == label.shape
 
                 controller.supervisor.actions.split(s, label)
@@ -40,10 +104,12 @@ class Recluster(IPlugin):
             @controller.supervisor.actions.add(shortcut='alt+a', prompt=True,
                                                prompt_default=lambda: 2,
                                                submenu='Clustering')
-            def K_means_clustering_amplitude(n_clusters):
+            @timed('K-means clustering amplitude')
+            def K_means_clustering_amplitude(n_clusters, chunk=0):
                 """
                 Split based on template amplitudes. Select number of
-                clusters
+                clusters and optionally a chunk duration in seconds to
+                cluster separately over time
                 """
 
                 # Selected clusters across cluster and similarity views
@@ -62,23 +128,114 @@ class Recluster(IPlugin):
                 # NOTE: we only consider the first selected cluster
                 spike_ids = bunchs[0].spike_ids
                 y = bunchs[0].amplitudes
+                count(spikes=len(spike_ids), nbytes=y.nbytes)
                 y_whitened = whiten(y.reshape((-1, 1)))
 
                 # Perform the clustering algorithm, which returns an
                 # integer for each sub-cluster
-                clusters_out, labels = kmeans2(y_whitened, n_clusters)
+                if chunk:
+                    # Follow amplitude drift across time chunks
+                    spike_times = controller.model.spike_times[spike_ids]
+                    labels = kmeans_chunked(y_whitened, n_clusters,
+                                            spike_times, chunk,
+                                            seed=int(cluster_ids[0]),
+                                            n_init=self.n_init)
+                else:
+                    clusters_out, labels = kmeans(y_whitened, n_clusters,
+                                                  seed=int(cluster_ids[0]),
+                                                  n_init=self.n_init)
 
                 assert spike_ids.shape == labels.shape
 
                 # We split according to the labels.
                 controller.supervisor.actions.split(spike_ids, labels)
 
+            @controller.supervisor.actions.add(shortcut='shift+alt+a',
+                                               prompt=True,
+                                               prompt_default=lambda: 2,
+                                               submenu='Clustering')
+            @timed('Split by amplitude')
+            def Split_by_amplitude(n_clusters, window=0):
+                """
+                Split at the valleys of the template amplitude
+                distribution. Select number of clusters and optionally
+                a time window in seconds to follow amplitude drift
+                """
+                cluster_ids = controller.supervisor.selected
+                bunchs = controller._amplitude_getter(cluster_ids,
+                                                      name='template',
+                                                      load_all=True)
+
+                # NOTE: we only consider the first selected cluster
+                spike_ids = bunchs[0].spike_ids
+                y = bunchs[0].amplitudes
+                spike_times = controller.model.spike_times[spike_ids]
+                count(spikes=len(spike_ids), nbytes=y.nbytes)
+
+                labels, n_found = split_by_valleys(y, n_clusters,
+                                                   times=spike_times,
+                                                   window=window)
+                if n_found < 2:
+                    logger.warn("No valleys found in the amplitudes.")
+                    return
+                if n_found < n_clusters:
+                    logger.info("Found only %i amplitude clusters.", n_found)
+
+                assert spike_ids.shape == labels.shape
+                controller.supervisor.actions.split(spike_ids, labels)
+
+            @controller.supervisor.actions.add(prompt=True,
+                                               prompt_default=lambda: 2,
+                                               name='K-means clustering per '
+                                                    'cluster',
+                                               submenu='Clustering')
+            @timed('K-means clustering per cluster')
+            def K_means_clustering_per_cluster(n_clusters):
+                """
+                Split each selected cluster separately based on its
+                features. Select number of clusters
+                """
+                self.split_each(controller, 'kmeans', n_clusters,
+                                features=True)
+
+            @controller.supervisor.actions.add(prompt=True,
+                                               prompt_default=lambda: 2,
+                                               name='K-means clustering '
+                                                    'amplitude per cluster',
+                                               submenu='Clustering')
+            @timed('K-means clustering amplitude per cluster')
+            def K_means_clustering_amplitude_per_cluster(n_clusters,
+                                                         chunk=0):
+                """
+                Split each selected cluster separately based on its
+                template amplitudes. Select number of clusters and
+                optionally a chunk duration in seconds
+                """
+                self.split_each(controller, 'kmeans', n_clusters,
+                                window=chunk)
+
+            @controller.supervisor.actions.add(prompt=True,
+                                               prompt_default=lambda: 2,
+                                               name='Split by amplitude per '
+                                                    'cluster',
+                                               submenu='Clustering')
+            @timed('Split by amplitude per cluster')
+            def Split_by_amplitude_per_cluster(n_clusters, window=0):
+                """
+                Split each selected cluster separately at the valleys
+                of its template amplitudes. Select number of clusters
+                and optionally a time window in seconds
+                """
+                self.split_each(controller, 'valleys', n_clusters,
+                                window=window)
+
             @controller.supervisor.actions.add(shortcut='alt+x', prompt=True,
                                                prompt_default=lambda: 14,
                                                name='Split by Mahalanobis '
                                                     'distance',
                                                alias='mahdist',
                                                submenu='Clustering')
+            @timed('Split by Mahalanobis distance')
             def MahalanobisDist(thres_in):
                 """Select threshold in STDs"""
                 logger.info("Removing outliers by Mahalanobis distance")
@@ -117,8 +274,8 @@ class Recluster(IPlugin):
                 spike_ids = controller.selector.select_spikes(cluster_ids)
                 s = controller.supervisor.clustering.spikes_in_clusters(
                     cluster_ids)
-                data = controller.model._load_features()
-                data3 = data.data[spike_ids]
+                data3 = feature_cache(controller).get(spike_ids)
+                count(spikes=len(spike_ids), nbytes=data3.nbytes)
                 data2 = np.reshape(data3, (data3.shape[0],
                                            data3.shape[1]*data3.shape[2]))
                 if data2.shape[0] < data2.shape[1]:
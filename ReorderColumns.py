@@ -7,8 +7,10 @@ by specifying all column names in `last_columns`, see configuration
 below.
 
 The similarity column in the similarity view is added to the table last
-(far right), such that there is an additional function below to reset
-the table with the desired column order instead.
+(far right) by phy. The final column order of both views is therefore
+computed once together with other plugins (see `plugin_utils`) before
+the tables are built, such that the similarity view is created with the
+desired column order right away.
 
 If present, the column named 'quality' will be squeezed to minimum width
 to preserve some space.
@@ -34,23 +36,26 @@ text_align : {'left', 'center', 'right'}
 
 tight_columns : bool
     Whether to squeeze width of all column headers
+
+Changes to the file are applied while phy is running.
 """
 
-import json
+import sys
 from phy import IPlugin, connect
 from phy.cluster.supervisor import ClusterView
-from phy.utils import phy_config_dir
 from pathlib import Path
 import logging
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import (  # noqa: E402
+    column_layout, load_config, table_bridge)
+
 logger = logging.getLogger('phy')
 
 
 class ReorderColumns(IPlugin):
     # Load config
     def __init__(self):
-        filepath = Path(phy_config_dir()) / 'plugin_reordercolumns.json'
-
         # Default config
         dflts = {
             'last_columns': ['quality', 'comment'],
@@ -58,29 +63,20 @@ class ReorderColumns(IPlugin):
             'tight_columns': False,
         }
 
-        # Create config file with defaults if it does not exist
-        if not filepath.exists():
-            logger.debug("Create default config at %s.", filepath)
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(dflts, f, ensure_ascii=False, indent=4)
-
-        # Load config
-        logger.debug("Load %s for config.", filepath)
-        with open(filepath, 'r') as f:
-            try:
-                data = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning("Error decoding JSON: %s", e)
-                data = dflts
-
-        self.last_columns = data.get('last_columns', dflts['last_columns'])
-        self.text_align = data.get('text_align', dflts['text_align'])
-        self.tight_columns = data.get('tight_columns', dflts['tight_columns'])
+        self.config = load_config('plugin_reordercolumns.json', dflts)
+        self.apply_config(self.config)
 
-    def attach_to_controller(self, controller):
+    def apply_config(self, config):
+        """Update the settings from the config"""
+        self.last_columns = config['last_columns']
+        self.text_align = config['text_align']
+        self.tight_columns = config['tight_columns']
+
+    def styles(self):
+        """Return the style sheet for the current settings"""
         # Reduce width of the quality column/all columns
         spec = '' if self.tight_columns else '[data-sort=\'quality\']'
-        ClusterView._styles += """
+        return """
 
             table th""" + spec + """, td.quality {
                 max-width: 8px;
@@ -98,29 +94,44 @@ class ReorderColumns(IPlugin):
 
         """
 
-        @connect
-        def on_controller_ready(sender):
-            for col in self.last_columns:
-                if col not in controller.supervisor.columns:
-                    logger.debug("Add column %s.", col)
-                    controller.supervisor.cluster_meta.add_field(col)
-                else:
-                    controller.supervisor.columns.remove(col)
-                controller.supervisor.columns.append(col)
+    def attach_to_controller(self, controller):
+        # Style sheet of both views, replaced as a whole on config changes
+        if not getattr(ClusterView, '_reordercolumns', False):
+            _set_styles = ClusterView._set_styles
+
+            def _set_styles_with_columns(view):
+                _set_styles(view)
+                view.builder.add_header(
+                    '<style id="reordercolumns">\n%s\n</style>' %
+                    self.styles())
+
+            ClusterView._set_styles = _set_styles_with_columns
+            ClusterView._reordercolumns = True
+
+        # Move the columns once the controller is ready
+        column_layout(controller).move_to_end(self.last_columns)
 
         @connect
         def on_gui_ready(sender, gui):
-            """The similarity view requires special rearranging"""
-
-            # Add custom columns after 'similarity'
-            columns = controller.supervisor.columns.copy()
-            for col in self.last_columns:
-                columns.remove(col)
-            columns.append('similarity')
-            for col in self.last_columns:
-                columns.append(col)
-
-            # Recreating the table
-            controller.supervisor.similarity_view._reset_table(
-                columns=columns, sort=('similarity', 'desc')
-            )
+            sup = controller.supervisor
+
+            def on_config_changed(config):
+                """Apply modified config without restarting"""
+                last_columns = self.last_columns
+                self.apply_config(config)
+
+                # Replace the style sheet in both views
+                for view in (sup.cluster_view, sup.similarity_view):
+                    table_bridge(view).style('reordercolumns', self.styles())
+
+                # Recreating the tables only if needed
+                if self.last_columns != last_columns:
+                    logger.debug("Move columns %s.",
+                                 ', '.join(self.last_columns))
+                    column_layout(controller).update(sup, self.last_columns)
+
+            self.config.watch(on_config_changed)
+
+            @connect(sender=gui)
+            def on_close(sender):
+                self.config.unwatch(on_config_changed)
@@ -25,6 +25,29 @@ Select the cluster with the highest id (among non-noise clusters). This
 is useful after performing an action and losing track of the recently
 created cluster.
 
+The cluster ids are kept sorted together with a mask of noise clusters,
+and both are updated on each clustering or label change, such that
+holding the keys stays smooth with many thousands of clusters.
+
+
+Select the next unsorted cluster by priority
+--------------------------------------------
+
+Go through the unsorted clusters in a strict order of priority, one
+cluster at a time. The priority is either the number of spikes, the
+mean template amplitude or the similarity to the cluster selected when
+the queue was started (largest first). Each cluster is visited once,
+clusters that are labeled in the meantime are skipped and clusters
+created by splits or merges are queued. Once all clusters are visited,
+or with 'Restart unsorted queue', the queue starts over.
+
+Configuration:
+
+On first use, a JSON file will be created in the Phy configuration
+directory, usually {HOME}/.phy/plugin_selectionoptions.json, with the
+priority of the queue ('n_spikes', 'amplitude' or 'similarity') and the
+default radius of 'Select all within radius'.
+
 
 Select all unsorted clusters in current channel
 -----------------------------------------------
@@ -32,6 +55,14 @@ Select all unsorted clusters in current channel
 Select all yet unsorted clusters within the current channel. This is
 useful to quickly see all clusters side-by-side.
 
+On 2-D multielectrode arrays, 'Select all within radius' also selects
+the unsorted clusters on the neighbouring channels within a radius (in
+the units of the channel positions, 'radius' in the configuration file)
+of the current channel, nearest channels first. The neighbours are found
+with a KD-tree of the channel positions (see `plugin_channels`) and the
+clusters of each channel are kept in an index that is updated on each
+clustering change, so no cluster is visited that is not selected.
+
 
 Select all similar clusters of certain similarity
 -------------------------------------------------
@@ -42,32 +73,322 @@ arguments are specified. This is useful to see candidates for merging
 at a glance.
 """
 
+import heapq
+import sys
 import numpy as np
+from pathlib import Path
 from phy import IPlugin, connect
 import logging
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import load_config, timed  # noqa: E402
+from plugin_channels import channel_index  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
+def _format_ids(ids, n=10):
+    """Comma separated cluster ids, shortened for long lists"""
+    out = ', '.join(map(str, ids[:n]))
+    if len(ids) > n:
+        out += ', ... (%i clusters)' % len(ids)
+    return out
+
+
+class ClusterIndex(object):
+    """Sorted cluster ids with a mask of noise clusters"""
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.ids = None
+        self.noise = None
+
+    def _is_noise(self, cluster_ids):
+        get = self.supervisor.cluster_meta.get
+        return np.array([get('group', c) == 'noise' for c in cluster_ids],
+                        dtype=bool)
+
+    def build(self):
+        ids = np.asarray(self.supervisor.clustering.cluster_ids,
+                         dtype=np.int64)
+        self.ids = np.sort(ids)
+        self.noise = self._is_noise(self.ids.tolist())
+
+    def on_cluster(self, sender, up):
+        """Update the index after a clustering change"""
+        if self.ids is None:
+            return
+        if up.deleted:
+            keep = ~np.isin(self.ids, up.deleted)
+            self.ids, self.noise = self.ids[keep], self.noise[keep]
+        if up.added:
+            # The supervisor has already set the labels of new clusters
+            added = np.setdiff1d(up.added, self.ids)
+            pos = np.searchsorted(self.ids, added)
+            self.ids = np.insert(self.ids, pos, added)
+            self.noise = np.insert(self.noise, pos,
+                                   self._is_noise(added.tolist()))
+
+    def on_cluster_meta(self, sender, up):
+        """Update the noise mask after a group change"""
+        if (self.ids is None or not self.ids.size or
+                up.description != 'metadata_group'):
+            return
+        changed = np.asarray(up.metadata_changed, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.ids, changed),
+                         len(self.ids) - 1)
+        found = self.ids[pos] == changed
+        self.noise[pos[found]] = self._is_noise(changed[found].tolist())
+
+    def nearest(self, start=None, direction=1):
+        """
+        Nearest non-noise cluster id after `start` in ascending (1) or
+        descending (-1) order, from the start of that order by default
+        """
+        if self.ids is None:
+            self.build()
+        if direction > 0:
+            i = 0 if start is None else np.searchsorted(self.ids, start,
+                                                        'right')
+            noise = self.noise[i:]
+        else:
+            i = len(self.ids) if start is None else np.searchsorted(
+                self.ids, start, 'left')
+            noise = self.noise[:i][::-1]
+        if not noise.size:
+            return
+        # First False
+        j = int(np.argmin(noise))
+        if noise[j]:
+            return
+        return int(self.ids[i + j] if direction > 0 else self.ids[i - 1 - j])
+
+
+class ChannelClusters(object):
+    """Cluster ids by peak channel"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.clusters = None  # Channel id: set of cluster ids
+        self.channels = dict()  # Cluster id: channel id
+
+    def _add(self, cluster_ids):
+        for c in map(int, cluster_ids):
+            ch = int(self.controller.get_best_channel(c))
+            self.channels[c] = ch
+            self.clusters.setdefault(ch, set()).add(c)
+
+    def build(self):
+        self.clusters = dict()
+        self.channels = dict()
+        self._add(self.controller.supervisor.clustering.cluster_ids)
+
+    def on_cluster(self, sender, up):
+        """Update the index after a clustering change"""
+        if self.clusters is None:
+            return
+        for c in up.deleted:
+            ch = self.channels.pop(c, None)
+            if ch is not None:
+                self.clusters[ch].discard(c)
+        self._add(up.added)
+
+    def channel(self, cluster_id):
+        """Peak channel of a cluster"""
+        if self.clusters is None:
+            self.build()
+        return self.channels[cluster_id]
+
+    def get(self, channel_ids):
+        """Cluster ids on the channels, in the order of the channels"""
+        if self.clusters is None:
+            self.build()
+        return [c for ch in channel_ids
+                for c in sorted(self.clusters.get(int(ch), ()))]
+
+
+class UnsortedQueue(object):
+    """Heap of the unsorted clusters by priority, with lazy deletion"""
+
+    keys = ('n_spikes', 'amplitude', 'similarity')
+
+    def __init__(self, controller, key='n_spikes'):
+        self.controller = controller
+        self.key = key
+        self.anchor = None  # Reference cluster of the similarity
+        self.heap = None
+        self.priority = dict()  # Queued clusters
+        self.visited = set()
+
+    @property
+    def supervisor(self):
+        return self.controller.supervisor
+
+    def _is_unsorted(self, cluster_id):
+        group = self.supervisor.cluster_meta.get('group', cluster_id)
+        return group in (None, 'unsorted')
+
+    def _priorities(self, cluster_ids):
+        """Priorities of clusters, lower first"""
+        sup = self.supervisor
+        if self.key == 'similarity':
+            similar = {s['id']: float(s['similarity'])
+                       for s in sup._get_similar_clusters(None, self.anchor)}
+            return [-similar[c] if c in similar else None
+                    for c in cluster_ids]
+        spc = sup.clustering.spikes_per_cluster
+        if self.key == 'amplitude':
+            amplitudes = self.controller.model.amplitudes
+            return [-float(np.mean(amplitudes[spc[c]])) for c in cluster_ids]
+        return [-len(spc[c]) for c in cluster_ids]
+
+    def _all_priorities(self, cluster_ids):
+        """Priorities of all clusters in one pass over the spikes"""
+        if self.key == 'similarity':
+            return self._priorities(cluster_ids)
+        spike_clusters = self.supervisor.clustering.spike_clusters
+        counts = np.bincount(spike_clusters)
+        if self.key == 'amplitude':
+            amplitudes = np.bincount(spike_clusters,
+                                     weights=self.controller.model.amplitudes)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return (-amplitudes[cluster_ids] /
+                        counts[cluster_ids]).tolist()
+        return (-counts[cluster_ids]).tolist()
+
+    def build(self):
+        """Queue all unsorted clusters"""
+        if self.key not in self.keys:
+            logger.warn("Unknown queue priority %s, use one of %s.",
+                        self.key, ', '.join(self.keys))
+            self.key = self.keys[0]
+        if self.key == 'similarity':
+            selected = self.supervisor.selected_clusters
+            self.anchor = selected[0] if selected else None
+            if self.anchor is None:
+                logger.warn("Select a cluster to order by similarity.")
+                self.heap = None
+                return
+        groups = self.supervisor.get_labels('group')
+        cluster_ids = [c for c, g in groups.items()
+                       if g in (None, 'unsorted') and c != self.anchor]
+        self.priority = {c: p for c, p in
+                         zip(cluster_ids, self._all_priorities(cluster_ids))
+                         if p is not None}
+        self.heap = [(p, c) for c, p in self.priority.items()]
+        heapq.heapify(self.heap)
+        self.visited = set()
+        logger.debug("Queued %i unsorted clusters by %s.",
+                     len(self.heap), self.key)
+
+    def _push(self, cluster_ids):
+        cluster_ids = [c for c in cluster_ids if c not in self.visited and
+                       c != self.anchor and self._is_unsorted(c)]
+        for c, p in zip(cluster_ids, self._priorities(cluster_ids)):
+            if p is not None:
+                self.priority[c] = p
+                heapq.heappush(self.heap, (p, c))
+
+    def on_cluster(self, sender, up):
+        """Drop deleted and queue new clusters"""
+        if self.heap is None:
+            return
+        for c in up.deleted:
+            self.priority.pop(c, None)
+        if self.anchor in up.deleted:
+            # The reference of the similarity is gone
+            self.heap = None
+            return
+        self._push(up.added)
+        # Remove the dropped entries once they dominate the heap
+        if len(self.heap) > 2 * len(self.priority) + 64:
+            self.heap = [(p, c) for c, p in self.priority.items()]
+            heapq.heapify(self.heap)
+
+    def on_cluster_meta(self, sender, up):
+        """Drop clusters that were labeled and queue unlabeled ones"""
+        if self.heap is None or up.description != 'metadata_group':
+            return
+        existing = self.supervisor.clustering.spikes_per_cluster
+        changed = [c for c in up.metadata_changed if c in existing]
+        for c in changed:
+            self.priority.pop(c, None)
+        self._push(changed)
+
+    def _pop(self):
+        while self.heap:
+            p, c = heapq.heappop(self.heap)
+            if self.priority.get(c) == p:
+                del self.priority[c]
+                self.visited.add(c)
+                return c
+
+    def next(self):
+        """Pop the next unsorted cluster, start over when all were visited"""
+        if self.heap is None:
+            self.build()
+        cluster_id = self._pop()
+        if cluster_id is None and self.visited:
+            self.build()
+            cluster_id = self._pop()
+        return cluster_id
+
+
 class SelectionOptions(IPlugin):
     # Safety measure of maximum resulting selections
     max_selections = 50
 
+    def __init__(self):
+        # Default config
+        dflts = dict()
+        dflts['queue_key'] = 'n_spikes'  # 'amplitude' or 'similarity'
+        dflts['radius'] = 100.  # Default of 'Select all within radius'
+
+        self.config = load_config('plugin_selectionoptions.json', dflts)
+
     def attach_to_controller(self, controller):
         @connect
         def on_gui_ready(sender, gui):
+            sup = controller.supervisor
+            index = ClusterIndex(sup)
+            connect(index.on_cluster, event='cluster', sender=sup.clustering)
+            connect(index.on_cluster_meta, event='cluster',
+                    sender=sup.cluster_meta)
+
+            channel_clusters = ChannelClusters(controller)
+            connect(channel_clusters.on_cluster, event='cluster',
+                    sender=sup.clustering)
+
+            queue = UnsortedQueue(controller, self.config['queue_key'])
+            connect(queue.on_cluster, event='cluster', sender=sup.clustering)
+            connect(queue.on_cluster_meta, event='cluster',
+                    sender=sup.cluster_meta)
+
+            def on_config_changed(config):
+                if config['queue_key'] != queue.key:
+                    queue.key = config['queue_key']
+                    queue.heap = None
+
+            self.config.watch(on_config_changed)
+
+            @connect(sender=gui)
+            def on_close(sender):
+                self.config.unwatch(on_config_changed)
+
             @controller.supervisor.actions.add(shortcut='alt+y',
                                                name='Reverse selection',
                                                menu='Sele&ct')
+            @timed('Reverse selection')
             def reverseselection():
                 """Reverse the current cluster selection order"""
                 sup = controller.supervisor
+                selected = sup.selected
 
-                if len(sup.selected) < 2:
+                if len(selected) < 2:
                     logger.debug('Not enough clusters selected.')
                     return
 
-                if (len(sup.selected) == 2
+                if (len(selected) == 2
                         and len(sup.selected_clusters) == 1
                         and len(sup.selected_similar) == 1):
                     # Switch cluster and similarity selection
@@ -75,11 +396,11 @@ class SelectionOptions(IPlugin):
                              sup.selected_clusters, None)
                 else:
                     # Move the selection to the cluster view only
-                    state = (sup.selected[::-1], None, None, None)
+                    state = (selected[::-1], None, None, None)
 
                 logger.info('Reverse selection of clusters from %s to %s.',
-                            ', '.join(map(str, sup.selected)),
-                            ', '.join(map(str, sup.selected[::-1])))
+                            _format_ids(selected),
+                            _format_ids(selected[::-1]))
 
                 # Let the TaskLogger take care of making the selections
                 sup.task_logger._select_state(state)
@@ -87,30 +408,15 @@ class SelectionOptions(IPlugin):
 
             def selectnearest(start=None, direction=1):
                 """Select the nearest non-noise cluster"""
-                ids = controller.supervisor.clustering.cluster_ids
-                if isinstance(ids, np.ndarray):
-                    ids = ids.tolist()
-                assert len(ids) > 0
-
-                # Arrange cluster id list for traversing
-                ids = sorted(ids)[::direction]
-                if start in ids:
-                    ids = ids[ids.index(start)+1:]
-
-                # Traverse in desired direction
-                groups = controller.supervisor.get_labels('group')
-                for nearest in ids:
-                    if groups[nearest] != 'noise':
-                        break
-                else:
+                nearest = index.nearest(start, direction)
+                if nearest is None:
                     return
 
                 if controller.supervisor.selected_clusters == [nearest]:
                     return
 
                 logger.info('Change selection from %s to %i.',
-                            ', '.join(map(str,
-                                          controller.supervisor.selected)),
+                            _format_ids(controller.supervisor.selected),
                             nearest)
                 controller.supervisor.select(nearest)
 
@@ -118,6 +424,7 @@ class SelectionOptions(IPlugin):
                                                name='Select next higher '
                                                     'cluster',
                                                menu='Sele&ct')
+            @timed('Select next higher cluster')
             def selectpreviousid():
                 """Select the next higher (non-noise) cluster id"""
                 sup = controller.supervisor
@@ -134,6 +441,7 @@ class SelectionOptions(IPlugin):
                                                name='Select next lower '
                                                     'cluster',
                                                menu='Sele&ct')
+            @timed('Select next lower cluster')
             def selectnextid():
                 """Select the next lower (non-noise) cluster id"""
                 sup = controller.supervisor
@@ -149,15 +457,39 @@ class SelectionOptions(IPlugin):
             @controller.supervisor.actions.add(shortcut='shift+end',
                                                name='Select newest cluster',
                                                menu='Sele&ct')
+            @timed('Select newest cluster')
             def selectnewest():
                 """Select the newest (non noise) cluster"""
                 selectnearest(direction=-1)
 
-            @controller.supervisor.actions.add(shortcut='ctrl+shift+a',
-                                               name='Select all in channel',
+            @controller.supervisor.actions.add(shortcut='shift+home',
+                                               name='Select next unsorted '
+                                                    'cluster',
                                                menu='Sele&ct')
-            def selectallinchannel():
-                """Select all unsorted clusters in current channel"""
+            @timed('Select next unsorted cluster')
+            def selectnextunsorted():
+                """Select the next unsorted cluster by priority"""
+                cluster_id = queue.next()
+                if cluster_id is None:
+                    logger.info('No unsorted clusters left.')
+                    return
+
+                logger.info('Select unsorted cluster %i (%i left by %s).',
+                            cluster_id, len(queue.priority), queue.key)
+                controller.supervisor.select(cluster_id)
+
+            @controller.supervisor.actions.add(name='Restart unsorted queue',
+                                               menu='Sele&ct')
+            def restartqueue():
+                """
+                Queue all unsorted clusters again, by similarity to the
+                selected cluster if configured
+                """
+                queue.key = self.config['queue_key']
+                queue.build()
+
+            def selectinchannel(radius=0):
+                """Select all unsorted clusters near the current channel"""
                 sup = controller.supervisor
 
                 # Safety check in case there was no prior selection
@@ -166,20 +498,25 @@ class SelectionOptions(IPlugin):
                     return
 
                 # Obtain the currently selected channel
-                channel = set(sup.get_cluster_info(c)['ch']
+                channel = set(channel_clusters.channel(c)
                               for c in sup.selected_clusters)
                 if len(channel) != 1:
                     logger.warn('Error: Selection exceeds one channel')
                     return
                 channel = channel.pop()
 
-                # Get all cluster IDs belonging to that channel
-                all_clusters = sup.cluster_info
-                sel = [c['id'] for c in all_clusters if c['ch'] == channel and
-                       c['group'] not in ('noise', 'good')]
+                # Get all cluster IDs belonging to the nearest channels
+                channels = channel_index(controller).within(
+                    channel, radius)[0] if radius > 0 else [channel]
+                get = sup.cluster_meta.get
+                sel = [c for c in channel_clusters.get(channels)
+                       if get('group', c) not in ('noise', 'good')]
 
+                where = ('channel %s' % channel if radius <= 0 else
+                         '%i channels within %g of channel %s' % (
+                             len(channels), radius, channel))
                 if len(sel) < 1:
-                    logger.info('Channel %s fully sorted.', channel)
+                    logger.info('%s fully sorted.', where.capitalize())
                     return
 
                 # Safety measure
@@ -191,17 +528,45 @@ class SelectionOptions(IPlugin):
                 else:
                     capped = 'all'
 
-                logger.info('Select %s unsorted clusters in channel %s',
-                            capped, channel)
+                logger.info('Select %s unsorted clusters in %s', capped,
+                            where)
 
                 sup.select(sel)
 
+            @controller.supervisor.actions.add(shortcut='ctrl+shift+a',
+                                               name='Select all in channel',
+                                               menu='Sele&ct')
+            @timed('Select all in channel')
+            def selectallinchannel():
+                """Select all unsorted clusters in current channel"""
+                selectinchannel()
+
+            @controller.supervisor.actions.add(name='Select all within '
+                                                    'radius',
+                                               alias='selrad',
+                                               menu='Sele&ct',
+                                               prompt=True,
+                                               prompt_default=lambda:
+                                               self.config['radius'])
+            @timed('Select all within radius')
+            def selectallinradius(radius):
+                """
+                Select all unsorted clusters on the channels within a
+                radius of the current channel
+                """
+                if not isinstance(radius, (int, float)) or radius < 0:
+                    logger.warn('Error: Invalid input. A positive number '
+                                'expected.')
+                    return
+                selectinchannel(radius)
+
             @controller.supervisor.actions.add(shortcut='ctrl+shift+j',
                                                name='Select similar clusters',
                                                alias='selsim',
                                                menu='Sele&ct',
                                                prompt=True,
                                                prompt_default=lambda: 0.8)
+            @timed('Select similar clusters')
             def Selected_similar_clusters(low, high=1.01):
                 """
                 Select all similar clusters down to a certain
@@ -1,19 +1,86 @@
-"""Remove spikes with low interspike interval"""
+"""
+Remove spikes with low interspike interval
 
+'Visualize short ISI' splits the spikes with a short interspike interval
+from the first selected cluster, 'Visualize short ISI per cluster' from
+each selected cluster, all in a single split.
+
+'Preview short ISI' does not change the clustering. It marks the spikes
+of all selected clusters in the amplitude view instead: spikes within
+the refractory period of another spike of their cluster (red) and
+spikes within 0.5 ms of a spike of another selected cluster (yellow),
+e.g. double detections of the same spike. The trace view can then step
+through the marked spikes. The marks are cleared when the selection
+changes.
+"""
+
+import sys
+from pathlib import Path
 from phy import IPlugin, connect
+from phy.cluster.views import AmplitudeView, TraceView
+from phy.plot.visuals import ScatterVisual
 import numpy as np
 import logging
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import count, timed  # noqa: E402
+from plugin_metrics import coincident_spikes, short_isi  # noqa: E402
+from plugin_clustering import combine_splits  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
 class SplitShortISI(IPlugin):
+    # Refractory period and window of coincident spikes in s
+    refractory = .0015
+    coincidence_window = .0005
+    # Marker colors of short ISI and coincident spikes
+    isi_color = (1, 0, 0, 1)
+    coincident_color = (1, 1, 0, 1)
+    marker_size = 12.
+
+    def __init__(self):
+        self.visual = None  # Overlay in the amplitude view
+        self.marked = np.zeros(0)  # Times of the marked spikes
+
+    def preview(self, controller, cluster_ids, name='template'):
+        """
+        Find short ISI and coincident spikes in the selected clusters
+
+        Returns
+        -------
+
+        bunchs : list
+            Amplitudes and spike times as in the amplitude view per
+            cluster
+        times : list
+            Spike times per cluster
+        isi : list
+            Masks of the short ISI spikes per cluster
+        coincident : list
+            Masks of the coincident spikes per cluster
+        """
+        bunchs = controller._amplitude_getter(cluster_ids, name=name,
+                                              load_all=True)
+        times = [controller.model.spike_times[b.spike_ids] for b in bunchs]
+        count(spikes=sum(map(len, times)),
+              nbytes=sum(t.nbytes for t in times))
+        isi = [short_isi(t, self.refractory) for t in times]
+
+        # Coincident spikes across all clusters at once
+        labels = np.repeat(np.arange(len(times)), list(map(len, times)))
+        mask = coincident_spikes(np.concatenate(times), labels,
+                                 self.coincidence_window)
+        coincident = np.split(mask, np.cumsum(list(map(len, times)))[:-1])
+        return bunchs, times, isi, coincident
+
     def attach_to_controller(self, controller):
         @connect
         def on_gui_ready(sender, gui):
             @controller.supervisor.actions.add(shortcut='alt+i',
                                                name='Visualize short ISI',
                                                alias='isi')
+            @timed('Visualize short ISI')
             def VisualizeShortISI():
                 """
                 Split all spikes with an interspike interval of less
@@ -21,7 +88,8 @@ class SplitShortISI(IPlugin):
                 THIS IS FOR VISUALIZATION ONLY, it will show you where
                 potential noise spikes may be located. Re-merge the
                 clusters again afterwards and cut the cluster with
-                another method!
+                another method! See 'Preview short ISI' to only mark
+                the spikes.
                 """
 
                 logger.info('Detecting spikes with ISI less than 1.5 ms')
@@ -42,6 +110,7 @@ class SplitShortISI(IPlugin):
                 # NOTE: we only consider the first selected cluster
                 spike_ids = bunchs[0].spike_ids
                 spike_times = controller.model.spike_times[spike_ids]
+                count(spikes=len(spike_ids), nbytes=spike_times.nbytes)
                 dspike_times = np.diff(spike_times)
 
                 labels = np.ones(len(dspike_times), 'int64')
@@ -59,3 +128,121 @@ class SplitShortISI(IPlugin):
                 controller.supervisor.actions.split(spike_ids, labels)
                 num = np.sum(np.asarray(labels) == 2)
                 logger.info('Removed %i spikes from %i.', num, cluster_ids[0])
+
+            @controller.supervisor.actions.add(name='Visualize short ISI per '
+                                                    'cluster',
+                                               alias='isiall')
+            @timed('Visualize short ISI per cluster')
+            def VisualizeShortISIPerCluster():
+                """
+                Split the spikes with an interspike interval of less
+                than 1.5 ms of each selected cluster into a separate
+                cluster, as 'Visualize short ISI' does for the first
+                """
+                cluster_ids = controller.supervisor.selected
+                bunchs = controller._amplitude_getter(cluster_ids,
+                                                      name='template',
+                                                      load_all=True)
+                spike_ids = [b.spike_ids for b in bunchs]
+                labels = []
+                for ids in spike_ids:
+                    short = np.diff(controller.model.spike_times[ids]) < .0015
+                    labels.append(np.append(np.where(short, 2, 1), 1))
+                count(spikes=sum(map(len, spike_ids)),
+                      nbytes=sum(ids.nbytes for ids in spike_ids))
+                num = [np.sum(lab == 2) for lab in labels]
+
+                spike_ids, labels = combine_splits(spike_ids, labels)
+                if not spike_ids.size:
+                    logger.info('No spikes with short ISI.')
+                    return
+                controller.supervisor.actions.split(spike_ids, labels)
+                logger.info('Removed %i spikes from %i clusters.', sum(num),
+                            np.count_nonzero(num))
+
+            @controller.supervisor.actions.add(shortcut='shift+alt+i',
+                                               name='Preview short ISI',
+                                               alias='isip')
+            @timed('Preview short ISI')
+            def PreviewShortISI():
+                """
+                Mark short ISI spikes and spikes coinciding with another
+                selected cluster in the amplitude view, without changing
+                the clustering
+                """
+                cluster_ids = controller.supervisor.selected
+                if not cluster_ids:
+                    logger.debug('No clusters selected.')
+                    return
+
+                # Raw amplitudes of all spikes would be read from the
+                # raw data, mark the template amplitudes instead
+                view = gui.get_view(AmplitudeView)
+                name = getattr(view, 'amplitudes_type', 'template')
+                if name not in ('template', 'feature'):
+                    logger.info('Switch the amplitude view to template '
+                                'amplitudes to see the marked spikes.')
+                    name, view = 'template', None
+                bunchs, times, isi, coincident = self.preview(
+                    controller, cluster_ids, name)
+
+                for cluster_id, i, c in zip(cluster_ids, isi, coincident):
+                    logger.info('Cluster %i: %i short ISI and %i coincident '
+                                'spikes.', cluster_id, i.sum(), c.sum())
+                self.marked = np.unique(np.concatenate(
+                    [t[i | c] for t, i, c in zip(times, isi, coincident)]))
+
+                if view is None or self.visual is None:
+                    return
+                self.visual.reset_batch()
+                for b, i, c in zip(bunchs, isi, coincident):
+                    # Coincident spikes on top
+                    for mask, color in ((i & ~c, self.isi_color),
+                                        (c, self.coincident_color)):
+                        if mask.any():
+                            self.visual.add_batch_data(
+                                x=b.spike_times[mask], y=b.amplitudes[mask],
+                                color=color, size=self.marker_size,
+                                data_bounds=view.data_bounds)
+                view.canvas.update_visual(self.visual)
+                self.visual.show()
+                view.canvas.update()
+
+            @connect(sender=controller.supervisor)
+            def on_select(sender, cluster_ids, **kwargs):
+                self.marked = np.zeros(0)
+                if self.visual is not None:
+                    self.visual.hide()
+
+        @connect
+        def on_view_attached(view, gui):
+            if isinstance(view, AmplitudeView):
+                self.visual = ScatterVisual(marker='ring')
+                view.canvas.add_visual(self.visual)
+                self.visual.hide()
+
+            elif isinstance(view, TraceView):
+                def _jump_to_marked(delta=+1):
+                    if not self.marked.size:
+                        logger.info('Preview short ISI first.')
+                        return
+                    # The view centers on full samples
+                    time = view.time + delta / controller.model.sample_rate
+                    ind = np.searchsorted(self.marked, time)
+                    if delta < 0:
+                        ind -= 1
+                    view.go_to(self.marked[ind % self.marked.size])
+
+                @view.actions.add(name='Jump to next marked spike')
+                def jump_to_next_marked():
+                    """
+                    Go to the next spike marked by 'Preview short ISI'.
+                    """
+                    _jump_to_marked(+1)
+
+                @view.actions.add(name='Jump to previous marked spike')
+                def jump_to_prev_marked():
+                    """
+                    Go to the previous spike marked by 'Preview short ISI'.
+                    """
+                    _jump_to_marked(-1)
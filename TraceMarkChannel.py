@@ -2,11 +2,16 @@
 Mark selected channels in trace view
 """
 
+import sys
 import numpy as np
+from pathlib import Path
 from phy.cluster.views import TraceView
 from phy import IPlugin, connect
 from phy.utils.color import selected_cluster_color
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import timed  # noqa: E402
+
 
 class TraceMarkChannel(IPlugin):
     def attach_to_controller(self, controller):
@@ -36,6 +41,7 @@ class TraceMarkChannel(IPlugin):
                 view._plot_labels = _plot_labels
 
                 @connect(sender=controller.supervisor)
+                @timed('Trace mark channel')
                 def on_select(sender, cluster_ids=None, **kwargs):
                     if not cluster_ids:
                         view.ch = []
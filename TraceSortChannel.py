@@ -1,20 +1,63 @@
 """
 Sort the channels in trace view
+
+By default the traces are ordered by channel id. On 2-D multielectrode
+arrays they can instead be ordered along a curve over the electrode
+grid, such that neighbouring electrodes, on which a unit usually shows
+up together, are mostly shown next to each other (see
+`plugin_channels`).
+
+Configuration:
+
+On first use, a JSON file will be created in the Phy configuration
+directory, usually {HOME}/.phy/plugin_tracesortchannel.json, with the
+order ('channel' or 'curve'). Changes to the file are applied while phy
+is running.
 """
 
+import sys
 import numpy as np
+from pathlib import Path
 from phy.cluster.views import TraceView
 from phy import IPlugin, connect
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import load_config  # noqa: E402
+from plugin_channels import channel_index  # noqa: E402
+
+logger = logging.getLogger('phy')
 
 
 class TraceSortChannel(IPlugin):
+    orders = ('channel', 'curve')
+
+    def __init__(self):
+        # Default config
+        dflts = dict()
+        dflts['order'] = 'channel'  # Or 'curve' along the electrode grid
+
+        self.config = load_config('plugin_tracesortchannel.json', dflts)
+
+    def ranks(self, controller, n_channels):
+        """Position of each channel in the trace view"""
+        order = self.config['order']
+        if order not in self.orders:
+            logger.warn("Unknown channel order %s, use one of %s.",
+                        order, ', '.join(self.orders))
+        if order != 'curve':
+            return np.arange(n_channels)
+        ranks = np.empty(n_channels, dtype=np.int64)
+        ranks[channel_index(controller).order] = np.arange(n_channels)
+        return ranks
+
     def attach_to_controller(self, controller):
         @connect
         def on_view_attached(view, gui):
             if isinstance(view, TraceView):
                 # Update channel order
-                idx = np.argsort(view.channel_y_ranks)
-                view.channel_y_ranks = view.channel_y_ranks[idx]
+                view.channel_y_ranks = self.ranks(controller,
+                                                  len(view.channel_y_ranks))
 
                 # Update drawing of traces
                 _traces = view.traces  # Backup of original function
@@ -28,3 +71,14 @@ class TraceSortChannel(IPlugin):
                         wv['channel_ids'] = wv['channel_ids'][sort_i]
                     return tr
                 view.traces = _get_traces
+
+                def on_config_changed(config):
+                    view.channel_y_ranks = self.ranks(
+                        controller, len(view.channel_y_ranks))
+                    view.plot()
+
+                self.config.watch(on_config_changed)
+
+                @connect(sender=gui)
+                def on_close(sender):
+                    self.config.unwatch(on_config_changed)
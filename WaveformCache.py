@@ -0,0 +1,178 @@
+"""
+Cache the waveforms of all clusters on disk
+
+A background thread extracts the waveforms shown in the waveform view
+(the same number of spikes per cluster, on the best channels of the
+cluster, see `WaveformThr`) for all clusters over the session and
+appends them to a cache in the phy cache directory of the data. The
+waveform view then reads them from the cache instead of the raw data,
+also when clusters are selected again after an undo. Selected clusters
+and new clusters from merges and splits are cached first.
+
+The cache is kept between sessions and checked against the current
+spikes of each cluster, see `plugin_waveforms`. Changing the number of
+waveforms or the channels of a cluster falls back to the raw data until
+the cluster is cached again.
+
+Waveforms already exported by phy for compressed raw data are not
+cached again.
+
+Configuration:
+
+On first use, a JSON file will be created in the Phy configuration
+directory, usually {HOME}/.phy/plugin_waveformcache.json, with the
+maximum size of the cache in MB.
+"""
+
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+from phy import IPlugin, connect
+from phylib.utils import Bunch
+import numpy as np
+import logging
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import count, load_config, timed  # noqa: E402
+from plugin_waveforms import WaveformStore, spikes_key  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class WaveformCache(IPlugin):
+    # Write the index after this many new clusters
+    save_interval = 100
+    # Pause in s between clusters to leave the GUI responsive
+    pause = .01
+
+    def __init__(self):
+        # Default config
+        dflts = dict()
+        dflts['max_size'] = 4096  # Stop caching above this size in MB
+
+        self.config = load_config('plugin_waveformcache.json', dflts)
+        self.store = None
+        self._queue = queue.PriorityQueue()  # (priority, seq, cluster id)
+        self._seq = 0
+        self._thread = None
+
+    def push(self, cluster_ids, priority=1):
+        """Cache clusters, lower priorities first"""
+        for cluster_id in cluster_ids:
+            self._seq += 1
+            self._queue.put((priority, self._seq, cluster_id))
+
+    def fill(self, controller, cluster_id):
+        """Cache the waveforms of a cluster, return whether they were new"""
+        spike_ids = controller.supervisor.clustering.spikes_per_cluster.get(
+            cluster_id)
+        if spike_ids is None:  # Merged or split since
+            return False
+        key = spikes_key(spike_ids)
+        n = controller.n_spikes_waveforms
+        if self.store.get(cluster_id, key, n) is not None:
+            return False
+        spike_ids = controller.selector(n, [cluster_id], subset_chunks=True)
+        channel_ids = controller.get_best_channels(cluster_id)
+        data = controller.model.get_waveforms(spike_ids, channel_ids)
+        if data is None:
+            return False
+        self.store.add(cluster_id, key, n, spike_ids, channel_ids, data)
+        return True
+
+    def load(self, controller, cluster_id):
+        """
+        Return the waveforms of a cluster as the controller would, None if
+        not cached
+        """
+        model = controller.model
+        spike_ids = controller.supervisor.clustering.spikes_per_cluster[
+            cluster_id]
+        entry = self.store.get(cluster_id, spikes_key(spike_ids),
+                               controller.n_spikes_waveforms)
+        if entry is None:
+            return None
+        channel_ids = controller.get_best_channels(cluster_id)
+        if not np.array_equal(channel_ids, entry['channel_ids']):
+            return None
+        data = self.store.read(entry)
+        count(spikes=len(data), nbytes=data.nbytes)
+        data = data - np.median(data, axis=1)[:, np.newaxis, :]
+        data = controller.raw_data_filter.apply(data, axis=1)
+        return Bunch(data=data, channel_ids=channel_ids,
+                     channel_labels=controller._get_channel_labels(
+                         channel_ids),
+                     channel_positions=model.channel_positions[channel_ids])
+
+    def _run(self, controller):
+        max_size = self.config['max_size'] * 2 ** 20
+        n_new = 0
+        while True:
+            _, _, cluster_id = self._queue.get()
+            if cluster_id is None:
+                break
+            if self.store.size > max_size:
+                continue
+            try:
+                n_new += self.fill(controller, cluster_id)
+            except (KeyError, IndexError) as e:  # Changed while caching
+                logger.debug("Skip caching cluster %i: %s", cluster_id, e)
+            except OSError as e:
+                logger.warning("Error caching waveforms: %s", e)
+                break
+            if n_new >= self.save_interval or (
+                    n_new and self._queue.empty()):
+                self.store.save()
+                n_new = 0
+            time.sleep(self.pause)
+        self.store.save()
+
+    def close(self):
+        """Stop caching and write the index"""
+        if self._thread is not None:
+            self._queue.put((-1, 0, None))
+            self._thread.join()
+            self._thread = None
+
+    def attach_to_controller(self, controller):
+        model = controller.model
+        if (getattr(model, 'traces', None) is None or
+                getattr(model, 'spike_waveforms', None) is not None):
+            logger.debug("No raw data waveforms to cache.")
+            return
+
+        self.store = WaveformStore(controller.cache_dir / 'plugin_waveforms')
+        get_waveforms = controller._get_waveforms
+
+        @timed('Load waveforms')
+        def _get_waveforms(cluster_id):
+            out = self.load(controller, cluster_id)
+            return out if out is not None else get_waveforms(cluster_id)
+        controller._get_waveforms = _get_waveforms
+
+        @connect
+        def on_gui_ready(sender, gui):
+            sup = controller.supervisor
+            groups = sup.get_labels('group')
+            self.push(c for c in sup.clustering.cluster_ids
+                      if groups.get(c) != 'noise')
+            self.push((c for c in sup.clustering.cluster_ids
+                       if groups.get(c) == 'noise'), priority=2)
+            self._thread = threading.Thread(target=self._run,
+                                            args=(controller,), daemon=True)
+            self._thread.start()
+
+            def on_clustering(sender, up):
+                self.push(up.added, priority=0)
+
+            connect(on_clustering, event='cluster', sender=sup.clustering)
+
+            @connect(sender=sup)
+            def on_select(sender, cluster_ids, **kwargs):
+                self.push(cluster_ids, priority=0)
+
+            @connect(sender=gui)
+            def on_close(sender):
+                self.close()
@@ -32,27 +32,31 @@ Configuration:
 
 On first use, a JSON file will be created in the Phy configuration
 directory, usually {HOME}/.phy/plugin_writecomments.json. The delimiter
-and the short hand notation pairs can be adjusted there.
+and the short hand notation pairs can be adjusted there. Changes to the
+file are applied while phy is running.
 
 Note:
 
 Only single-character, lower-case short hand notations are supported.
+The comments are read from the shared cluster annotations (see
+`plugin_annotations`), in which the short hand notations are bits.
 """
 
-import json
+import sys
 from phy import IPlugin, connect
-from phy.utils import phy_config_dir
 from pathlib import Path
 import logging
 
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_utils import load_config, timed  # noqa: E402
+from plugin_annotations import annotations  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
 class WriteComments(IPlugin):
     # Load config
     def __init__(self):
-        filepath = Path(phy_config_dir()) / 'plugin_writecomments.json'
-
         # Default config
         dflts = dict()
         dflts['delimiter'] = '_'  # Comment delimiter
@@ -63,93 +67,67 @@ class WriteComments(IPlugin):
             'n': 'noisefloor',
         }
 
-        # Create config file with defaults if it does not exist
-        if not filepath.exists():
-            logger.debug("Create default config at %s.", filepath)
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(dflts, f, ensure_ascii=False, indent=4)
-
-        # Load config
-        logger.debug("Load %s for config.", filepath)
-        with open(filepath, 'r') as f:
-            try:
-                data = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning("Error decoding JSON: %s", e)
-                data = dflts
+        self.config = load_config('plugin_writecomments.json', dflts)
+        self.store = None  # Cluster annotations
+        self.apply_config(self.config)
 
-        self.delimiter = data.get('delimiter', dflts['delimiter'])
-        self.pairs = data.get('pairs', dflts['pairs'])
+    def apply_config(self, config):
+        """Update the delimiter and short hand notations from the config"""
+        self.delimiter = config['delimiter']
 
         # Allow lower case keys only
-        for k in self.pairs.keys():
-            if not k.islower():
-                self.pairs[k.lower()] = self.pairs[k]
-                del self.pairs[k]
-
+        self.pairs = {k.lower(): v for k, v in config['pairs'].items()}
         self.pairs_inv = {v: k for k, v in self.pairs.items()}
 
         logger.debug("Available short hand notations are %s.",
                      ', '.join(self.pairs.keys()))
+        if self.store is not None:
+            self.store.configure(self.delimiter, self.pairs.values())
 
-    def load_comments(self, controller):
-        """Load selected comments a list of as sets"""
-        cluster_ids = controller.supervisor.selected
-        if 'comment' not in controller.supervisor.fields:
-            logger.debug('Comment field does not exist. Return empty list.')
-            return []
-        allcmt = controller.supervisor.get_labels('comment')
-
-        # Find shared comments (ignoring empty comments)
-        comments = []
-        for cid in cluster_ids:
-            cmt = allcmt[cid].split(self.delimiter) if allcmt[cid] else []
-            cmt = set(cmt).difference('')
-            comments.append(cmt)
-        return comments
-
-    def split_comments(self, comments):
-        """Split list of sets into notations and custom comments"""
-        pair_set = set(self.pairs.values())
-        chars = [c.intersection(pair_set) for c in comments]
-        comments = [c.difference(pair_set) for c in comments]
-        return chars, comments
+    def annotations(self, controller):
+        """Return the cluster annotations with the current notations"""
+        if self.store is None:
+            self.store = annotations(controller)
+            self.store.configure(self.delimiter, self.pairs.values())
+        return self.store
 
     def attach_to_controller(self, controller):
         def get_comments():
             """Fetch common comments among selected clusters"""
             logger.debug('Retrieving comments from selected clusters.')
-            comments = self.load_comments(controller)
-            logger.debug('Splitting comments.')
-            chars, comments = self.split_comments(comments)
-
-            # Keep non-empty comments only
-            chars = [p for p in chars if p]
-            # comments = [c for c in comments if c]  # Comments not shared
-
-            # Keep shared comments only
-            if len(chars) > 0:
-                chars = chars[0].intersection(*chars)
-            if len(comments) > 0:
-                comments = list(comments[0].intersection(*comments))
+            store = self.annotations(controller)
+            cluster_ids = controller.supervisor.selected
 
-            logger.debug('Number of comments found: %i, %i (chars, comments).',
-                         len(chars), len(comments))
+            # Shared short hand notations (ignoring clusters without)
+            chars = [c for c in cluster_ids if store.comment(c)[0]]
+            bits, _ = store.shared(chars)
+            # Shared custom comments
+            _, comments = store.shared(cluster_ids)
 
             # Collapse characters without delimiter
-            chars = ''.join(self.pairs_inv[c] for c in chars)
+            chars = ''.join(self.pairs_inv[t] for t in store.tag_names
+                            if bits & store.tag_bits[t])
             chars = [chars] if chars else []
 
             # Join the comments back together
-            ret = self.delimiter.join(chars + comments)
+            ret = self.delimiter.join(chars + [store.tokens[i]
+                                               for i in comments])
             logger.debug('Created prompt default as \'%s\'.', ret)
             return ret
 
         @connect
         def on_gui_ready(sender, gui):
+            # Apply modified config without restarting
+            self.config.watch(self.apply_config)
+
+            @connect(sender=gui)
+            def on_close(sender):
+                self.config.unwatch(self.apply_config)
+
             @controller.supervisor.actions.add(name='Add comment', alias='com',
                                                shortcut='alt+w', prompt=True,
                                                prompt_default=get_comments)
+            @timed('Add comment')
             def Add_comment(*userinput):
                 """
                 Add comments to selected clusters, prepend with '~' to
@@ -180,47 +158,43 @@ class WriteComments(IPlugin):
                                 ', '.join(map(str, cluster_ids)))
                     return
 
-                # Otherwise replace/remove/merge with existing
-                comments_old = self.load_comments(controller)
-                chars_old, comments_old = self.split_comments(comments_old)
-
                 # Extract short hand notations and custom comments
+                store = self.annotations(controller)
                 chars_new, *comments_new = userinput.split(self.delimiter)
                 chars_new = chars_new.lower()
                 if set(chars_new).issubset(self.pairs.keys()):
-                    chars_new = set(self.pairs[c] for c in set(chars_new))
+                    chars_new = self.delimiter.join(self.pairs[c]
+                                                    for c in set(chars_new))
                 else:
                     comments_new = [chars_new] + comments_new
-                    chars_new = set()
-                comments_new = set(comments_new).difference('')
-
-                assert len(cluster_ids) == len(comments_old) == len(chars_old)
+                    chars_new = ''
+                bits_new, comments_new = store.parse(self.delimiter.join(
+                    [chars_new] + comments_new))
 
                 # Merge for each cluster with their previous comments
-                comments = []
-                for char_old, cmt_old in zip(chars_old, comments_old):
+                by_comment = dict()
+                for cid in cluster_ids:
+                    bits_old, cmt_old = store.comment(cid)
                     if (len(cluster_ids) == 1 or replace) and not remove:
                         # Replace old comment completely
-                        char = chars_new
-                        comment = comments_new
+                        bits, comment = bits_new, comments_new
                     elif remove:
                         # Remove new from old comments
-                        char = char_old.difference(chars_new)
-                        comment = cmt_old.difference(comments_new)
+                        bits = bits_old & ~bits_new
+                        comment = [i for i in cmt_old
+                                   if i not in comments_new]
                     else:
                         # Merge old and new comments
-                        char = char_old.union(chars_new)
-                        comment = cmt_old.union(comments_new)
+                        bits = bits_old | bits_new
+                        comment = list(cmt_old) + [i for i in comments_new
+                                                   if i not in cmt_old]
 
                     # Combine final comment string
-                    char, comment = list(char), list(comment)
-                    comments.append(self.delimiter.join(char + comment))
-
-                if len(set(comments)) == 1:
-                    logger.debug('Set the same comment to all clusters')
-                    controller.supervisor.label('comment', comments[0])
-                else:
-                    logger.debug('Set the comments individually')
-                    for cid, comment in zip(cluster_ids, comments):
-                        controller.supervisor.label('comment', comment,
-                                                    cluster_ids=cid)
+                    comment = store.format(bits, comment)
+                    by_comment.setdefault(comment, []).append(cid)
+
+                # One label action per distinct comment
+                logger.debug('Set %i distinct comments.', len(by_comment))
+                for comment, cids in by_comment.items():
+                    controller.supervisor.label('comment', comment or None,
+                                                cluster_ids=cids)
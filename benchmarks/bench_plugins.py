@@ -0,0 +1,264 @@
+"""
+Benchmark the plugin actions without the phy GUI
+
+The plugins are attached to a synthetic controller (see
+`bench_synthetic`) and their actions are called directly on the
+largest non-noise cluster, after checking some edge cases of the
+shared helpers. For each action the median wall time, the throughput
+in spikes per second (as reported by the actions, see
+`plugin_utils.count`) and the peak memory allocated are reported.
+
+Usage (phy needs to be installed):
+
+    python benchmarks/bench_plugins.py --clusters 10000 --spikes 1e8
+
+The results can be appended to a CSV file with `--output` to track
+them over time.
+
+Note that phy also scans this folder for plugins, so nothing is done on
+import.
+"""
+
+import argparse
+import csv
+import importlib
+import logging
+import shutil
+import sys
+import tracemalloc
+from pathlib import Path
+from timeit import default_timer
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+# Plugins providing the benchmarked actions
+PLUGINS = ['Recluster', 'SplitShortISI', 'SelectionOptions',
+           'WriteComments', 'AssignQuality', 'JumpInTrace', 'PreCuration',
+           'QualityMetrics', 'MergeDuplicates', 'ExportAnnotations',
+           'WaveformCache']
+
+
+def attach_plugins(controller, gui, trace_view):
+    """
+    Attach the plugins and emit the events phy would emit, return the
+    plugins by name
+    """
+    from phy import emit
+    from phy.gui.qt import create_app
+    from phy.utils import phy_config_dir
+
+    # Some plugins start timers
+    create_app()
+
+    # Plugins create their config files on first use
+    Path(phy_config_dir()).mkdir(parents=True, exist_ok=True)
+
+    sys.path.append(str(Path(__file__).parents[1]))
+    plugins = dict()
+    for name in PLUGINS:
+        plugin = plugins[name] = getattr(importlib.import_module(name),
+                                         name)()
+        plugin.attach_to_controller(controller)
+    emit('controller_ready', controller)
+    emit('gui_ready', controller, gui)
+    gui.views.append(trace_view)
+    emit('view_attached', trace_view, gui)
+    return plugins
+
+
+def scenarios(controller, trace_view, plugins):
+    """Return pairs of scenario names and functions to time"""
+    sup = controller.supervisor
+    actions = sup.actions
+
+    # Largest non-noise cluster and its most similar clusters
+    groups = sup.get_labels('group')
+    n_spikes = np.array([sup.n_spikes(c) for c in sup.clustering.cluster_ids])
+    order = np.argsort(n_spikes)[::-1]
+    cluster = next(c for c in order.tolist() if groups[c] != 'noise')
+    similar = [s['id'] for s in sup._get_similar_clusters(None, cluster)][:4]
+
+    def suggest_quality():
+        # Wait for the worker thread and deliver its result
+        from phy.gui.qt import create_app, thread_pool
+
+        actions['Suggest_quality']()
+        thread_pool().waitForDone()
+        create_app().processEvents()
+
+    def quality_metrics():
+        # Recompute the columns of all clusters
+        controller.metrics_table.data.clear()
+        return [controller.cluster_metrics[name](cluster)
+                for name in ('isi_viol', 'amp_cutoff', 'presence')]
+
+    # Waveforms of the cluster from the raw data and from the cache, without
+    # caching in the background while timing
+    cache = plugins['WaveformCache']
+    cache.close()
+    cache.fill(controller, cluster)
+
+    def load_waveforms():
+        return type(controller)._get_waveforms(controller, cluster)
+
+    def selecting(cluster_ids, f, *args):
+        def run():
+            sup.select(cluster_ids)
+            f(*args)
+        return run
+
+    return [
+        ('K-means clustering', selecting(
+            [cluster], actions['K_means_clustering'], 2)),
+        ('K-means clustering amplitude', selecting(
+            [cluster], actions['K_means_clustering_amplitude'], 2)),
+        ('K-means clustering amplitude chunked', selecting(
+            [cluster], actions['K_means_clustering_amplitude'], 2, 300)),
+        ('Split by amplitude', selecting(
+            [cluster], actions['Split_by_amplitude'], 2)),
+        ('Split by amplitude over time', selecting(
+            [cluster], actions['Split_by_amplitude'], 2, 60)),
+        ('K-means clustering per cluster', selecting(
+            [cluster] + similar, actions['K-means clustering per cluster'],
+            2)),
+        ('K-means clustering amplitude per cluster', selecting(
+            [cluster] + similar,
+            actions['K-means clustering amplitude per cluster'], 2)),
+        ('Split by amplitude per cluster', selecting(
+            [cluster] + similar, actions['Split by amplitude per cluster'],
+            2)),
+        ('Split by Mahalanobis distance', selecting(
+            [cluster], actions['Split by Mahalanobis distance'], 14)),
+        ('Visualize short ISI', selecting(
+            [cluster], actions['Visualize short ISI'])),
+        ('Visualize short ISI per cluster', selecting(
+            [cluster] + similar, actions['Visualize short ISI per cluster'])),
+        ('Preview short ISI', selecting(
+            [cluster] + similar, actions['Preview short ISI'])),
+        ('Find duplicate spikes', selecting(
+            [cluster] + similar, actions['Find duplicate spikes'])),
+        ('Select next lower cluster', selecting(
+            [cluster], actions['Select next lower cluster'])),
+        ('Select next unsorted cluster',
+         actions['Select next unsorted cluster']),
+        ('Select all in channel', selecting(
+            [cluster], actions['Select all in channel'])),
+        ('Select all within radius', selecting(
+            [cluster], actions['Select all within radius'], 150.)),
+        ('Select similar clusters', selecting(
+            [cluster], actions['Select similar clusters'], .2)),
+        ('Add comment', selecting(
+            [cluster] + similar, actions['Add comment'], 'as_bench')),
+        ('Assign quality', selecting(
+            [cluster] + similar, actions['Assign_quality_1'])),
+        ('Jump to next spike', selecting(
+            [cluster] + similar, trace_view.actions['Jump to next spike'])),
+        ('Jump to next burst', selecting(
+            [cluster] + similar, trace_view.actions['Jump to next burst'])),
+        ('Batch pre-curation', actions['Batch pre-curation']),
+        ('Quality metrics', quality_metrics),
+        ('Suggest quality', suggest_quality),
+        ('Accept suggested quality', selecting(
+            [cluster] + similar, actions['Accept_suggested_quality'])),
+        ('Export annotations', actions['Export annotations']),
+        ('Load waveforms', load_waveforms),
+        ('Load cached waveforms', lambda: controller._get_waveforms(cluster)),
+    ]
+
+
+def check_edge_cases():
+    """Check edge cases of the shared helpers before timing them"""
+    from plugin_clustering import kmeans_chunked
+
+    # Fewer spikes than clusters in the first time chunk
+    times = np.r_[0., np.linspace(10., 19., 300)]
+    data = np.r_[0., np.tile([0., 1., 2.], 100)]
+    labels = kmeans_chunked(data, 3, times, 10., parallel=False)
+    assert set(labels.tolist()) <= {0, 1, 2}, labels
+
+    # No spikes
+    assert not kmeans_chunked(np.zeros(0), 3, np.zeros(0), 10.).size
+
+
+def _spikes_recorded():
+    """Total number of spikes reported by all timed actions so far"""
+    from plugin_utils import timings
+
+    return sum(r['spikes'] for records in timings().records.values()
+               for r in records)
+
+
+def benchmark(f, repeat=5):
+    """Return median wall time, spikes per call and peak memory"""
+    times = []
+    spikes = _spikes_recorded()
+    tracemalloc.reset_peak()
+    mem = tracemalloc.get_traced_memory()[0]
+    for _ in range(repeat):
+        t0 = default_timer()
+        f()
+        times.append(default_timer() - t0)
+    peak = tracemalloc.get_traced_memory()[1] - mem
+    spikes = (_spikes_recorded() - spikes) / repeat
+    return np.median(times), spikes, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clusters', type=int, default=1000)
+    parser.add_argument('--spikes', type=float, default=1e6)
+    parser.add_argument('--channels', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dir', help='Directory for the synthetic data')
+    parser.add_argument('--output', help='Append the results to a CSV file')
+    args = parser.parse_args(argv)
+
+    sys.path.append(str(Path(__file__).parent))
+    from bench_synthetic import (SyntheticModel, SyntheticController,
+                                 HeadlessGUI, headless_trace_view)
+
+    print('Generate %i spikes in %i clusters on %i channels.' % (
+        args.spikes, args.clusters, args.channels))
+    t0 = default_timer()
+    model = SyntheticModel(n_clusters=args.clusters,
+                           n_spikes=int(args.spikes),
+                           n_channels=args.channels, dir_path=args.dir)
+    print('Generated in %.1f s at %s.' % (default_timer() - t0,
+                                          model.dir_path))
+
+    controller = SyntheticController(model)
+    trace_view = headless_trace_view()
+    plugins = attach_plugins(controller, HeadlessGUI(), trace_view)
+    check_edge_cases()
+
+    tracemalloc.start()
+    results = []
+    print('%-36s %10s %14s %10s' % ('action', 'median ms', 'Mspikes/s',
+                                    'peak MB'))
+    for name, f in scenarios(controller, trace_view, plugins):
+        t, spikes, peak = benchmark(f, repeat=args.repeat)
+        rate = spikes / t / 1e6 if t > 0 else 0
+        print('%-36s %10.2f %14.2f %10.1f' % (name, t * 1e3, rate,
+                                              peak / 1e6))
+        results.append(dict(action=name, clusters=args.clusters,
+                            spikes=int(args.spikes), channels=args.channels,
+                            time=t, spikes_per_call=spikes, peak=peak))
+    tracemalloc.stop()
+
+    if args.output:
+        filepath = Path(args.output)
+        exists = filepath.exists()
+        with open(filepath, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            if not exists:
+                writer.writeheader()
+            writer.writerows(results)
+        print('Appended results to %s.' % filepath)
+
+    if not args.dir:
+        shutil.rmtree(model.dir_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+"""
+Synthetic stand-in for the phy controller
+
+Provides the parts of the template GUI controller, supervisor and model
+that the plugins use, filled with synthetic data of configurable scale.
+The PC features are written to a memmapped `pc_features.npy` in a
+temporary directory such that the plugins read them from disk as they
+would in phy. The raw data is a sparse file of zeros of the same size
+as the recording.
+
+No GUI is created. Actions added by the plugins are collected by name
+and can be called directly.
+
+Note that phy also scans this folder for plugins, so nothing is done on
+import.
+"""
+
+import logging
+import tempfile
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+
+class HeadlessActions(object):
+    """Collect the actions added by the plugins"""
+
+    def __init__(self):
+        self.callbacks = dict()
+
+    def add(self, callback=None, name=None, **kwargs):
+        if callback is None:
+            return lambda f: self.add(f, name=name, **kwargs)
+        self.callbacks[name or callback.__name__] = callback
+        return callback
+
+    def __getitem__(self, name):
+        return self.callbacks[name]
+
+    def enable(self, name):
+        pass
+
+    def disable(self, name):
+        pass
+
+
+class HeadlessClustering(object):
+    def __init__(self, spike_clusters, n_clusters):
+        self.spike_clusters = spike_clusters
+        self.cluster_ids = np.arange(n_clusters)
+
+        # Spike ids per cluster from a stable sort
+        order = np.argsort(spike_clusters, kind='stable')
+        bounds = np.cumsum(np.bincount(spike_clusters, minlength=n_clusters))
+        self.spikes_per_cluster = dict(
+            zip(self.cluster_ids.tolist(), np.split(order, bounds[:-1])))
+
+    def spikes_in_clusters(self, cluster_ids):
+        return np.sort(np.concatenate(
+            [self.spikes_per_cluster[c] for c in cluster_ids]))
+
+
+class HeadlessTaskLogger(object):
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self._state = None
+
+    def _select_state(self, state):
+        self._state = state
+
+    def process(self):
+        clusters, _, similar, _ = self._state
+        self.supervisor._selected = (list(clusters or []),
+                                     list(similar or []))
+
+    def last_state(self):
+        return self.supervisor._selected
+
+
+class HeadlessSupervisor(object):
+    """Supervisor with cluster labels and selection but without views"""
+
+    def __init__(self, spike_clusters, n_clusters, channels):
+        from phylib.utils import Bunch
+
+        self.clustering = HeadlessClustering(spike_clusters, n_clusters)
+        self.channels = channels  # Peak channel per cluster
+        self.labels = dict(group=dict(), comment=dict(), quality=dict())
+        self.columns = ['id', 'ch', 'sh', 'depth', 'fr', 'n_spikes']
+        self.cluster_meta = Bunch(add_field=self._add_field,
+                                  get=self._get_label)
+        self.actions = HeadlessActions()
+        self.task_logger = HeadlessTaskLogger(self)
+        self.splits = []  # Recorded split calls
+        self.actions.split = self._split
+        self._selected = ([], [])
+
+        # Mark some clusters as noise and good
+        rng = np.random.default_rng(0)
+        group = rng.choice(np.array([None, 'noise', 'good'], dtype=object),
+                           n_clusters, p=[.7, .2, .1])
+        self.labels['group'] = dict(zip(self.clustering.cluster_ids.tolist(),
+                                        group))
+
+    def _add_field(self, name):
+        self.labels.setdefault(name, dict())
+
+    def _get_label(self, field, cluster_id):
+        return self.labels.get(field, dict()).get(cluster_id)
+
+    def _split(self, spike_ids, labels):
+        self.splits.append((spike_ids, labels))
+
+    @property
+    def fields(self):
+        return tuple(f for f in self.labels.keys() if f != 'group')
+
+    @property
+    def selected_clusters(self):
+        return self._selected[0]
+
+    @property
+    def selected_similar(self):
+        return self._selected[1]
+
+    @property
+    def selected(self):
+        out = list(self._selected[0])
+        return out + [c for c in self._selected[1] if c not in out]
+
+    def select(self, *cluster_ids):
+        if cluster_ids and isinstance(cluster_ids[0], (tuple, list)):
+            cluster_ids = list(cluster_ids[0]) + list(cluster_ids[1:])
+        self._selected = (list(cluster_ids), [])
+
+    def n_spikes(self, cluster_id):
+        return len(self.clustering.spikes_per_cluster[cluster_id])
+
+    def get_labels(self, field):
+        values = self.labels.get(field, dict())
+        return {c: values.get(c) for c in self.clustering.cluster_ids}
+
+    def label(self, name, value, cluster_ids=None):
+        from phylib.utils import Bunch, emit
+
+        if cluster_ids is None:
+            cluster_ids = self.selected
+        if not hasattr(cluster_ids, '__len__'):
+            cluster_ids = [cluster_ids]
+        values = self.labels.setdefault(name, dict())
+        for c in cluster_ids:
+            values[c] = value
+        if name != 'group' and name not in self.columns:
+            self.columns.append(name)
+        emit('cluster', self.cluster_meta,
+             Bunch(description='metadata_' + name,
+                   metadata_changed=list(cluster_ids), metadata_value=value))
+
+    def get_cluster_info(self, cluster_id, exclude=()):
+        out = dict(id=cluster_id, ch=int(self.channels[cluster_id]),
+                   n_spikes=self.n_spikes(cluster_id))
+        for key, values in self.labels.items():
+            out[key] = values.get(cluster_id)
+        return {k: v for k, v in out.items() if k not in exclude}
+
+    @property
+    def cluster_info(self):
+        return [self.get_cluster_info(c) for c in self.clustering.cluster_ids]
+
+    def _get_similar_clusters(self, sender, cluster_id):
+        """Clusters on neighbouring channels are considered similar"""
+        ch = self.channels[cluster_id]
+        dist = np.abs(self.channels - ch)
+        similar = np.flatnonzero(dist <= 2)
+        return [dict(similarity='%.3f' % (1 / (1 + dist[c])),
+                     **self.get_cluster_info(c))
+                for c in similar if c != cluster_id]
+
+
+class HeadlessSelector(object):
+    def __init__(self, clustering):
+        self.clustering = clustering
+
+    def select_spikes(self, cluster_ids=None, max_n_spikes_per_cluster=None,
+                      **kwargs):
+        return self.clustering.spikes_in_clusters(cluster_ids)
+
+    def __call__(self, n_spikes, cluster_ids, **kwargs):
+        spike_ids = self.clustering.spikes_in_clusters(cluster_ids)
+        if n_spikes and len(spike_ids) > n_spikes:
+            spike_ids = spike_ids[np.linspace(
+                0, len(spike_ids) - 1, n_spikes).astype(np.int64)]
+        return spike_ids
+
+
+class HeadlessFilter(object):
+    """Raw data filter without filter"""
+
+    def apply(self, data, axis=0):
+        return data
+
+
+class SyntheticModel(object):
+    """Template model with synthetic spikes, amplitudes and features
+
+    Parameters
+    ----------
+
+    n_clusters : int
+        Number of clusters
+    n_spikes : int
+        Total number of spikes
+    n_channels : int
+        Number of recording channels
+    n_channels_loc : int
+        Number of channels per spike in the PC features
+    n_pcs : int
+        Number of principal components per channel
+    sample_rate : float
+        Sampling rate in Hz
+    dir_path : str or Path
+        Directory for the memmapped features, temporary by default
+    seed : int
+        Seed of the random number generator
+    """
+
+    chunk_size = 2 ** 22  # Spikes generated at a time
+    n_samples_waveforms = 82
+
+    def __init__(self, n_clusters=1000, n_spikes=10 ** 6, n_channels=256,
+                 n_channels_loc=12, n_pcs=3, sample_rate=25000.,
+                 dir_path=None, seed=0):
+        from phylib.utils import Bunch
+
+        rng = np.random.default_rng(seed)
+        self.dir_path = Path(dir_path or tempfile.mkdtemp(prefix='phybench'))
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        self.sample_rate = sample_rate
+        self.n_channels = n_channels
+        self.n_spikes = n_spikes
+
+        # Uneven cluster sizes and a peak channel per cluster
+        weights = rng.lognormal(0, 1.5, n_clusters)
+        weights /= weights.sum()
+        self.cluster_channels = rng.integers(0, n_channels, n_clusters)
+        self.cluster_amplitudes = rng.uniform(20, 200, n_clusters)
+
+        # 8 x 32 electrode grid
+        x, y = np.meshgrid(np.arange(8), np.arange((n_channels + 7) // 8))
+        self.channel_positions = 100. * np.c_[x.ravel(), y.ravel()]
+        self.channel_positions = self.channel_positions[:n_channels]
+
+        # Sorted spike times, about 50 s per 10^5 spikes
+        self.duration = max(60., n_spikes / 2000.)
+        self.spike_samples = np.sort(rng.integers(
+            0, int(self.duration * sample_rate), n_spikes)).astype(np.int64)
+        self.spike_times = self.spike_samples / sample_rate
+        self.spike_clusters = np.empty(n_spikes, dtype=np.int32)
+        self.amplitudes = np.empty(n_spikes, dtype=np.float32)
+
+        # Features on disk, filled chunk by chunk
+        filepath = self.dir_path / 'pc_features.npy'
+        features = np.lib.format.open_memmap(
+            filepath, mode='w+', dtype=np.float32,
+            shape=(n_spikes, n_pcs, n_channels_loc))
+        centers = rng.normal(0, 1, (n_clusters, n_pcs, n_channels_loc))
+        for i in range(0, n_spikes, self.chunk_size):
+            n = min(self.chunk_size, n_spikes - i)
+            cl = rng.choice(n_clusters, n, p=weights).astype(np.int32)
+            self.spike_clusters[i:i + n] = cl
+
+            # Slow amplitude drift over the session
+            drift = 1 + .2 * np.sin(self.spike_times[i:i + n] /
+                                    self.duration * 2 * np.pi)
+            self.amplitudes[i:i + n] = (self.cluster_amplitudes[cl] * drift *
+                                        rng.normal(1, .1, n))
+            features[i:i + n] = centers[cl] + rng.normal(
+                0, .3, (n, n_pcs, n_channels_loc)).astype(np.float32)
+        features.flush()
+        del features
+        self.features_path = filepath
+        self.sparse_features = self._load_features()
+
+        # One whitened template per cluster, the noise has unit variance
+        bump = np.exp(-.5 * ((np.arange(82) - 41) / 3.) ** 2)
+        templates = -.05 * bump[None, :, None] * rng.uniform(
+            .5, 1, (n_clusters, 1, n_channels_loc))
+        self.sparse_templates = Bunch(data=templates.astype(np.float32),
+                                      cols=None)
+        self.spike_templates = self.spike_clusters
+
+        # Raw data, not written such that the file takes no space
+        self.traces = np.memmap(
+            self.dir_path / 'traces.bin', dtype=np.int16, mode='w+',
+            shape=(int(self.duration * sample_rate), n_channels))
+        self.spike_waveforms = None
+
+    def _load_features(self):
+        from phylib.utils import Bunch
+
+        data = np.load(self.features_path, mmap_mode='r')
+        return Bunch(data=data.transpose((0, 2, 1)), cols=None, rows=None)
+
+    def get_waveforms(self, spike_ids, channel_ids):
+        from phylib.io.traces import extract_waveforms
+
+        return extract_waveforms(self.traces, self.spike_samples[spike_ids],
+                                 channel_ids, self.n_samples_waveforms)
+
+
+class SyntheticController(object):
+    """Controller stand-in holding the synthetic model and supervisor"""
+
+    def __init__(self, model):
+        self.model = model
+        self.dir_path = model.dir_path
+        self.supervisor = HeadlessSupervisor(
+            model.spike_clusters, len(model.cluster_channels),
+            model.cluster_channels)
+        self.selector = HeadlessSelector(self.supervisor.clustering)
+        self.cluster_metrics = dict()  # Columns added by the plugins
+        self.cache_dir = model.dir_path / '.phy'
+        self.raw_data_filter = HeadlessFilter()
+        self.n_spikes_waveforms = 100
+
+    def get_best_channel(self, cluster_id):
+        return self.supervisor.channels[cluster_id]
+
+    def get_best_channels(self, cluster_id):
+        ch = self.get_best_channel(cluster_id)
+        return np.arange(max(0, ch - 12), min(self.model.n_channels, ch + 13))
+
+    def _get_channel_labels(self, channel_ids):
+        return ['%d' % ch for ch in channel_ids]
+
+    def _get_waveforms(self, cluster_id):
+        """Waveforms from the raw data as in phy's WaveformMixin"""
+        from phylib.utils import Bunch
+
+        spike_ids = self.selector(self.n_spikes_waveforms, [cluster_id])
+        channel_ids = self.get_best_channels(cluster_id)
+        data = self.model.get_waveforms(spike_ids, channel_ids)
+        data = data - np.median(data, axis=1)[:, np.newaxis, :]
+        return Bunch(data=self.raw_data_filter.apply(data, axis=1),
+                     channel_ids=channel_ids,
+                     channel_labels=self._get_channel_labels(channel_ids),
+                     channel_positions=self.model.channel_positions[
+                         channel_ids])
+
+    def get_spike_times(self, cluster_id, n=None):
+        spike_ids = self.supervisor.clustering.spikes_per_cluster[cluster_id]
+        return self.model.spike_times[spike_ids]
+
+    def _amplitude_getter(self, cluster_ids, name=None, load_all=False):
+        from phylib.utils import Bunch
+
+        out = []
+        for cluster_id in cluster_ids:
+            if cluster_id is None:  # No background spikes
+                continue
+            spike_ids = self.supervisor.clustering.spikes_per_cluster[
+                cluster_id]
+            out.append(Bunch(amplitudes=self.model.amplitudes[spike_ids],
+                             spike_ids=spike_ids,
+                             spike_times=self.model.spike_times[spike_ids]))
+        return out
+
+
+def headless_trace_view():
+    """Return a trace view without canvas for `on_view_attached`"""
+    from phy.cluster.views import TraceView
+
+    class HeadlessTraceView(TraceView):
+        time = 0.  # Current position, a property in TraceView
+
+        def __init__(self):
+            self.actions = HeadlessActions()
+            self.state_attrs = ()
+
+        def go_to(self, time):
+            self.time = time
+
+    return HeadlessTraceView()
+
+
+class HeadlessGUI(object):
+    """GUI stand-in with views and action groups"""
+
+    def __init__(self):
+        self.views = []
+        self.help_actions = HeadlessActions()
+
+    def get_view(self, cls):
+        return next((v for v in self.views if isinstance(v, cls)), None)
@@ -0,0 +1,184 @@
+"""
+Cluster annotations shared by the plugins in this repository
+
+This module does not define a plugin itself, see `plugin_utils`.
+
+
+Comments and quality
+--------------------
+
+`WriteComments` and `AssignQuality` label clusters through the
+supervisor, which keeps the labels in the cluster view, in the undo
+history and in the TSV files written on save. `annotations` returns a
+compact index of these labels for reading them back: the words of each
+comment are interned to small integer ids, the short hand notations of
+`WriteComments` are kept as a bitset per cluster and the quality as a
+small integer per cluster. Shared comments of a selection and filters by
+notation are then bitwise operations instead of splitting the comment
+strings of all clusters on every prompt.
+
+The index is built from the labels when first requested and follows the
+label and clustering events afterwards. As phy may execute this module a
+second time when scanning the plugin directory, the index is only
+obtained through `annotations`.
+"""
+
+from functools import reduce
+from phy import connect
+import numpy as np
+import logging
+
+logger = logging.getLogger('phy')
+
+
+class Annotations(object):
+    """Comments as interned tokens and tag bits, quality as integers"""
+
+    def __init__(self, supervisor, delimiter='_', tags=()):
+        self.supervisor = supervisor
+        self.tokens = []  # Token id: word
+        self._token_ids = dict()  # Word: token id
+        self.configure(delimiter, tags)
+
+    def configure(self, delimiter, tags):
+        """Set the delimiter and the words kept as tag bits"""
+        tags = list(tags)
+        if len(tags) > 64:
+            raise ValueError("At most 64 short hand notations are supported.")
+        self.delimiter = delimiter
+        self.tag_names = tags
+        self.tag_bits = {t: np.uint64(1 << i) for i, t in enumerate(tags)}
+        self.build()
+
+    def intern(self, word):
+        """Return the id of a word"""
+        token = self._token_ids.get(word)
+        if token is None:
+            token = self._token_ids[word] = len(self.tokens)
+            self.tokens.append(word)
+        return token
+
+    def _values(self, field, cluster_ids):
+        meta = self.supervisor.cluster_meta
+        if field not in self.supervisor.fields:
+            return [None] * len(cluster_ids)
+        return [meta.get(field, c) for c in cluster_ids]
+
+    def _grow(self, n):
+        if n > self.tags.size:
+            size = max(n, 2 * self.tags.size)
+            self.tags = np.r_[self.tags, np.zeros(size - self.tags.size,
+                                                  dtype=np.uint64)]
+            self.quality = np.r_[self.quality, np.zeros(
+                size - self.quality.size, dtype=np.int8)]
+
+    def build(self):
+        """Index the labels of all clusters"""
+        cluster_ids = list(self.supervisor.clustering.cluster_ids)
+        n = max(cluster_ids, default=-1) + 1
+        self.tags = np.zeros(n, dtype=np.uint64)
+        self.quality = np.zeros(n, dtype=np.int8)
+        self.custom = dict()  # Cluster id: token ids of custom comments
+        self.update(cluster_ids)
+
+    def update(self, cluster_ids, fields=('comment', 'quality')):
+        """Index the current labels of some clusters"""
+        cluster_ids = list(cluster_ids)
+        self._grow(max(cluster_ids, default=-1) + 1)
+        if 'comment' in fields:
+            for c, text in zip(cluster_ids,
+                               self._values('comment', cluster_ids)):
+                self.tags[c], custom = self.parse(text)
+                if custom:
+                    self.custom[c] = custom
+                else:
+                    self.custom.pop(c, None)
+        if 'quality' in fields:
+            for c, value in zip(cluster_ids,
+                                self._values('quality', cluster_ids)):
+                try:
+                    self.quality[c] = int(value) if value else 0
+                except ValueError:
+                    self.quality[c] = 0
+
+    def remove(self, cluster_ids):
+        cluster_ids = [c for c in cluster_ids if c < self.tags.size]
+        self.tags[cluster_ids] = 0
+        self.quality[cluster_ids] = 0
+        for c in cluster_ids:
+            self.custom.pop(c, None)
+
+    def parse(self, text):
+        """Tag bits and custom token ids of a comment string"""
+        bits = np.uint64(0)
+        custom = []
+        for word in (text or '').split(self.delimiter):
+            if word in self.tag_bits:
+                bits |= self.tag_bits[word]
+            elif word and self.intern(word) not in custom:
+                custom.append(self.intern(word))
+        return bits, tuple(custom)
+
+    def format(self, bits, custom):
+        """Comment string of tag bits and custom token ids"""
+        words = [t for t in self.tag_names if bits & self.tag_bits[t]]
+        words += [self.tokens[i] for i in custom]
+        return self.delimiter.join(words)
+
+    def comment(self, cluster_id):
+        """Tag bits and custom token ids of a cluster"""
+        if cluster_id >= self.tags.size:
+            return np.uint64(0), ()
+        return self.tags[cluster_id], self.custom.get(cluster_id, ())
+
+    def shared(self, cluster_ids):
+        """Tag bits and custom token ids common to all clusters"""
+        if not len(cluster_ids):
+            return np.uint64(0), ()
+        comments = [self.comment(c) for c in cluster_ids]
+        bits = np.bitwise_and.reduce([b for b, _ in comments])
+        common = reduce(set.intersection, (set(c) for _, c in comments[1:]),
+                        set(comments[0][1]))
+        return bits, tuple(i for i in comments[0][1] if i in common)
+
+    def get_quality(self, cluster_ids):
+        """Quality of clusters, 0 for none"""
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        out = np.zeros(cluster_ids.size, dtype=np.int8)
+        ok = cluster_ids < self.quality.size
+        out[ok] = self.quality[cluster_ids[ok]]
+        return out
+
+    def with_tags(self, bits):
+        """Ids of the clusters having all the tag bits"""
+        bits = np.uint64(bits)
+        return np.flatnonzero((self.tags & bits) == bits)
+
+
+def annotations(controller):
+    """
+    Return the annotations of a controller, create them on first use
+
+    `WriteComments` configures the delimiter and tags.
+    """
+    store = getattr(controller, 'annotations', None)
+    if store is not None:
+        return store
+    sup = controller.supervisor
+    store = Annotations(sup)
+    controller.annotations = store
+
+    def on_clustering(sender, up):
+        # The supervisor has already copied the labels to the new clusters
+        store.remove(up.deleted)
+        store.update(up.added)
+
+    def on_cluster_meta(sender, up):
+        field = up.description.replace('metadata_', '', 1)
+        if field in ('comment', 'quality'):
+            store.update(up.metadata_changed, fields=(field,))
+
+    connect(on_clustering, event='cluster', sender=sup.clustering)
+    connect(on_cluster_meta, event='cluster', sender=sup.cluster_meta)
+
+    return store
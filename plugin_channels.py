@@ -0,0 +1,110 @@
+"""
+Spatial index of the recording channels shared by the plugins
+
+This module does not define a plugin itself, see `plugin_utils`. It does
+not depend on phy.
+
+
+Neighbours
+----------
+
+On 2-D multielectrode arrays a unit spans several neighbouring
+electrodes. `channel_index` returns a KD-tree of the channel positions
+of the model, built once per controller, which finds the channels
+within a radius of a channel in O(log n) instead of comparing all
+channel positions. The positions do not change during a session.
+
+
+Channel order
+-------------
+
+`curve_order` orders the channels along a Hilbert curve over the
+electrode grid, such that channels that are close on the probe are
+mostly close in the order as well, also across columns. The coordinates
+are replaced by their rank among the distinct x and y positions first,
+i.e. the grid is traversed by electrode and not by micrometre. Long
+probes are covered by consecutive square curves as wide as the probe.
+Channels at the same position are ordered by id.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+import logging
+
+logger = logging.getLogger('phy')
+
+
+def hilbert_keys(x, y, n):
+    """Distances along a Hilbert curve of side n (a power of 2)"""
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s //= 2
+    return d
+
+
+def curve_order(positions):
+    """Channel ids in the order of a Hilbert curve over their positions"""
+    positions = np.asarray(positions)
+    if not len(positions):
+        return np.zeros(0, dtype=np.int64)
+    x = np.unique(positions[:, 0], return_inverse=True)[1].ravel()
+    y = np.unique(positions[:, 1], return_inverse=True)[1].ravel()
+    if x.max() < y.max():
+        x, y = y, x
+
+    # Square blocks along the long axis, each curve ends next to the start
+    # of the next block
+    n = 1 << int(y.max()).bit_length()
+    keys = (x // n) * n * n + hilbert_keys(x % n, y, n)
+    return np.lexsort((np.arange(len(keys)), keys))
+
+
+class ChannelIndex(object):
+    """KD-tree of the channel positions"""
+
+    def __init__(self, positions):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.tree = cKDTree(self.positions)
+        self._order = None
+
+    @property
+    def order(self):
+        """Channel ids along a Hilbert curve, see `curve_order`"""
+        if self._order is None:
+            self._order = curve_order(self.positions)
+        return self._order
+
+    def within(self, channel_id, radius):
+        """
+        Channel ids within a radius of a channel and their distances,
+        nearest first
+        """
+        center = self.positions[channel_id]
+        channel_ids = np.array(self.tree.query_ball_point(center, radius),
+                               dtype=np.int64)
+        distances = np.linalg.norm(self.positions[channel_ids] - center,
+                                   axis=1)
+        order = np.lexsort((channel_ids, distances))
+        return channel_ids[order], distances[order]
+
+
+def channel_index(controller):
+    """Return the channel index of a controller, create it on first use"""
+    index = getattr(controller, 'channel_index', None)
+    if index is None:
+        index = controller.channel_index = ChannelIndex(
+            controller.model.channel_positions)
+    return index
@@ -0,0 +1,551 @@
+"""
+Clustering routines shared by the plugins in this repository
+
+This module does not define a plugin itself, see `plugin_utils`.
+
+
+K-means
+-------
+
+`kmeans` is seeded with k-means++ and stops early once the centroids no
+longer move. Several restarts are run in parallel threads and the one
+with the lowest inertia is kept. Given the same seed the result is
+identical between runs, and the labels are ordered along the first
+dimension of the centroids.
+
+`kmeans_chunked` clusters the data separately within time chunks to
+account for drift. The chunks are distributed over a process pool, each
+worker only receiving its chunk, and the clusters of adjacent chunks are
+linked by matching their centroids.
+
+
+Amplitude valleys
+-----------------
+
+For one-dimensional data, such as template amplitudes, the density is
+estimated by a smoothed histogram with a fixed number of bins in O(n).
+The deepest valleys of the density are used as thresholds between the
+clusters and the observations are labeled with `np.digitize`. To follow
+slow drifts, the thresholds can be estimated within time windows.
+
+
+Splitting many clusters
+-----------------------
+
+`split_clusters` splits each of several clusters independently with one
+of the methods above. The data of all clusters is copied once into a
+shared memory block and each worker of the process pool reads the
+block of its cluster from there, instead of receiving a pickled copy.
+`combine_splits` merges the resulting labels into a single split, such
+that all clusters are split, and undone, at once.
+"""
+
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from scipy.cluster.vq import whiten
+from scipy.optimize import linear_sum_assignment
+
+
+def _sq_distances(data, centers, data_sq=None):
+    """Squared euclidean distances of shape (n_points, n_centers)"""
+    if data_sq is None:
+        data_sq = np.einsum('ij,ij->i', data, data)
+    centers_sq = np.einsum('ij,ij->i', centers, centers)
+    d = data_sq[:, None] - 2 * data @ centers.T + centers_sq[None, :]
+    return np.maximum(d, 0, out=d)
+
+
+def kmeans_plusplus(data, k, rng, data_sq=None):
+    """Choose initial centroids with the k-means++ scheme"""
+    n = data.shape[0]
+    centers = np.empty((k, data.shape[1]), dtype=data.dtype)
+    centers[0] = data[rng.integers(n)]
+    closest = _sq_distances(data, centers[:1], data_sq)[:, 0]
+    for i in range(1, k):
+        total = closest.sum()
+        if total > 0:
+            idx = np.searchsorted(np.cumsum(closest), rng.random() * total)
+            idx = min(idx, n - 1)
+        else:
+            # All points coincide with the centroids
+            idx = rng.integers(n)
+        centers[i] = data[idx]
+        closest = np.minimum(
+            closest, _sq_distances(data, centers[i:i + 1], data_sq)[:, 0])
+    return centers
+
+
+def _lloyd(data, k, rng, max_iter, tol, data_sq):
+    """Single k-means run, return centroids, labels and inertia"""
+    centers = kmeans_plusplus(data, k, rng, data_sq)
+
+    # Tolerance relative to the mean variance of the data
+    tol = tol * np.mean(np.var(data, axis=0))
+
+    labels = None
+    for _ in range(max_iter):
+        dist = _sq_distances(data, centers, data_sq)
+        new_labels = np.argmin(dist, axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+
+        # Update the centroids, keep the previous one if empty
+        onehot = labels[None, :] == np.arange(k)[:, None]
+        counts = onehot.sum(axis=1)
+        sums = onehot.astype(data.dtype) @ data
+        new_centers = centers.copy()
+        filled = counts > 0
+        new_centers[filled] = sums[filled] / counts[filled, None]
+        shift = np.sum((new_centers - centers) ** 2)
+        centers = new_centers
+        if shift <= tol:
+            break
+
+    dist = _sq_distances(data, centers, data_sq)
+    labels = np.argmin(dist, axis=1)
+    inertia = dist[np.arange(len(labels)), labels].sum()
+    return centers, labels, inertia
+
+
+def kmeans(data, k, seed=0, n_init=4, max_iter=100, tol=1e-4):
+    """
+    Deterministic K-means clustering
+
+    Parameters
+    ----------
+
+    data : array-like (n_points, n_dims)
+        Observations, one per row (1-D input is treated as one dimension)
+    k : int
+        Number of clusters
+    seed : int or list of int
+        Seed of the random initialization, e.g. the cluster ids
+    n_init : int
+        Number of restarts, run in parallel
+    max_iter : int
+        Maximum number of iterations per restart
+    tol : float
+        Stop when the squared centroid shift falls below this fraction
+        of the mean variance of the data
+
+    Returns
+    -------
+
+    centers : ndarray (k, n_dims)
+        Centroids, sorted along the first dimension
+    labels : ndarray (n_points,)
+        Index of the closest centroid of each observation
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data.reshape((-1, 1))
+    k = int(min(k, data.shape[0]))
+    data_sq = np.einsum('ij,ij->i', data, data)
+
+    # Independent random generators for each restart
+    seeds = np.random.SeedSequence(seed).spawn(n_init)
+    rngs = [np.random.default_rng(s) for s in seeds]
+
+    # NumPy releases the GIL for the heavy lifting
+    n_workers = max(1, min(n_init, os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        runs = list(pool.map(
+            lambda rng: _lloyd(data, k, rng, max_iter, tol, data_sq), rngs))
+    centers, labels, _ = min(runs, key=lambda r: r[2])
+
+    # Order the clusters for reproducible labels
+    order = np.lexsort(centers.T[::-1])
+    rank = np.empty(k, dtype=np.int64)
+    rank[order] = np.arange(k)
+    return centers[order], rank[labels]
+
+
+_pool = None
+
+
+def process_pool():
+    """Return the process pool shared by the plugins, create on first use"""
+    global _pool
+    if _pool is None:
+        # Forking the GUI process is not safe
+        _pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _kmeans_task(args):
+    """K-means on one chunk in a worker process"""
+    data, k, seed, n_init = args
+    return kmeans(data, k, seed=seed, n_init=n_init)
+
+
+def _link(prev, centers, labels):
+    """Relabel the clusters of a chunk to match the previous centroids"""
+    cost = np.sum((prev[:, None, :] - centers[None, :, :]) ** 2, axis=2)
+    row, col = linear_sum_assignment(cost)
+    mapping = np.empty(len(centers), dtype=np.int64)
+    mapping[col] = row
+    linked = prev.copy()
+    linked[row] = centers[col]
+    return linked, mapping[labels]
+
+
+def kmeans_chunked(data, k, times, chunk, seed=0, n_init=4, parallel=True):
+    """
+    K-means clustering within time chunks, linked across chunks
+
+    Parameters
+    ----------
+
+    data : array-like (n_points, n_dims)
+        Observations, one per row (1-D input is treated as one dimension)
+    k : int
+        Number of clusters
+    times : array-like (n_points,)
+        Sorted time of each observation
+    chunk : float
+        Duration of the time chunks
+    seed : int or list of int
+        Seed of the random initialization, e.g. the cluster ids
+    n_init : int
+        Number of restarts per chunk
+    parallel : bool
+        Whether to distribute the chunks over the process pool
+
+    Returns
+    -------
+
+    labels : ndarray (n_points,)
+        Cluster of each observation, consistent across chunks
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data.reshape((-1, 1))
+    times = np.asarray(times).ravel()
+    if not times.size:
+        return np.zeros(0, dtype=np.int64)
+
+    # Chunk boundaries as indices into the sorted times
+    edges = np.arange(times[0], times[-1] + chunk, chunk)
+    bounds = np.searchsorted(times, edges[1:])
+    bounds = np.unique(np.r_[0, bounds[:-1], times.size])
+
+    # Chunks with fewer than k points join the next one, the last one the
+    # previous one, such that all chunks have k centroids to link
+    keep = [0]
+    for b in bounds[1:-1]:
+        if b - keep[-1] >= k:
+            keep.append(b)
+    if len(keep) > 1 and times.size - keep[-1] < k:
+        keep.pop()
+    bounds = np.r_[keep, times.size]
+    seed = np.atleast_1d(seed).tolist()
+    tasks = [(data[i0:i1], k, seed + [i], n_init)
+             for i, (i0, i1) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+    if parallel and len(tasks) > 1:
+        results = process_pool().map(_kmeans_task, tasks)
+    else:
+        results = map(_kmeans_task, tasks)
+
+    # Link each chunk to the previous one
+    labels = np.empty(times.size, dtype=np.int64)
+    prev = None
+    for i0, i1, (centers, chunk_labels) in zip(bounds[:-1], bounds[1:],
+                                               results):
+        if prev is None:
+            prev = centers
+        else:
+            prev, chunk_labels = _link(prev, centers, chunk_labels)
+        labels[i0:i1] = chunk_labels
+    return labels
+
+
+def _smooth(hist, width):
+    """Smooth a histogram with a Gaussian kernel (width in bins)"""
+    if width <= 0:
+        return hist.astype(np.float64)
+    x = np.arange(-int(4 * width), int(4 * width) + 1)
+    kernel = np.exp(-.5 * (x / width) ** 2)
+    return np.convolve(hist, kernel / kernel.sum(), mode='same')
+
+
+def valley_thresholds(data, n_clusters, n_bins=200, smooth=2.,
+                      min_depth=.2, min_peak=.05):
+    """
+    Thresholds at the deepest valleys of the density of 1-D data
+
+    Parameters
+    ----------
+
+    data : array-like (n_points,)
+        Observations
+    n_clusters : int
+        Number of clusters, i.e. at most `n_clusters - 1` thresholds
+    n_bins : int
+        Maximum number of histogram bins between the 0.5 and 99.5
+        percentiles, at most the square root of the number of points
+    smooth : float
+        Width of the Gaussian smoothing in bins
+    min_depth : float
+        Minimum depth of a valley relative to the lower of the highest
+        peaks on either side
+    min_peak : float
+        Minimum height of these peaks relative to the highest peak
+
+    Returns
+    -------
+
+    thresholds : ndarray
+        Sorted thresholds, fewer than requested if there are not enough
+        valleys
+    """
+    data = np.asarray(data).ravel()
+    if data.size < 2 or n_clusters < 2:
+        return np.array([])
+    lo, hi = np.percentile(data, [.5, 99.5])
+    if hi <= lo:
+        return np.array([])
+    # Fewer bins for few observations
+    n_bins = max(8, min(n_bins, int(np.sqrt(data.size))))
+    hist, edges = np.histogram(data, bins=n_bins, range=(lo, hi))
+    hist = _smooth(hist, smooth)
+
+    # Local minima of the density
+    mid = hist[1:-1]
+    valleys = np.flatnonzero((mid < hist[:-2]) & (mid <= hist[2:])) + 1
+
+    # Relative depth below the highest peaks on either side
+    left = np.maximum.accumulate(hist)
+    right = np.maximum.accumulate(hist[::-1])[::-1]
+    peak = np.minimum(left[valleys], right[valleys])
+    depth = (peak - hist[valleys]) / peak
+
+    # Ignore noise in the sparse tails of the distribution
+    keep = (depth >= min_depth) & (peak >= min_peak * hist.max())
+    valleys, depth = valleys[keep], depth[keep]
+
+    # Keep the deepest valleys
+    valleys = valleys[np.argsort(depth, kind='stable')[::-1]]
+    valleys = np.sort(valleys[:n_clusters - 1])
+    return (edges[valleys] + edges[valleys + 1]) / 2
+
+
+def split_by_valleys(data, n_clusters, times=None, window=None,
+                     min_points=100, **kwargs):
+    """
+    Label 1-D data by the valleys of its density
+
+    Parameters
+    ----------
+
+    data : array-like (n_points,)
+        Observations
+    n_clusters : int
+        Number of clusters
+    times : array-like (n_points,)
+        Sorted time of each observation, required for `window`
+    window : float
+        Estimate the thresholds separately in time windows of this
+        duration to follow slow drifts
+    min_points : int
+        Windows with fewer observations use the overall thresholds
+    **kwargs
+        Passed on to `valley_thresholds`
+
+    Returns
+    -------
+
+    labels : ndarray (n_points,)
+        Cluster of each observation, ordered by value
+    n_found : int
+        Number of clusters found
+    """
+    data = np.asarray(data).ravel()
+    thresholds = valley_thresholds(data, n_clusters, **kwargs)
+    if not window or times is None or not thresholds.size:
+        return np.digitize(data, thresholds), thresholds.size + 1
+
+    # Window boundaries as indices into the sorted times
+    times = np.asarray(times).ravel()
+    edges = np.arange(times[0], times[-1] + window, window)
+    bounds = np.searchsorted(times, edges[1:])
+    bounds = np.r_[0, bounds[:-1], times.size]
+
+    labels = np.empty(data.size, dtype=np.int64)
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        thr = thresholds
+        if i1 - i0 >= min_points:
+            thr_w = valley_thresholds(data[i0:i1], n_clusters, **kwargs)
+            # Same number of clusters needed to link them across windows
+            if thr_w.size == thresholds.size:
+                thr = thr_w
+        labels[i0:i1] = np.digitize(data[i0:i1], thr)
+    return labels, thresholds.size + 1
+
+
+def split_cluster(data, method, n_clusters, seed=0, n_init=4, times=None,
+                  window=0):
+    """
+    Labels of the spikes of one cluster
+
+    Parameters
+    ----------
+
+    data : array-like (n_points, ...)
+        Features (flattened per spike) or amplitudes of the spikes
+    method : str
+        'kmeans' on the whitened data or 'valleys' (1-D data only)
+    n_clusters : int
+        Number of clusters
+    seed : int or list of int
+        Seed of the random initialization, e.g. the cluster id
+    n_init : int
+        Number of K-means restarts
+    times : array-like (n_points,)
+        Sorted spike times, required for `window`
+    window : float
+        Cluster time chunks of this duration separately (K-means) or
+        estimate the valleys within time windows, 0 for neither
+
+    Returns
+    -------
+
+    labels : ndarray (n_points,)
+        Cluster of each spike
+    """
+    data = np.asarray(data)
+    data = data.reshape((data.shape[0], -1))
+    if method == 'kmeans':
+        data = whiten(data)
+        if not window:
+            return kmeans(data, n_clusters, seed=seed, n_init=n_init)[1]
+        # Already in a worker process
+        return kmeans_chunked(data, n_clusters, times, window, seed=seed,
+                              n_init=n_init, parallel=False)
+    elif method == 'valleys':
+        return split_by_valleys(data, n_clusters, times=times,
+                                window=window)[0]
+    raise ValueError("Unknown split method %s." % method)
+
+
+def _to_shared(array):
+    """Copy an array to a new shared memory block"""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _from_shared(block, i0, i1):
+    """Copy rows of an array in a shared memory block"""
+    name, shape, dtype = block
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype, buffer=shm.buf)[i0:i1].copy()
+    finally:
+        shm.close()
+
+
+def _split_task(args):
+    """Split one cluster in a worker process"""
+    data, times, i0, i1, method, n_clusters, seed, kwargs = args
+    times = _from_shared(times, i0, i1) if times is not None else None
+    return split_cluster(_from_shared(data, i0, i1), method, n_clusters,
+                         seed=seed, times=times, **kwargs)
+
+
+def split_clusters(data, offsets, method, n_clusters, seeds, times=None,
+                   parallel=True, **kwargs):
+    """
+    Split several clusters independently
+
+    Parameters
+    ----------
+
+    data : array-like (n_points, ...)
+        Data of the spikes of all clusters, cluster after cluster
+    offsets : array-like (n_clusters + 1,)
+        The data of the i-th cluster is data[offsets[i]:offsets[i + 1]]
+    method : str
+        See `split_cluster`
+    n_clusters : int
+        Number of clusters per split cluster
+    seeds : list
+        Seed per cluster, e.g. the cluster ids
+    times : array-like (n_points,)
+        Spike times, sorted within each cluster
+    parallel : bool
+        Whether to distribute the clusters over the process pool
+    **kwargs
+        Passed on to `split_cluster`
+
+    Returns
+    -------
+
+    labels : list
+        Labels of the spikes of each cluster
+    """
+    offsets = np.asarray(offsets)
+    bounds = list(zip(offsets[:-1].tolist(), offsets[1:].tolist()))
+    if not parallel or len(bounds) < 2:
+        return [split_cluster(
+            data[i0:i1], method, n_clusters, seed=seed,
+            times=times[i0:i1] if times is not None else None, **kwargs)
+            for (i0, i1), seed in zip(bounds, seeds)]
+
+    blocks = [_to_shared(data)]
+    if times is not None:
+        blocks.append(_to_shared(times))
+    try:
+        shared = [b for _, b in blocks] + [None]
+        tasks = [(shared[0], shared[1], i0, i1, method, n_clusters, seed,
+                  kwargs) for (i0, i1), seed in zip(bounds, seeds)]
+        return list(process_pool().map(_split_task, tasks))
+    finally:
+        for shm, _ in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def combine_splits(spike_ids, labels):
+    """
+    Combine the splits of several clusters into a single split
+
+    Parameters
+    ----------
+
+    spike_ids : list
+        Spike ids of each cluster
+    labels : list
+        Labels of these spikes per cluster
+
+    Returns
+    -------
+
+    spike_ids : ndarray
+        Sorted spike ids of the clusters that are split, i.e. that have
+        more than one label
+    labels : ndarray
+        Labels of these spikes, different across clusters
+    """
+    out_ids, out_labels = [], []
+    offset = 0
+    for ids, lab in zip(spike_ids, labels):
+        lab = np.asarray(lab, dtype=np.int64)
+        if lab.size == 0 or lab.min() == lab.max():
+            continue
+        out_ids.append(np.asarray(ids, dtype=np.int64))
+        out_labels.append(lab - lab.min() + offset)
+        offset += lab.max() - lab.min() + 1
+    if not out_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    out_ids = np.concatenate(out_ids)
+    out_labels = np.concatenate(out_labels)
+    order = np.argsort(out_ids, kind='stable')
+    return out_ids[order], out_labels[order]
@@ -0,0 +1,179 @@
+"""
+Feature access shared by the plugins in this repository
+
+This module does not define a plugin itself, see `plugin_utils`. It does
+not depend on phy, such that worker processes can import it.
+
+
+Feature cache
+-------------
+
+The PC features are memmapped once by the model. `feature_cache`
+returns the feature cache of a controller, which reuses that memmap
+instead of opening the file for every action, and keeps the features of
+the most recently used sets of spikes in memory. The sets are identified
+by a hash of their spike ids, such that splitting the same cluster with
+different methods or numbers of clusters only reads its features from
+disk once. The cache is bounded in bytes and the least recently used
+sets are dropped first.
+
+
+Gather
+------
+
+Indexing a memmap with arbitrary spike ids reads the file in random
+order. `gather` sorts the spike ids and reads them window by window in
+file order. Windows in which most pages are needed anyway are read as
+one contiguous slice. Optionally, the kernel is asked to read the next
+window ahead while the current one is copied. The rows are returned in
+the requested order.
+"""
+
+import hashlib
+import mmap
+import numpy as np
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger('phy')
+
+
+def _willneed(data, lo, hi):
+    """Ask the kernel to read rows `lo` to `hi` of a memmap ahead"""
+    root = data
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    mm = root.base
+    if not isinstance(root, np.memmap) or not hasattr(mm, 'madvise'):
+        return
+    # Position of the array within the mapping
+    start = (data.ctypes.data - root.ctypes.data +
+             root.offset % mmap.ALLOCATIONGRANULARITY)
+    begin = start + lo * data.strides[0]
+    end = min(start + hi * data.strides[0], len(mm))
+    begin -= begin % mmap.PAGESIZE
+    try:
+        mm.madvise(mmap.MADV_WILLNEED, begin, end - begin)
+    except (OSError, ValueError):  # Only a hint
+        pass
+
+
+def gather(data, indices, window=2 ** 22, advise=False):
+    """
+    Read rows of a (memmapped) array in file order
+
+    Parameters
+    ----------
+
+    data : array-like (n_rows, ...)
+        Array to read from, typically a memmap
+    indices : array-like (n,)
+        Row indices in any order, duplicates allowed
+    window : int
+        Size in bytes of the windows of rows read at a time
+    advise : bool
+        Whether to ask the kernel to read the next window ahead
+
+    Returns
+    -------
+
+    out : ndarray (n, ...)
+        The rows `data[indices]`
+    """
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    if indices.size == 0 or not isinstance(data, np.memmap):
+        return np.asarray(data[indices])
+
+    # Copy whole rows if the axes of the rows are permuted in the file
+    axes = [0] + sorted(range(1, data.ndim), key=lambda i: -data.strides[i])
+    if axes != sorted(axes) and data.transpose(axes).flags.c_contiguous:
+        out = gather(data.transpose(axes), indices, window, advise)
+        return np.ascontiguousarray(out.transpose(np.argsort(axes)))
+
+    order = None
+    if np.any(indices[1:] < indices[:-1]):
+        order = np.argsort(indices)
+        indices = indices[order]
+
+    # Windows of rows in the file
+    row_bytes = abs(data.strides[0])
+    win = indices // max(1, window // row_bytes)
+    bounds = np.r_[0, np.flatnonzero(np.diff(win)) + 1, indices.size]
+
+    out = np.empty((indices.size,) + data.shape[1:], dtype=data.dtype)
+    for i, (i0, i1) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if advise and i + 2 < bounds.size:
+            _willneed(data, indices[i1], indices[bounds[i + 2] - 1] + 1)
+        lo, hi = indices[i0], indices[i1 - 1] + 1
+        if (i1 - i0) * mmap.PAGESIZE >= (hi - lo) * row_bytes:
+            # Most pages are needed: one contiguous read
+            out[i0:i1] = data[lo:hi][indices[i0:i1] - lo]
+        else:
+            out[i0:i1] = data[indices[i0:i1]]
+
+    if order is None:
+        return out
+    # Back to the requested order
+    result = np.empty_like(out)
+    result[order] = out
+    return result
+
+
+class FeatureCache(object):
+    """Least recently used cache of the features of sets of spikes"""
+
+    # Maximum size of the cached features
+    max_bytes = 512 * 1024 ** 2
+
+    def __init__(self, model):
+        self.model = model
+        self.nbytes = 0
+        self._features = None
+        self._cache = OrderedDict()
+
+    @property
+    def features(self):
+        """Memmapped features of all spikes (n_spikes, n_channels, n_pcs)"""
+        if self._features is None:
+            sparse = getattr(self.model, 'sparse_features', None)
+            if sparse is None:
+                sparse = self.model._load_features()
+            self._features = sparse.data
+        return self._features
+
+    def _key(self, spike_ids):
+        """Identify a set of spikes by the hash of its ids"""
+        spike_ids = np.ascontiguousarray(spike_ids, dtype=np.int64)
+        return (spike_ids.size,
+                hashlib.blake2b(spike_ids, digest_size=16).digest())
+
+    def get(self, spike_ids):
+        """Return the features of the spikes, read-only"""
+        key = self._key(spike_ids)
+        data = self._cache.get(key)
+        if data is not None:
+            self._cache.move_to_end(key)
+            return data
+
+        data = gather(self.features, spike_ids, advise=True)
+        data.flags.writeable = False
+        if data.nbytes <= self.max_bytes:
+            self._cache[key] = data
+            self.nbytes += data.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._cache.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return data
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+
+
+def feature_cache(controller):
+    """Return the feature cache of a controller, create it on first use"""
+    cache = getattr(controller, 'feature_cache', None)
+    if cache is None:
+        cache = FeatureCache(controller.model)
+        controller.feature_cache = cache
+    return cache
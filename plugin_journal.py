@@ -0,0 +1,245 @@
+"""
+Append-only journal of curation changes
+
+This module does not define a plugin itself, see `plugin_utils` and the
+`CurationJournal` plugin.
+
+
+Format
+------
+
+The file starts with a header holding the number of spikes and a
+checksum of the spike clusters the journal applies to. It is followed
+by records of a kind byte, the payload length and the payload:
+
+- 'A' (assign): spike ids (uint32, or uint64 for more than 2^32 spikes)
+  followed by their new cluster ids (int32)
+- 'L' (label): field name, JSON encoded value and cluster ids (int32)
+
+A record cut short by a crash ends the journal.
+
+
+Writing
+-------
+
+Records are encoded by the caller and appended by a background thread,
+which flushes the file after each record. When the file has grown well
+beyond its size after the last compaction, the writer thread compacts
+it: only the last cluster of each spike and the last value of each
+label are kept.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+import numpy as np
+from pathlib import Path
+import logging
+
+logger = logging.getLogger('phy')
+
+MAGIC = b'PHYJ'
+VERSION = 1
+_HEADER = struct.Struct('<4sBQ16s')
+_RECORD = struct.Struct('<cQ')
+
+
+def checksum(spike_clusters):
+    """Checksum identifying a spike clustering"""
+    data = np.ascontiguousarray(spike_clusters, dtype=np.int64)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _spike_dtype(n_spikes):
+    return np.dtype('<u4') if n_spikes < 2 ** 32 else np.dtype('<u8')
+
+
+def encode_header(n_spikes, check):
+    return _HEADER.pack(MAGIC, VERSION, n_spikes, check)
+
+
+def encode_assign(spike_ids, cluster_ids, n_spikes):
+    """Record of new cluster ids of spikes"""
+    payload = (np.asarray(spike_ids).astype(_spike_dtype(n_spikes)).tobytes()
+               + np.asarray(cluster_ids).astype('<i4').tobytes())
+    return _RECORD.pack(b'A', len(payload)) + payload
+
+
+def encode_label(field, value, cluster_ids):
+    """Record of a label value of clusters"""
+    name = field.encode('utf-8')
+    value = json.dumps(value, default=lambda v: v.item()).encode('utf-8')
+    payload = (struct.pack('<H', len(name)) + name +
+               struct.pack('<I', len(value)) + value +
+               np.asarray(cluster_ids).astype('<i4').tobytes())
+    return _RECORD.pack(b'L', len(payload)) + payload
+
+
+def read_journal(filepath):
+    """
+    Read a journal file
+
+    Returns
+    -------
+
+    n_spikes : int
+    check : bytes
+        Checksum of the spike clusters the journal applies to
+    records : list
+        Tuples ('A', spike_ids, cluster_ids) and ('L', field, value,
+        cluster_ids) in order
+    """
+    data = Path(filepath).read_bytes()
+    if len(data) < _HEADER.size:
+        raise ValueError("Journal header is incomplete.")
+    magic, version, n_spikes, check = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a journal file of this version.")
+    dtype = _spike_dtype(n_spikes)
+
+    records = []
+    pos = _HEADER.size
+    while pos + _RECORD.size <= len(data):
+        kind, length = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        if pos + length > len(data):
+            logger.debug("Ignore incomplete journal record.")
+            break
+        payload = data[pos:pos + length]
+        pos += length
+        if kind == b'A':
+            n = length // (dtype.itemsize + 4)
+            spike_ids = np.frombuffer(payload, dtype, n).astype(np.int64)
+            cluster_ids = np.frombuffer(payload, '<i4', n,
+                                        n * dtype.itemsize).astype(np.int64)
+            records.append(('A', spike_ids, cluster_ids))
+        elif kind == b'L':
+            (n,) = struct.unpack_from('<H', payload)
+            field = payload[2:2 + n].decode('utf-8')
+            (m,) = struct.unpack_from('<I', payload, 2 + n)
+            value = json.loads(payload[6 + n:6 + n + m].decode('utf-8'))
+            cluster_ids = np.frombuffer(payload[6 + n + m:], '<i4')
+            records.append(('L', field, value, cluster_ids.tolist()))
+        else:
+            logger.warning("Unknown journal record %s.", kind)
+            break
+    return n_spikes, check, records
+
+
+def collapse(records):
+    """
+    Final state after all records
+
+    Returns
+    -------
+
+    spike_ids : ndarray
+        Sorted ids of all spikes that were assigned
+    cluster_ids : ndarray
+        Last cluster id of each of these spikes
+    labels : dict
+        Last value per cluster id per field
+    """
+    assigns = [r for r in records if r[0] == 'A']
+    if assigns:
+        spike_ids = np.concatenate([r[1] for r in assigns])
+        cluster_ids = np.concatenate([r[2] for r in assigns])
+        # Last assignment of each spike
+        spike_ids, last = np.unique(spike_ids[::-1], return_index=True)
+        cluster_ids = cluster_ids[::-1][last]
+    else:
+        spike_ids = cluster_ids = np.zeros(0, dtype=np.int64)
+
+    labels = dict()
+    for r in records:
+        if r[0] == 'L':
+            _, field, value, clusters = r
+            labels.setdefault(field, dict()).update(
+                (c, value) for c in clusters)
+    return spike_ids, cluster_ids, labels
+
+
+def compact(records, n_spikes):
+    """Encode the final state of the records as few records"""
+    spike_ids, cluster_ids, labels = collapse(records)
+    out = []
+    if spike_ids.size:
+        out.append(encode_assign(spike_ids, cluster_ids, n_spikes))
+    for field, values in labels.items():
+        by_value = dict()
+        for cluster_id, value in values.items():
+            by_value.setdefault(json.dumps(value), []).append(cluster_id)
+        for value, clusters in by_value.items():
+            out.append(encode_label(field, json.loads(value), clusters))
+    return b''.join(out)
+
+
+class JournalWriter(object):
+    """Append records to a journal file in a background thread"""
+
+    # Compact when the file has grown by this factor since the last time
+    compact_factor = 4
+    # Never compact smaller files
+    compact_min_size = 2 ** 24
+
+    def __init__(self, filepath):
+        self.filepath = Path(filepath)
+        self._queue = queue.Queue()
+        self._compacted_size = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def reset(self, n_spikes, check):
+        """Start a new journal for the given spike clusters"""
+        self._queue.put(('reset', encode_header(n_spikes, check)))
+
+    def append(self, record):
+        """Append an encoded record"""
+        self._queue.put(('append', record))
+
+    def close(self):
+        """Write all pending records and stop the thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        f = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            command, data = item
+            try:
+                if command == 'reset':
+                    if f is not None:
+                        f.close()
+                    f = open(self.filepath, 'wb')
+                    self._compacted_size = len(data)
+                elif f is None:
+                    f = open(self.filepath, 'ab')
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                if f.tell() > max(self.compact_min_size, self.compact_factor *
+                                  self._compacted_size):
+                    f.close()
+                    f = self._compact()
+            except OSError as e:
+                logger.warning("Error writing the journal: %s", e)
+        if f is not None:
+            f.close()
+
+    def _compact(self):
+        """Rewrite the journal with the final state, return the file"""
+        n_spikes, check, records = read_journal(self.filepath)
+        tmp = self.filepath.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(encode_header(n_spikes, check))
+            f.write(compact(records, n_spikes))
+        os.replace(tmp, self.filepath)
+        self._compacted_size = self.filepath.stat().st_size
+        logger.debug("Compacted journal to %i bytes.", self._compacted_size)
+        return open(self.filepath, 'ab')
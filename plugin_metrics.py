@@ -0,0 +1,503 @@
+"""
+Cluster metrics shared by the plugins in this repository
+
+This module does not define a plugin itself, see `plugin_utils`.
+
+
+Grouped metrics
+---------------
+
+The metrics of all clusters are computed in one pass over the spikes.
+A stable sort by cluster keeps the spikes of each cluster in temporal
+order and the sums per cluster are accumulated with `np.bincount`. The
+histograms needed for the amplitude cutoff and presence ratio are
+accumulated for all clusters at once in a single `np.bincount` as well.
+The same functions serve to update the metrics of a few clusters by
+passing only their spikes.
+
+`metrics_table` returns the quality metrics of a controller. They are
+computed for all clusters when first requested. As phy gives new ids to
+all clusters changed by a merge or split, only the new clusters are
+computed afterwards, and the values of clusters restored by an undo are
+still valid.
+
+
+Spike conflicts
+---------------
+
+`short_isi` and `coincident_spikes` flag individual spikes rather than
+clusters: spikes within the refractory period of another spike of the
+same cluster, and spikes within a short window of a spike of another
+cluster. Both only need neighbouring spikes in time, the latter after
+merging the sorted spike times of the clusters. `duplicate_spikes`
+picks the smaller spike of each coincident pair as the duplicate and
+repeats this on the remaining spikes for chains of coincident spikes.
+
+
+Feature metrics
+---------------
+
+Metrics that need the PC features of each cluster, such as the fraction
+of Mahalanobis outliers, are computed cluster by cluster. The clusters
+are sharded over the process pool of `plugin_clustering` and each
+worker reads the features of its clusters from the memmapped file
+itself (see `plugin_features.gather`), such that the features are never
+sent between processes.
+"""
+
+import os
+import sys
+import threading
+import numpy as np
+from pathlib import Path
+from scipy.ndimage import gaussian_filter1d
+
+sys.path.append(str(Path(__file__).parent))  # Shared plugin helpers
+from plugin_clustering import process_pool  # noqa: E402
+from plugin_features import gather  # noqa: E402
+
+
+def group_by_cluster(spike_clusters):
+    """
+    Sort the spikes by cluster
+
+    Returns
+    -------
+
+    order : ndarray (n_spikes,)
+        Spike ids sorted by cluster, in temporal order within clusters
+    cluster_ids : ndarray (n_clusters,)
+        Sorted ids of the non-empty clusters
+    index : ndarray (n_spikes,)
+        Index into `cluster_ids` of each spike in `order`
+    counts : ndarray (n_clusters,)
+        Number of spikes per cluster
+    """
+    spike_clusters = np.asarray(spike_clusters)
+    n = spike_clusters.size
+
+    # Stable sort by cluster as a (much faster) sort of unique keys
+    keys = spike_clusters.astype(np.int64) * n + np.arange(n)
+    keys.sort()
+    order, sorted_clusters = keys % n, keys // n
+    new = np.ones(n, dtype=bool)
+    new[1:] = sorted_clusters[1:] != sorted_clusters[:-1]
+    cluster_ids = sorted_clusters[new]
+    index = np.cumsum(new) - 1
+    counts = np.bincount(index, minlength=cluster_ids.size)
+    return order, cluster_ids, index, counts
+
+
+def refractory_violations(spike_times, spike_clusters, refractory=.0015):
+    """
+    Fraction of spikes within the refractory period of the previous
+    spike of the same cluster
+
+    Returns
+    -------
+
+    cluster_ids : ndarray (n_clusters,)
+        Sorted ids of the non-empty clusters
+    fraction : ndarray (n_clusters,)
+        Fraction of violating spikes per cluster
+    """
+    order, cluster_ids, index, counts = group_by_cluster(spike_clusters)
+    times = np.asarray(spike_times)[order]
+    return cluster_ids, _isi_violations(times, index, counts, refractory)
+
+
+def _isi_violations(times, index, counts, refractory):
+    """Fraction of refractory violations from the grouped spike times"""
+    short = np.diff(times) < refractory
+    short &= index[1:] == index[:-1]
+    n_short = np.bincount(index[1:][short], minlength=counts.size)
+    return n_short / counts
+
+
+def short_isi(spike_times, refractory=.0015):
+    """
+    Mask of the spikes of one cluster (sorted by time) within the
+    refractory period of the previous or next spike
+    """
+    if len(spike_times) < 2:
+        return np.zeros(len(spike_times), dtype=bool)
+    short = np.diff(spike_times) < refractory
+    return np.r_[short, False] | np.r_[False, short]
+
+
+def _nearest_other(times, clusters):
+    """
+    Distance to and index of the nearest spike of another cluster, for
+    spikes sorted by time
+    """
+    n = times.size
+    # The nearest spikes of other clusters are just outside the run of
+    # consecutive spikes of the same cluster
+    new = np.r_[True, clusters[1:] != clusters[:-1]]
+    run = np.cumsum(new) - 1
+    starts = np.flatnonzero(new)
+    ends = np.r_[starts[1:], n]
+    left, right = starts[run] - 1, ends[run]
+    dist = np.full(n, np.inf)
+    nearest = np.full(n, -1)
+    ok = left >= 0
+    dist[ok] = times[ok] - times[left[ok]]
+    nearest[ok] = left[ok]
+    ok = right < n
+    closer = np.zeros(n, dtype=bool)
+    closer[ok] = times[right[ok]] - times[ok] < dist[ok]
+    dist[closer] = times[right[closer]] - times[closer]
+    nearest[closer] = right[closer]
+    return dist, nearest
+
+
+def coincident_spikes(spike_times, spike_clusters, window=.0005):
+    """
+    Mask of the spikes within `window` of a spike of another cluster
+
+    The spike times of each cluster are expected to be sorted, such that
+    sorting all of them amounts to merging the clusters.
+    """
+    spike_times = np.asarray(spike_times)
+    mask = np.zeros(spike_times.size, dtype=bool)
+    if spike_times.size < 2:
+        return mask
+    order = np.argsort(spike_times, kind='stable')
+    dist, _ = _nearest_other(spike_times[order],
+                             np.asarray(spike_clusters)[order])
+    mask[order] = dist < window
+    return mask
+
+
+def duplicate_spikes(spike_times, spike_clusters, amplitudes,
+                     window=.0005):
+    """
+    Mask of the spikes detected twice by different clusters
+
+    Of two spikes of different clusters within `window`, the one with
+    the lower amplitude is the duplicate. In chains of coincident spikes,
+    only spikes next to a spike that is kept are removed at a time, until
+    no two of the remaining spikes of different clusters are within
+    `window`. The spikes are expected to be sorted by time, e.g. the
+    spikes of several clusters in the order of their ids, such that no
+    sort is needed.
+    """
+    spike_times = np.asarray(spike_times)
+    spike_clusters = np.asarray(spike_clusters)
+    amplitudes = np.asarray(amplitudes)
+    mask = np.zeros(spike_times.size, dtype=bool)
+    kept = np.arange(spike_times.size)
+    while kept.size >= 2:
+        dist, nearest = _nearest_other(spike_times[kept],
+                                       spike_clusters[kept])
+        amp = amplitudes[kept]
+        index = np.arange(kept.size)
+        # Ties are broken by time
+        lower = dist < window
+        lower[lower] = ((amp[lower] < amp[nearest[lower]]) |
+                        ((amp[lower] == amp[nearest[lower]]) &
+                         (index[lower] > nearest[lower])))
+        if not lower.any():
+            break
+        # Spikes next to a higher spike that is removed itself wait
+        remove = lower.copy()
+        remove[lower] = ~lower[nearest[lower]]
+        mask[kept[remove]] = True
+        kept = kept[~remove]
+    return mask
+
+
+def _amplitude_cutoff(amplitudes, index, counts, n_bins=500, smooth=3.):
+    """
+    Estimated fraction of spikes missing below the detection threshold
+    from the grouped amplitudes
+
+    The amplitude histogram of each cluster is mirrored at its peak to
+    extrapolate the truncated lower tail (Hill et al. 2011), capped at
+    0.5.
+    """
+    n_clusters = counts.size
+    start = np.r_[0, np.cumsum(counts)[:-1]]
+    lo = np.minimum.reduceat(amplitudes, start)
+    hi = np.maximum.reduceat(amplitudes, start)
+    width = np.where(hi > lo, hi - lo, 1) / n_bins
+
+    # Histograms of all clusters at once, one row per cluster
+    bins = ((amplitudes - lo[index]) / width[index]).astype(np.int64)
+    np.clip(bins, 0, n_bins - 1, out=bins)
+    hist = np.bincount(index * n_bins + bins, minlength=n_clusters * n_bins)
+    pdf = gaussian_filter1d(hist.reshape((n_clusters, n_bins)).astype(
+        np.float64), smooth, axis=1)
+    pdf /= np.maximum(pdf.sum(axis=1, keepdims=True), 1e-12)
+
+    # Bin above the peak with the density of the lowest bin
+    peak = np.argmax(pdf, axis=1)
+    above = np.arange(n_bins)[None, :] >= peak[:, None]
+    diff = np.where(above, np.abs(pdf - pdf[:, :1]), np.inf)
+    cut = np.argmin(diff, axis=1)
+    missing = np.where(np.arange(n_bins)[None, :] >= cut[:, None], pdf, 0)
+    return np.minimum(missing.sum(axis=1), .5)
+
+
+def _presence_ratio(times, index, counts, t0, t1, n_bins=100):
+    """Fraction of time bins with spikes from the grouped spike times"""
+    n_clusters = counts.size
+    bins = ((times - t0) / max(t1 - t0, 1e-12) * n_bins).astype(np.int64)
+    np.clip(bins, 0, n_bins - 1, out=bins)
+    hist = np.bincount(index * n_bins + bins, minlength=n_clusters * n_bins)
+    return np.mean(hist.reshape((n_clusters, n_bins)) > 0, axis=1)
+
+
+def quality_metrics(spike_times, spike_clusters, amplitudes, duration,
+                    refractory=.0015, peaks=None):
+    """
+    Quality metrics of all clusters in one grouped pass
+
+    Parameters
+    ----------
+
+    spike_times : array-like (n_spikes,)
+        Sorted spike times in seconds
+    spike_clusters : array-like (n_spikes,)
+        Cluster of each spike
+    amplitudes : array-like (n_spikes,)
+        Template amplitude of each spike
+    duration : float
+        Duration of the recording in seconds
+    refractory : float
+        Refractory period in seconds
+    peaks : array-like (n_spikes,)
+        Peak amplitude of each spike relative to the noise standard
+        deviation, optional
+
+    Returns
+    -------
+
+    cluster_ids : ndarray (n_clusters,)
+        Sorted ids of the non-empty clusters
+    metrics : dict
+        Arrays of the firing rate (fr), fraction of refractory
+        violations (isi_viol), estimated fraction of missing spikes
+        (amp_cutoff), fraction of the recording with spikes (presence)
+        and, if `peaks` is given, mean signal-to-noise ratio (snr) per
+        cluster
+    """
+    order, cluster_ids, index, counts = group_by_cluster(spike_clusters)
+    if not cluster_ids.size:
+        names = ('fr', 'isi_viol', 'amp_cutoff', 'presence') + (
+            ('snr',) if peaks is not None else ())
+        return cluster_ids, {name: np.zeros(0) for name in names}
+    times = np.asarray(spike_times)[order]
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)[order]
+    metrics = dict(
+        fr=counts / max(duration, 1e-12),
+        isi_viol=_isi_violations(times, index, counts, refractory),
+        amp_cutoff=_amplitude_cutoff(amplitudes, index, counts),
+        presence=_presence_ratio(times, index, counts, 0, duration),
+    )
+    if peaks is not None:
+        peaks = np.asarray(peaks, dtype=np.float64)[order]
+        metrics['snr'] = np.bincount(index, peaks) / counts
+    return cluster_ids, metrics
+
+
+def bimodality(values, spike_clusters):
+    """
+    Bimodality coefficient of a spike attribute, such as the amplitudes
+
+    Values above 5/9 (that of a uniform distribution) hint at a bimodal
+    distribution. Clusters with fewer than four spikes get NaN.
+
+    Returns
+    -------
+
+    cluster_ids : ndarray (n_clusters,)
+        Sorted ids of the non-empty clusters
+    coefficient : ndarray (n_clusters,)
+        Sample bimodality coefficient per cluster
+    """
+    order, cluster_ids, index, n = group_by_cluster(spike_clusters)
+    values = np.asarray(values, dtype=np.float64)[order]
+    mean = np.bincount(index, values) / n
+    dev = values - mean[index]
+    sq = dev * dev
+    m2 = np.bincount(index, sq) / n
+    m3 = np.bincount(index, sq * dev) / n
+    m4 = np.bincount(index, sq * sq) / n
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skew = m3 / m2 ** 1.5
+        kurt = m4 / m2 ** 2 - 3
+
+        # Corrected for the sample size
+        g = skew * np.sqrt(n * (n - 1)) / (n - 2)
+        k = ((n + 1) * kurt + 6) * (n - 1) / ((n - 2) * (n - 3))
+        coef = (g ** 2 + 1) / (k + 3 * (n - 1) ** 2 / ((n - 2) * (n - 3)))
+    coef[n < 4] = np.nan
+    return cluster_ids, coef
+
+
+def mahalanobis_outliers(features, threshold):
+    """
+    Indices of the observations further than `threshold` standard
+    deviations from the mean, by their Mahalanobis distance
+
+    Returns None if there are fewer observations than dimensions.
+    """
+    data = np.asarray(features, dtype=np.float64)
+    data = data.reshape((data.shape[0], -1))
+    if data.shape[0] <= data.shape[1]:
+        return None
+    data -= data.mean(axis=0)
+    cov = data.T @ data / (data.shape[0] - 1)
+    dist = np.sum((data @ np.linalg.pinv(cov)) * data, axis=1)
+    return np.flatnonzero(dist > threshold ** 2)
+
+
+def _outliers_task(args):
+    """Mahalanobis outliers of a shard of clusters in a worker process"""
+    features, shard, threshold = args
+    if isinstance(features, str):
+        features = np.load(features, mmap_mode='r')
+    return [(cluster_id, mahalanobis_outliers(gather(features, spike_ids),
+                                              threshold))
+            for cluster_id, spike_ids in shard]
+
+
+def _shards(spike_ids, n_shards):
+    """Split the clusters into shards with similar numbers of spikes"""
+    items = sorted(spike_ids.items(), key=lambda item: -len(item[1]))
+    shards = [[] for _ in range(n_shards)]
+    sizes = np.zeros(n_shards)
+    for item in items:
+        i = np.argmin(sizes)
+        shards[i].append(item)
+        sizes[i] += len(item[1])
+    return [shard for shard in shards if shard]
+
+
+def outliers_per_cluster(features, spike_ids, threshold, parallel=True):
+    """
+    Mahalanobis outliers of many clusters
+
+    Parameters
+    ----------
+
+    features : array-like (n_spikes, ...)
+        Features of all spikes. If memmapped, the workers read the file.
+    spike_ids : dict
+        Sorted spike ids per cluster id
+    threshold : float
+        Threshold in standard deviations
+    parallel : bool
+        Whether to distribute the clusters over the process pool
+
+    Returns
+    -------
+
+    outliers : dict
+        Indices into the spike ids of the outliers per cluster id, None
+        for clusters with too few spikes
+    """
+    filename = getattr(features, 'filename', None)
+    pool = process_pool() if parallel and filename else None
+    if pool is None:
+        return dict(_outliers_task((features, spike_ids.items(), threshold)))
+
+    # Several shards per worker to balance the load
+    n_shards = 4 * (os.cpu_count() or 1)
+    tasks = [(str(filename), shard, threshold)
+             for shard in _shards(spike_ids, n_shards)]
+    return dict(item for result in pool.map(_outliers_task, tasks)
+                for item in result)
+
+
+class MetricsTable(object):
+    """Quality metrics per cluster, computed when first requested"""
+
+    # Refractory period in s
+    refractory = .0015
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.data = dict()  # Metric name: {cluster id: value}
+        self._peaks = None
+        self._lock = threading.Lock()  # Also updated from worker threads
+
+    def template_peaks(self):
+        """
+        Peak of each template, relative to the noise standard deviation
+        as the templates are whitened, None without templates
+        """
+        if self._peaks is None:
+            templates = getattr(self.controller.model, 'sparse_templates',
+                                None)
+            if templates is None:
+                return None
+            self._peaks = np.abs(templates.data).max(axis=(1, 2))
+        return self._peaks
+
+    def pending(self):
+        """
+        Spike ids and a copy of the clusters of these spikes for the
+        clusters not in the table yet
+        """
+        clustering = self.controller.supervisor.clustering
+        with self._lock:
+            known = self.data.get('fr')
+            if known is None:
+                return slice(None), np.array(clustering.spike_clusters)
+            missing = [c for c in clustering.cluster_ids if c not in known]
+        spike_ids = clustering.spikes_in_clusters(missing) if missing else \
+            np.zeros(0, dtype=np.int64)
+        return spike_ids, clustering.spike_clusters[spike_ids]
+
+    def update(self, pending=None):
+        """
+        Compute the metrics of all clusters not in the table yet, or of
+        the spikes returned by `pending` before, e.g. in a worker thread
+        while the clustering may change
+        """
+        spike_ids, spike_clusters = pending or self.pending()
+        model = self.controller.model
+        amplitudes = model.amplitudes[spike_ids]
+        peaks = self.template_peaks()
+        if peaks is not None:
+            peaks = amplitudes * peaks[model.spike_templates[spike_ids]]
+        cluster_ids, metrics = quality_metrics(
+            model.spike_times[spike_ids], spike_clusters, amplitudes,
+            model.duration, self.refractory, peaks=peaks)
+        cluster_ids = cluster_ids.tolist()
+        with self._lock:
+            for name, values in metrics.items():
+                self.data.setdefault(name, dict()).update(
+                    zip(cluster_ids, values.tolist()))
+
+    def get(self, name, cluster_id):
+        """Return a metric of a cluster"""
+        values = self.data.get(name)
+        if values is None or cluster_id not in values:
+            self.update()
+            values = self.data.get(name, dict())
+        return values.get(cluster_id)
+
+    def values(self, name, cluster_ids):
+        """Return a metric of many clusters as array, NaN if unknown"""
+        self.update()
+        return self.lookup(name, cluster_ids)
+
+    def lookup(self, name, cluster_ids):
+        """Like `values`, without computing the missing clusters"""
+        with self._lock:
+            values = self.data.get(name, dict())
+            return np.array([values.get(c, np.nan) for c in cluster_ids],
+                            dtype=np.float64)
+
+
+def metrics_table(controller):
+    """Return the metrics table of a controller, create it on first use"""
+    table = getattr(controller, 'metrics_table', None)
+    if table is None:
+        table = MetricsTable(controller)
+        controller.metrics_table = table
+    return table
@@ -0,0 +1,535 @@
+"""
+Shared helpers for the plugins in this repository
+
+This module does not define a plugin itself. It is imported by the
+plugins that need to coordinate with each other. As phy loads plugin
+files by their path, the plugins add this directory to `sys.path`
+before importing from here.
+
+
+Column layout
+-------------
+
+`MEAColumns` removes columns and `ReorderColumns` moves columns to the
+right hand side of the cluster view and similarity view. Both register
+their changes with the column layout of the controller, which computes
+the final column order once when the controller is ready, i.e. before
+either table is built. The similarity view is then built directly with
+the 'similarity' column in place instead of being recreated afterwards.
+
+The resulting layout is cached in the Phy configuration directory,
+usually {HOME}/.phy/plugin_columnlayout.json.
+
+
+Configuration files
+-------------------
+
+Plugins with a JSON configuration in the Phy configuration directory
+obtain it with `load_config`. Each file is created with the defaults on
+first use, parsed once and shared. While the GUI is open, the
+modification time of the file is polled and the plugins are notified of
+changes, such that the configuration can be adjusted without restarting
+phy and reloading the data.
+
+
+Table styling
+-------------
+
+Plugins styling the rows of the cluster view or similarity view, e.g.
+`MarkChannel`, or changing their style sheet, e.g. `ReorderColumns`, do
+so through the bridge of the view returned by `table_bridge`. The
+operations of all plugins are collected and sent once per frame as a
+single JSON payload to a Javascript handler that is installed in the
+page once. Row styles of different plugins are kept apart, and the
+callbacks receive the result of their operation asynchronously. When a
+table is rebuilt, the handler is installed again with the current styles.
+
+
+Timings
+-------
+
+Plugin actions are decorated with `timed`, which keeps the wall time of
+the most recent calls of each action in a ring buffer. The actions
+report the number of spikes and bytes they loaded with `count`. The
+statistics are shown by the `PluginTimings` plugin.
+
+Note that this module may be executed a second time when phy scans the
+plugin directory. Shared objects are therefore only accessed through
+functions and never imported directly.
+"""
+
+import csv
+import inspect
+import json
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+import numpy as np
+from phy import connect
+from phy.cluster.supervisor import SimilarityView
+from phy.gui.qt import QTimer
+from phy.utils import phy_config_dir
+from pathlib import Path
+import logging
+
+logger = logging.getLogger('phy')
+
+
+class ColumnLayout(object):
+    """Final column order of the cluster view and similarity view"""
+
+    filename = 'plugin_columnlayout.json'
+
+    def __init__(self):
+        self.removed = []  # Columns to remove from the tables
+        self.last = []  # Columns to move to the right hand side
+        self.columns = None  # Final columns of the cluster view
+        self.similarity_columns = None  # Final columns of similarity view
+
+    def remove_columns(self, columns):
+        """Register columns to remove from both views"""
+        self.removed += [c for c in columns if c not in self.removed]
+
+    def move_to_end(self, columns):
+        """Register columns to move to the right hand side"""
+        self.last += [c for c in columns if c not in self.last]
+
+    def _key(self, columns):
+        """Identify the layout by its inputs"""
+        return dict(columns=list(columns), removed=self.removed,
+                    last=self.last)
+
+    def _load(self, key):
+        """Return the cached layout if it was computed from the same input"""
+        filepath = Path(phy_config_dir()) / self.filename
+        if not filepath.exists():
+            return None
+        try:
+            with open(filepath, 'r') as f:
+                data = json.load(f)
+        except json.decoder.JSONDecodeError as e:
+            logger.warning("Error decoding JSON: %s", e)
+            return None
+        if data.get('key') != key:
+            return None
+        return data
+
+    def _save(self, key):
+        filepath = Path(phy_config_dir()) / self.filename
+        logger.debug("Cache column layout at %s.", filepath)
+        data = dict(key=key, columns=self.columns,
+                    similarity_columns=self.similarity_columns)
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+
+    def compute(self, columns):
+        """Compute the final column order from the supervisor columns"""
+        key = self._key(columns)
+        cached = self._load(key)
+        if cached is not None:
+            logger.debug("Use cached column layout.")
+            self.columns = cached['columns']
+            self.similarity_columns = cached['similarity_columns']
+            return self.columns
+
+        columns = [c for c in columns
+                   if c not in self.removed and c not in self.last]
+        self.columns = columns + self.last
+        self.similarity_columns = self.similarity(self.columns)
+        self._save(key)
+        return self.columns
+
+    def similarity(self, columns):
+        """Order the similarity view columns with `last` after 'similarity'"""
+        # The views drop the 'id' column from the list they are given
+        columns = [c for c in columns if c not in ('id', 'similarity')]
+        if (self.similarity_columns is not None
+                and ['id'] + columns == self.columns):
+            return list(self.similarity_columns)
+        last = [c for c in self.last if c in columns]
+        return [c for c in columns if c not in last] + ['similarity'] + last
+
+    def update(self, supervisor, last):
+        """Change the columns on the right hand side and rebuild the views"""
+        self.last = list(last)
+        self.similarity_columns = None
+        self.apply(supervisor)
+        supervisor._reset_cluster_view()
+        supervisor.similarity_view._reset_table(
+            columns=supervisor.columns + ['similarity'],
+            sort=('similarity', 'desc'))
+
+    def apply(self, supervisor):
+        """Update the supervisor columns in place"""
+        for col in self.last:
+            if col not in supervisor.columns:
+                logger.debug("Add column %s.", col)
+                supervisor.cluster_meta.add_field(col)
+
+        columns = self.compute(supervisor.columns)
+        logger.debug("Set columns to %s.", ', '.join(columns))
+
+        # The list object is shared with the views, so it is kept
+        supervisor.columns[:] = columns
+
+
+def column_layout(controller):
+    """Return the column layout of a controller, create it on first use"""
+    layout = getattr(controller, 'column_layout', None)
+    if layout is not None:
+        return layout
+
+    layout = ColumnLayout()
+    controller.column_layout = layout
+
+    @connect
+    def on_controller_ready(sender):
+        if sender is not controller:
+            return
+        supervisor = controller.supervisor
+        layout.apply(supervisor)
+
+        # The similarity view is built in its constructor, with the layout
+        # of the supervisor creating it
+        _create_views = supervisor._create_views
+
+        def _create_views_with_layout(*args, **kwargs):
+            SimilarityView._building_layout = layout
+            try:
+                _create_views(*args, **kwargs)
+            finally:
+                SimilarityView._building_layout = None
+            supervisor.similarity_view.column_layout = layout
+
+        supervisor._create_views = _create_views_with_layout
+
+    # Build the similarity view directly with the final columns
+    if not getattr(SimilarityView, '_column_layout', False):
+        _reset_table = SimilarityView._reset_table
+
+        def _reset_table_with_layout(view, data=None, columns=(), sort=None):
+            view_layout = (getattr(view, 'column_layout', None) or
+                           getattr(SimilarityView, '_building_layout', None))
+            if view_layout is not None and view_layout.columns is not None:
+                columns = view_layout.similarity(columns)
+            _reset_table(view, data=data, columns=columns, sort=sort)
+
+        SimilarityView._reset_table = _reset_table_with_layout
+        SimilarityView._building_layout = None
+        SimilarityView._column_layout = True
+
+    return layout
+
+
+class PluginConfig(object):
+    """JSON configuration file of a plugin"""
+
+    # Interval in ms to check the file for modifications
+    poll_interval = 2000
+
+    def __init__(self, filename, defaults):
+        self.filepath = Path(phy_config_dir()) / filename
+        self.defaults = defaults
+        self.data = dict(defaults)
+        self._mtime = None
+        self._callbacks = []
+        self._timer = None
+        self.load()
+
+    def __getitem__(self, key):
+        return self.data.get(key, self.defaults[key])
+
+    def load(self):
+        """Load the file, return whether it was decoded successfully"""
+        # Create config file with defaults if it does not exist
+        if not self.filepath.exists():
+            logger.debug("Create default config at %s.", self.filepath)
+            with open(self.filepath, 'w', encoding='utf-8') as f:
+                json.dump(self.defaults, f, ensure_ascii=False, indent=4)
+
+        logger.debug("Load %s for config.", self.filepath)
+        self._mtime = self.filepath.stat().st_mtime
+        with open(self.filepath, 'r') as f:
+            try:
+                self.data = json.load(f)
+            except json.decoder.JSONDecodeError as e:
+                # Keep the previous (or default) values
+                logger.warning("Error decoding JSON: %s", e)
+                return False
+        return True
+
+    def check(self):
+        """Reload the file if modified and notify the watchers"""
+        try:
+            mtime = self.filepath.stat().st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime or not self.load():
+            return
+        logger.info("Apply modified config %s.", self.filepath)
+        for callback in self._callbacks:
+            callback(self)
+
+    def watch(self, callback):
+        """Call `callback(config)` whenever the file was modified"""
+        self._callbacks.append(callback)
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.timeout.connect(self.check)
+            self._timer.start(self.poll_interval)
+
+    def unwatch(self, callback):
+        """Stop notifying `callback` and stop polling if unused"""
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+        if not self._callbacks and self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+
+_configs = dict()
+
+
+def load_config(filename, defaults):
+    """Return the shared configuration of a file in the config directory"""
+    filepath = Path(phy_config_dir()) / filename
+    if filepath not in _configs:
+        _configs[filepath] = PluginConfig(filename, defaults)
+    return _configs[filepath]
+
+
+_BRIDGE_JS = """
+(window.phyPluginBridge = (function() {
+    var layers = {};  // Row styles by id
+
+    function rowId(row) {
+        var id = row.getAttribute('data-_id');
+
+        // New clusters do not have this attribute
+        if (!id) {
+            id = row.getElementsByClassName('id');
+            return id.length ? id[0].innerHTML : null;
+        }
+        return id;
+    }
+
+    var handlers = {
+        style: function(op) {
+            var s = document.getElementById(op.id);
+            if (!s) {
+                s = document.createElement('style');
+                s.id = op.id;
+                document.head.appendChild(s);
+            }
+            s.innerHTML = op.css;
+            return op.id;
+        },
+        rows: function(op) {
+            layers[op.id] = op;
+            var rows = document.getElementsByTagName('tr');
+            var changed = [];
+            for (var i = 0; i < rows.length; i++) {
+                var id = rowId(rows[i]);
+                if (id === null) {
+                    continue;
+                }
+
+                // Later layers override earlier ones on the same property
+                var value = '';
+                for (var name in layers) {
+                    var layer = layers[name];
+                    if (layer.property === op.property &&
+                            layer.values.hasOwnProperty(id)) {
+                        value = layer.values[id];
+                    }
+                }
+                rows[i].style[op.property] = value;
+                if (op.values.hasOwnProperty(id)) {
+                    changed.push(id);
+                }
+            }
+            return changed;
+        },
+    };
+
+    return function(ops) {
+        return ops.map(function(op) { return handlers[op.op](op); });
+    };
+})())(%s)
+"""
+
+
+class TableBridge(object):
+    """Batched style operations on a table view"""
+
+    # Delay in ms to collect the operations of a frame
+    interval = 16
+
+    def __init__(self, view):
+        self.view = view
+        self.state = OrderedDict()  # Key: latest operation
+        self._pending = OrderedDict()  # Key: operation to send
+        self._callbacks = dict()  # Key: callbacks of pending operation
+        self._installed = False
+        self._timer = None
+
+        def on_ready(sender):
+            # The page was rebuilt without the handler
+            self._installed = False
+            self._schedule()
+
+        connect(on_ready, event='ready', sender=view)
+
+    def style(self, id, css, callback=None):
+        """Set the style sheet of the view with a given id"""
+        self.queue(dict(op='style', id=id, css=css), callback=callback)
+
+    def rows(self, id, property, values, callback=None):
+        """
+        Set a style property of rows by cluster id and reset it on the
+        rows set before under the same id, `callback(cluster_ids)`
+        """
+        values = {str(c): v for c, v in values.items()}
+        self.queue(dict(op='rows', id=id, property=property, values=values),
+                   callback=callback)
+
+    def queue(self, op, callback=None):
+        """Send an operation with the next payload"""
+        key = (op['op'], op['id'])
+        self.state[key] = self._pending[key] = op
+        if callback is not None:
+            self._callbacks.setdefault(key, []).append(callback)
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.timeout.connect(self.flush)
+        if not self._timer.isActive():
+            self._timer.start(self.interval)
+
+    def flush(self):
+        """Send the pending operations in a single call"""
+        # Without the handler, resend the current state of all operations
+        installed = self._installed
+        ops = self._pending if installed else self.state
+        if not ops or not self.view.is_ready():
+            return  # Sent once the table is built
+        keys, payload = list(ops), json.dumps(list(ops.values()))
+        callbacks = self._callbacks
+        self._pending, self._callbacks = OrderedDict(), dict()
+        if installed:
+            expr = ('window.phyPluginBridge ? window.phyPluginBridge(%s) '
+                    ': null' % payload)
+        else:
+            expr = _BRIDGE_JS % payload
+            self._installed = True
+
+        def resolve(results):
+            if results is None:
+                # Missing handler after a page reload or table not loaded
+                self._installed = False
+                if installed:
+                    for key, items in callbacks.items():
+                        self._callbacks.setdefault(key, [])[:0] = items
+                    self.flush()
+                    return
+            results = results or [None] * len(keys)
+            for key, result in zip(keys, results):
+                for callback in callbacks.get(key, ()):
+                    callback(result)
+
+        self.view.eval_js(expr, callback=resolve)
+
+
+def table_bridge(view):
+    """Return the style bridge of a table view, create it on first use"""
+    bridge = getattr(view, 'table_bridge', None)
+    if bridge is None:
+        bridge = view.table_bridge = TableBridge(view)
+    return bridge
+
+
+class Timings(object):
+    """Ring buffers with the timings of the plugin actions"""
+
+    # Number of most recent calls kept per action
+    size = 1000
+
+    def __init__(self):
+        self.records = dict()
+        self._active = []  # Records of the currently running actions
+
+    @contextmanager
+    def measure(self, name):
+        """Record the wall time of the enclosed block"""
+        record = dict(time=0., spikes=0, nbytes=0)
+        self._active.append(record)
+        t0 = default_timer()
+        try:
+            yield record
+        finally:
+            record['time'] = default_timer() - t0
+            self._active.remove(record)
+            if name not in self.records:
+                self.records[name] = deque(maxlen=self.size)
+            self.records[name].append(record)
+
+    def count(self, spikes=0, nbytes=0):
+        """Add spikes and bytes loaded to the innermost running action"""
+        if self._active:
+            self._active[-1]['spikes'] += int(spikes)
+            self._active[-1]['nbytes'] += int(nbytes)
+
+    def stats(self):
+        """Return the statistics of each action as list of dicts"""
+        out = []
+        for name, records in sorted(self.records.items()):
+            t = np.array([r['time'] for r in records])
+            out.append(dict(
+                name=name,
+                calls=t.size,
+                p50=np.percentile(t, 50),
+                p95=np.percentile(t, 95),
+                spikes=np.mean([r['spikes'] for r in records]),
+                nbytes=np.mean([r['nbytes'] for r in records]),
+            ))
+        return out
+
+    def save(self, filepath):
+        """Write all recorded calls to a CSV file"""
+        with open(filepath, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('name', 'time', 'spikes', 'nbytes'))
+            for name, records in sorted(self.records.items()):
+                for r in records:
+                    writer.writerow((name, r['time'], r['spikes'],
+                                     r['nbytes']))
+
+
+_timings = Timings()
+
+
+def timings():
+    """Return the timings of all plugin actions"""
+    return _timings
+
+
+def count(spikes=0, nbytes=0):
+    """Report spikes and bytes loaded by the running plugin action"""
+    _timings.count(spikes=spikes, nbytes=nbytes)
+
+
+def timed(name):
+    """Decorator to record the timings of a plugin action"""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            with _timings.measure(name):
+                return f(*args, **kwargs)
+        # Phy inspects the arguments of actions for the input prompt
+        wrapped.__signature__ = inspect.signature(f)
+        return wrapped
+    return decorator
@@ -0,0 +1,171 @@
+"""
+On-disk cache of spike waveforms per cluster
+
+This module does not define a plugin itself, see `plugin_utils` and the
+`WaveformCache` plugin. It does not depend on phy.
+
+
+Format
+------
+
+The waveforms of all cached clusters are appended to a single raw file,
+`waveforms.bin`, as a ragged array: the (n_spikes, n_samples,
+n_channels) block of each cluster is stored contiguously and read back
+through a memmap. `index.npz` holds per cluster the offset and shape of
+its block, a key of the spikes of the cluster at the time, the number
+of spikes requested, and the spike and channel ids of the waveforms
+(again as offsets and values).
+
+Cluster ids are not reused within a session, but the clusters of an
+unsaved session get the same ids as new clusters of the next one. An
+entry is therefore only used if the key of the current spikes of the
+cluster matches.
+
+Blocks of replaced entries are not reclaimed. The cache is cleared when
+these make up most of the file.
+"""
+
+import hashlib
+import os
+import threading
+import numpy as np
+from pathlib import Path
+import logging
+
+logger = logging.getLogger('phy')
+
+
+def spikes_key(spike_ids):
+    """Key identifying a set of spikes"""
+    data = np.ascontiguousarray(spike_ids, dtype=np.int64)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class WaveformStore(object):
+    """Waveforms per cluster in a memmapped ragged array"""
+
+    # Clear the cache on load when less than this fraction is used
+    min_used = .5
+
+    def __init__(self, dirpath):
+        self.dirpath = Path(dirpath)
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        self.data_path = self.dirpath / 'waveforms.bin'
+        self.index_path = self.dirpath / 'index.npz'
+        self.entries = dict()  # Cluster id: entry dict
+        self.dtype = None
+        self.size = 0  # Bytes in the data file
+        self._lock = threading.Lock()  # Filled from a worker thread
+        self.load()
+
+    @property
+    def used(self):
+        """Bytes of the data file referenced by entries"""
+        return sum(int(np.prod(e['shape'])) for e in
+                   self.entries.values()) * getattr(self.dtype, 'itemsize', 0)
+
+    def load(self):
+        """Read the index, clear the cache if it is unusable"""
+        try:
+            with np.load(self.index_path) as f:
+                index = {k: f[k] for k in f.files}
+            self.dtype = np.dtype(str(index['dtype']))
+            self.size = self.data_path.stat().st_size
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            logger.debug("Start a new waveform cache: %s", e)
+            self.clear()
+            return
+
+        spike_ids = np.split(index['spike_ids'], index['spike_offsets'][1:-1])
+        channel_ids = np.split(index['channel_ids'],
+                               index['channel_offsets'][1:-1])
+        for i, cluster_id in enumerate(index['cluster_ids'].tolist()):
+            self.entries[cluster_id] = dict(
+                offset=int(index['offsets'][i]),
+                shape=tuple(index['shapes'][i].tolist()),
+                key=index['keys'][i].tobytes(),
+                n_requested=int(index['n_requested'][i]),
+                spike_ids=spike_ids[i], channel_ids=channel_ids[i])
+
+        end = max((e['offset'] + int(np.prod(e['shape'])) *
+                   self.dtype.itemsize for e in self.entries.values()),
+                  default=0)
+        if end > self.size or self.used < self.min_used * self.size:
+            logger.debug("Clear the waveform cache of %i bytes.", self.size)
+            self.clear()
+
+    def clear(self):
+        """Remove all entries and truncate the data file"""
+        with self._lock:
+            self.entries = dict()
+            self.dtype = None
+            self.size = 0
+            open(self.data_path, 'wb').close()
+            self._save_index()
+
+    def save(self):
+        """Write the index"""
+        with self._lock:
+            self._save_index()
+
+    def _save_index(self):
+        entries = sorted(self.entries.items())
+
+        def ragged(name, dtype):
+            values = [e[name] for _, e in entries]
+            offsets = np.r_[0, np.cumsum([len(v) for v in values])]
+            return (np.concatenate(values).astype(dtype) if values else
+                    np.zeros(0, dtype=dtype)), offsets.astype(np.int64)
+
+        spike_ids, spike_offsets = ragged('spike_ids', np.int64)
+        channel_ids, channel_offsets = ragged('channel_ids', np.int64)
+        keys = np.array([np.frombuffer(e['key'], np.uint8)
+                         for _, e in entries], dtype=np.uint8)
+        tmp = self.index_path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f, dtype=str(self.dtype or ''),
+                cluster_ids=np.array([c for c, _ in entries], dtype=np.int64),
+                offsets=np.array([e['offset'] for _, e in entries],
+                                 dtype=np.int64),
+                shapes=np.array([e['shape'] for _, e in entries],
+                                dtype=np.int64).reshape((-1, 3)),
+                keys=keys.reshape((-1, 16)),
+                n_requested=np.array([e['n_requested'] for _, e in entries],
+                                     dtype=np.int64),
+                spike_ids=spike_ids, spike_offsets=spike_offsets,
+                channel_ids=channel_ids, channel_offsets=channel_offsets)
+        os.replace(tmp, self.index_path)
+
+    def add(self, cluster_id, key, n_requested, spike_ids, channel_ids,
+            data):
+        """Append the waveforms of a cluster, replacing its entry"""
+        with self._lock:
+            if self.dtype is None:
+                self.dtype = np.dtype(data.dtype)
+            data = np.ascontiguousarray(data, dtype=self.dtype)
+            with open(self.data_path, 'ab') as f:
+                offset = f.tell()
+                f.write(data.tobytes())
+            self.size = offset + data.nbytes
+            self.entries[cluster_id] = dict(
+                offset=offset, shape=data.shape, key=key,
+                n_requested=n_requested,
+                spike_ids=np.asarray(spike_ids, dtype=np.int64),
+                channel_ids=np.asarray(channel_ids, dtype=np.int64))
+
+    def get(self, cluster_id, key, n_requested):
+        """Return the entry of a cluster if it is still valid"""
+        entry = self.entries.get(cluster_id)
+        if (entry is None or entry['key'] != key or
+                entry['n_requested'] != n_requested):
+            return None
+        return entry
+
+    def read(self, entry):
+        """Return the waveforms of an entry"""
+        if not np.prod(entry['shape']):
+            return np.zeros(entry['shape'], dtype=self.dtype)
+        data = np.memmap(self.data_path, dtype=self.dtype, mode='r',
+                         offset=entry['offset'], shape=entry['shape'])
+        return np.array(data)